@@ -64,6 +64,8 @@
 #         for copying data to the cluster. The following settings control the copy step
 #         and can be set in a config.json file:
 #           COPY_DEST_HOST, COPY_DEST_USER, COPY_DEST_GROUP, COPY_DEST_RUN_ROOT
+#         The connection is an ssh ControlMaster (bin/ssh_connection.py) shared by every
+#         rsync and remote command, and reopened when it drops.
 #
 # Warning re aborted runs
 #   1. If SolexaRun.sequencing_status is set to 'sequencing failed' in the LIMS,
@@ -89,6 +91,7 @@ import traceback
 import subprocess
 import email.mime.text
 from optparse import OptionParser
+from multiprocessing.pool import ThreadPool
 
 import dxpy
 import fnmatch
@@ -97,6 +100,17 @@ from distutils.version import StrictVersion
 sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),'..'))
 from bin.rundir import RunDir
 from bin import rundir_utils
+from bin import tar_writer
+from bin import checksum
+from bin.parallel_rsync import ParallelRsync
+from bin import copy_manifest
+from bin.ssh_connection import SSHConnectionPool
+from bin.copy_scheduler import CopyScheduler, CopyCandidate
+from bin.copy_progress import ProgressMonitor
+from bin.runroot_watcher import RunRootWatcher
+from bin.lims_cache import LimsCache
+from bin.copy_task import CopyTaskProcess
+from bin.state_journal import StateJournal, ReattachedProcess, get_process_start_time, is_process_running
 
 from scgpm_lims import Connection
 from scgpm_lims import RunInfo, SolexaRun, SolexaFlowCell
@@ -104,11 +118,20 @@ from scgpm_lims import RunInfo, SolexaRun, SolexaFlowCell
 class ValidationError(Exception):
     pass
 
+class DNAnexusUploadError(Exception):
+    pass
+
 class DNAnexusUpload:
 
+    STREAM_PART_SIZE = 64 * 1024 * 1024 # Upload part size in 'Stream' upload mode
+    UPLOAD_PART_SIZE = 64 * 1024 * 1024 # Upload part size in 'API' and 'UploadAgent' upload modes, and of the part MD5s
+                                        # recorded for each tar to check uploads against
+    TAR_WALK_THREADS = 8 # Directory listings run in parallel when tarring a lane
+
     def __init__(self, rundir, tar_dir, LOG_FILE, initiate_analysis_script, lims_url, 
                  lims_token, test, upload_mode, viewers, contributors, administrators, dx_env_config, 
-                 dx_workflow_config_dir, release, develop, region, upload_agent, ua_token):
+                 dx_workflow_config_dir, release, develop, region, upload_agent, ua_token,
+                 max_lane_uploads=1):
         self.rundir = rundir            # RunDir object
         self.tar_dir = tar_dir
         self.LOG_FILE = LOG_FILE
@@ -116,7 +139,7 @@ class DNAnexusUpload:
         self.lims_url = lims_url
         self.lims_token = lims_token
         self.test = test
-        self.upload_mode = upload_mode  # ['API', 'UploadAgent']
+        self.upload_mode = upload_mode  # ['API', 'UploadAgent', 'Stream']
         self.viewers = viewers
         self.contributors = contributors
         self.administrators = administrators
@@ -127,14 +150,17 @@ class DNAnexusUpload:
         self.region = region
         self.upload_agent = upload_agent
         self.ua_token = ua_token
+        self.max_lane_uploads = max_lane_uploads # lanes uploaded concurrently while the next lane is tarred
 
-        self.project_dxid = None
         self.interop_tar = None
         self.metadata_tar = None
 	#self.thumbnails_tar = None
         self.lane_tar_files = None
         self.rta_version = None
         self.file_dxids = {}
+        self.folder_files = {}       # (project_dxid, folder, class_name) -> describe_folder() listing
+        self.completed_uploads = {}  # (file name, signature) -> (project_dxid, file dxid)
+        self.upload_cache_lock = threading.Lock()
 
         dxpy.set_security_context({"auth_token_type": "bearer", "auth_token": self.ua_token})
 
@@ -142,8 +168,15 @@ class DNAnexusUpload:
         if not self.rta_version:
             self.rta_version = self.get_rta_version()
 
+        # In 'Stream' upload mode nothing is tarred to tar_dir; the tars are
+        # kept as (tar_name, members) specs and tarred during the upload.
+        streaming = self.upload_mode == 'Stream'
+
         # Tar interop and metadata files
-        self.interop_tar = self.tar_interop_dir()
+        if streaming:
+            self.interop_tar = self.get_interop_tar_spec()
+        else:
+            self.interop_tar = self.tar_interop_dir()
 
         # Tar metadata files
         print 'RTA version is: %s' % self.rta_version
@@ -151,10 +184,16 @@ class DNAnexusUpload:
             print 'Tarring metadata according to RTA v1 pattern'
             #print 'ERROR: workflow does not support RTA versions older than 1.18.54'
             #sys.exit()
-            self.metadata_tar = self.tar_rta_v1_metadata()
+            if streaming:
+                self.metadata_tar = self.get_rta_v1_metadata_tar_spec()
+            else:
+                self.metadata_tar = self.tar_rta_v1_metadata()
         elif StrictVersion(self.rta_version) >= StrictVersion('2.0.0'):
             print 'Tarring metadata files according to RTA v2 pattern'
-            self.metadata_tar = self.tar_rta_v2_metadata()
+            if streaming:
+                self.metadata_tar = self.get_rta_v2_metadata_tar_spec()
+            else:
+                self.metadata_tar = self.tar_rta_v2_metadata()
         else:
             print 'Error: Could not figure out how to tar metadata'
             sys.exit()
@@ -166,95 +205,105 @@ class DNAnexusUpload:
         #self.metadata_tar = self.tar_rta_v2_metadata()
         #self.lane_paths = self.get_lane_paths()  # self.lane_tar_files["L001"] = lane_dir_path
 
-        # Tars all lanes before uploading files
-        for lane_name in self.lane_paths:
-            lane_index = int(lane_name[-1:])
-            #lane_tar = self.tar_rta_v2_lane_path(lane_name, lane_index)
-            if StrictVersion(self.rta_version) < StrictVersion('2.0.0'):
-                lane_tar = self.tar_rta_v1_lane_path(lane_name, lane_index)
-            elif StrictVersion(self.rta_version) >= StrictVersion('2.0.0'):
-                print 'Tarring lane %d according to RTA v2 pattern' % lane_index
-                lane_tar = self.tar_rta_v2_lane_path(lane_name, lane_index)
-
-            self.project_dxid = self.get_dnanexus_project(lane_index)
-            dxids = self.upload_lane(lane_index=lane_index, lane_tar=lane_tar)
-            self.file_dxids[lane_index] = dxids
-            self.call_initiate_analysis(lane_index)
+        # Lanes are tarred one at a time here, and each finished lane tar is
+        # handed to a pool of max_lane_uploads threads that creates the lane's
+        # project, uploads to it and initiates analysis. Lane N+1 is being
+        # tarred while lane N uploads. When streaming, the lane is tarred by
+        # its upload thread instead.
+        pool = ThreadPool(processes=max(1, self.max_lane_uploads))
+        lane_results = []
+        failed_lanes = []
+        try:
+            for lane_name in sorted(self.lane_paths):
+                lane_index = int(lane_name[-1:])
+                #lane_tar = self.tar_rta_v2_lane_path(lane_name, lane_index)
+                if StrictVersion(self.rta_version) < StrictVersion('2.0.0'):
+                    if streaming:
+                        lane_tar = self.get_rta_v1_lane_tar_spec(lane_name, lane_index)
+                    else:
+                        lane_tar = self.tar_rta_v1_lane_path(lane_name, lane_index)
+                elif StrictVersion(self.rta_version) >= StrictVersion('2.0.0'):
+                    print 'Tarring lane %d according to RTA v2 pattern' % lane_index
+                    if streaming:
+                        lane_tar = self.get_rta_v2_lane_tar_spec(lane_name, lane_index)
+                    else:
+                        lane_tar = self.tar_rta_v2_lane_path(lane_name, lane_index)
+                lane_results.append((lane_index, pool.apply_async(self.process_lane, (lane_index, lane_tar))))
+            pool.close()
+            for (lane_index, lane_result) in lane_results:
+                try:
+                    self.file_dxids[lane_index] = lane_result.get()
+                except Exception, e:
+                    print 'Error: Upload of %s L%d failed: %s' % (self.rundir.get_dir(), lane_index, e)
+                    failed_lanes.append(lane_index)
+        finally:
+            pool.terminate()
+            pool.join()
+        if failed_lanes:
+            # Nonzero exit so autocopy reports the failed copy and retries the run.
+            sys.exit(1)
+
+    def process_lane(self, lane_index, lane_tar):
+        """
+        Function : Finds or creates the lane's DNAnexus project, uploads the InterOp, metadata
+                   and lane tars to it, and initiates analysis. Runs in a lane upload thread.
+        Returns  : The list of uploaded file dxids.
+        """
+        try:
+            project_dxid = self.get_dnanexus_project(lane_index)
+            dxids = self.upload_lane(lane_index=lane_index, lane_tar=lane_tar, project_dxid=project_dxid)
+            self.call_initiate_analysis(lane_index, project_dxid)
+        except SystemExit:
+            # The upload helpers sys.exit() on errors, which would otherwise
+            # silently kill the pool thread and leave run() waiting forever.
+            raise DNAnexusUploadError('Upload of lane %d exited' % lane_index)
+        return dxids
 
     def get_rta_version(self):
-        params_file = os.path.join(self.rundir.get_path(), 'runParameters.xml')
-        with open(params_file, 'r') as PARAM:
-            for line in PARAM:
-                match = re.search(r'<RTAVersion>([\d\.]+)</RTAVersion>', line)
-                if match:
-                    rta_version = match.group(1)
-                    break
-        return rta_version
+        # <RTAVersion> from the run's parsed runParameters.xml
+        return self.rundir.get_run_parameters().rta_version
  
     def tar_interop_dir(self):
         ''' Description: tar and upload InterOp directory to lane DNAnexus project
         '''
-        tar_name = '%s.InterOp.tar' % self.rundir.get_dir()
-        tar_path = os.path.join(self.tar_dir, tar_name)
-        
-        if os.path.isfile(tar_path):
-            return tar_path
+        (tar_name, members) = self.get_interop_tar_spec()
+        return self.write_tar(tar_name, members, verbose=True)
 
-        interop_tar_list = ['tar', '-C', self.rundir.get_path(), 
-                                '-cvf', tar_path, 'InterOp', 'runParameters.xml', 'RunInfo.xml'
-                            ]
-        interop_tar_proc = subprocess.call(interop_tar_list, stdout=self.LOG_FILE, 
-                                            stderr=self.LOG_FILE
-                       )
-        # Check that InterOp tar file exists
-        return tar_path
+    def get_interop_tar_spec(self):
+        tar_name = '%s.InterOp.tar' % self.rundir.get_dir()
+        return (tar_name, ['InterOp', 'runParameters.xml', 'RunInfo.xml'])
 
     def tar_rta_v1_metadata(self):
         ''' Description:
         '''
+        (tar_name, members) = self.get_rta_v1_metadata_tar_spec()
+        return self.write_tar(tar_name, members, verbose=True)
 
+    def get_rta_v1_metadata_tar_spec(self):
         tar_name = '%s.metadata.tar' % self.rundir.get_dir() # get_dir() = basename/run name
-        tar_path = os.path.join(self.tar_dir, tar_name)
-
-        if os.path.isfile(tar_path):
-                return tar_path
-
-        meta_tar_list = ['tar', '-C', '%s' % self.rundir.get_path(),
-                         '-cvf', '%s' % tar_path,
-                         'runParameters.xml', 'RunInfo.xml',
-                         'Data/RTALogs', 'Data/Intensities/config.xml', 'Data/Intensities/BaseCalls/config.xml',
-                         'RTAComplete.txt',
-                         'Data/Intensities/RTAConfiguration.xml', 'Data/Intensities/config.xml',
-                         'Data/Intensities/Offsets',
-                         'Recipe', 'Config']
-
-        meta_tar_proc = subprocess.call(meta_tar_list, stdout=self.LOG_FILE,
-                                         stderr=self.LOG_FILE)
-        return tar_path
+        members = ['runParameters.xml', 'RunInfo.xml',
+                   'Data/RTALogs', 'Data/Intensities/config.xml', 'Data/Intensities/BaseCalls/config.xml',
+                   'RTAComplete.txt',
+                   'Data/Intensities/RTAConfiguration.xml', 'Data/Intensities/config.xml',
+                   'Data/Intensities/Offsets',
+                   'Recipe', 'Config']
+        return (tar_name, members)
 
     def tar_rta_v2_metadata(self):
         ''' DEV: Change this to mirror formatting of tar_rta_v1_metadata method and specify files/dirs
         Description:
         '''
+        (tar_name, members) = self.get_rta_v2_metadata_tar_spec()
+        return self.write_tar(tar_name, members, verbose=True)
 
+    def get_rta_v2_metadata_tar_spec(self):
         tar_name = '%s.metadata.tar' % self.rundir.get_dir() # get_dir() = basename/run name
-        tar_path = os.path.join(self.tar_dir, tar_name)
-
-        if os.path.isfile(tar_path):
-                return tar_path
-
-        meta_tar_list = ['tar', '-C', '%s' % self.rundir.get_path(),
-                         '-cvf', '%s' % tar_path,
-                         'runParameters.xml', 'RunInfo.xml', 'RTAConfiguration.xml',
-                         'RTALogs',
-                         'RTAComplete.txt',
-                         'Recipe', 'Config',
-             		 'Data/Intensities/s.locs'
-           	 	]
-        
-        meta_tar_proc = subprocess.call(meta_tar_list, stdout=self.LOG_FILE,
-                                         stderr=self.LOG_FILE)
-        return tar_path
+        members = ['runParameters.xml', 'RunInfo.xml', 'RTAConfiguration.xml',
+                   'RTALogs',
+                   'RTAComplete.txt',
+                   'Recipe', 'Config',
+                   'Data/Intensities/s.locs']
+        return (tar_name, members)
  
     def get_lane_paths(self):
 
@@ -269,68 +318,194 @@ class DNAnexusUpload:
         return lane_paths
 
     def tar_rta_v1_lane_path(self, lane_name, lane_index):
+        (tar_name, members) = self.get_rta_v1_lane_tar_spec(lane_name, lane_index)
+        return self.write_tar(tar_name, members)
 
+    def get_rta_v1_lane_tar_spec(self, lane_name, lane_index):
         tar_name = '%s_L%d.tar' % (self.rundir.get_dir(), lane_index)
-        tar_path = os.path.join(self.tar_dir, tar_name)
-        if os.path.isfile(tar_path):
-            pass
-        else:
-            intens_rel_path = os.path.join('Data', 'Intensities', lane_name)
-            basecall_rel_path = os.path.join('Data', 'Intensities', 'BaseCalls', lane_name)
-            lane_tar_list = ['tar', '-C', self.rundir.get_path(),
-                             '-cf', tar_path, intens_rel_path, basecall_rel_path
-                            ]
-            lane_tar_proc = subprocess.call(lane_tar_list, stdout=self.LOG_FILE,
-                                                         stderr=self.LOG_FILE)
-        return tar_path
-
+        intens_rel_path = os.path.join('Data', 'Intensities', lane_name)
+        basecall_rel_path = os.path.join('Data', 'Intensities', 'BaseCalls', lane_name)
+        return (tar_name, [intens_rel_path, basecall_rel_path])
 
     def tar_rta_v2_lane_path(self, lane_name, lane_index):
+        (tar_name, members) = self.get_rta_v2_lane_tar_spec(lane_name, lane_index)
+        return self.write_tar(tar_name, members)
 
+    def get_rta_v2_lane_tar_spec(self, lane_name, lane_index):
         tar_name = '%s_L%d.tar' % (self.rundir.get_dir(), lane_index)
+        basecall_rel_path = os.path.join('Data', 'Intensities', 'BaseCalls', lane_name)
+        return (tar_name, [basecall_rel_path])
+
+    def write_tar(self, tar_name, members, verbose=False):
+        """
+        Function : Tars members (paths relative to the run directory) into tar_name in tar_dir,
+                   unless that tar already exists from an earlier attempt. The tar is
+                   checksummed as it's written, into a sidecar file for upload_file().
+        Returns  : The tar path.
+        """
         tar_path = os.path.join(self.tar_dir, tar_name)
         if os.path.isfile(tar_path):
-                pass
-        else :
-                basecall_rel_path = os.path.join('Data', 'Intensities', 'BaseCalls', lane_name)
-                lane_tar_list = ['tar', '-C', self.rundir.get_path(),
-                                 '-cf', tar_path, basecall_rel_path
-                                ]
-                lane_tar_proc = subprocess.call(lane_tar_list, stdout=self.LOG_FILE,
-                                                 stderr=self.LOG_FILE)
+            return tar_path
+        # tar_writer writes to a temporary file and renames it, so an
+        # interrupted tar is redone rather than uploaded.
+        hasher = checksum.MultiHasher(part_size = self.UPLOAD_PART_SIZE)
+        try:
+            tar_stats = tar_writer.write_tar(self.rundir.get_path(), members, tar_path,
+                                             walk_threads = self.TAR_WALK_THREADS,
+                                             list_file = self.LOG_FILE if verbose else None,
+                                             hasher = hasher)
+        finally:
+            checksums = hasher.finish()
+        self.log_tar_stats(tar_name, tar_stats)
+        checksum.write_checksums(tar_path, checksums)
         return tar_path
 
-    def upload_file(self, file_path, class_name, project_dxid, folder): 
+    def log_tar_stats(self, tar_name, tar_stats):
+        print 'Info: Tarred %s: %s' % (tar_name, tar_stats)
+        # Missing optional members are reported but don't stop the upload,
+        # as with GNU tar.
+        for path in tar_stats.missing:
+            print 'Warning: %s: Cannot read %s' % (tar_name, path)
+        for path in tar_stats.changed:
+            print 'Warning: %s: File shrank while being tarred: %s' % (tar_name, path)
+
+    def stream_tar_upload(self, tar_spec, project_dxid, folder):
+        """
+        Function : 'Stream' upload mode. Tars straight into a new DNAnexus file, uploading
+                   it in STREAM_PART_SIZE parts, so the archive is never written to tar_dir
+                   and the run is read from disk only once.
+        Args     : tar_spec - (tar_name, members) from one of the get_*_tar_spec methods.
+        Returns  : The uploaded file dxid.
+        """
+        (tar_name, members) = tar_spec
+        upload_file_dxid = self.find_uploaded_file(tar_name, 'file', project_dxid, folder)
+        if upload_file_dxid:
+            return upload_file_dxid
+
+        print 'Streaming file %s to DNAnexus' % tar_name
+        # write() uploads a part each time write_buffer_size bytes are
+        # buffered, which bounds memory to about two parts per stream.
+        upload_file_dxfile = dxpy.new_dxfile(name = tar_name,
+                                             project = project_dxid,
+                                             folder = folder,
+                                             properties = {'upload_complete': 'false'},
+                                             parents = True,
+                                             write_buffer_size = self.STREAM_PART_SIZE)
+        hasher = checksum.MultiHasher(part_size = self.STREAM_PART_SIZE)
+        try:
+            tar_stats = tar_writer.write_tar(self.rundir.get_path(), members, upload_file_dxfile,
+                                             walk_threads = self.TAR_WALK_THREADS,
+                                             buffer_size = self.STREAM_PART_SIZE,
+                                             hasher = hasher)
+        finally:
+            checksums = hasher.finish()
+        self.log_tar_stats(tar_name, tar_stats)
+        upload_file_dxfile.close(block=True)
+        upload_file_dxid = upload_file_dxfile.get_id()
+        self.check_upload(tar_name, checksums, upload_file_dxid, project_dxid)
+        upload_file_dxfile.set_properties(properties = {'upload_complete': 'true'})
+        self.record_completed_upload(tar_name, None, project_dxid, upload_file_dxid)
+        return upload_file_dxid
+
+    def find_uploaded_file(self, file_basename, class_name, project_dxid, folder, signature=None):
+        """
+        Function : Looks for a completed upload of file_basename in the project folder, removing
+                   any incomplete uploads found along the way. A completed upload of the same
+                   file (same name and signature) made into another lane project by this process
+                   is cloned into project_dxid instead of being uploaded again.
+        Returns  : The dxid of the completed upload, or None.
+        """
         upload_file_dxid = None
-        file_basename = os.path.basename(file_path)
         file_glob_name = file_basename + '*'
-	print 'Info: Checking upload status of file: %s' % file_path
-        # Find any existing copies of this file on DNAnexus
-        dxfile_generator = dxpy.find_data_objects(
-                                                  classname = class_name, 
-                                                  name = file_glob_name,
-                                                  name_mode = 'glob',
-                                                  project = project_dxid,
-                                                  folder = folder,
-                                                  properties = {'upload_complete': True})
+        # Find any existing copies of this file on DNAnexus, using the
+        # folder listing fetched once for all files of the project folder
+        dxfiles = [dxfile_desc for dxfile_desc in self.describe_folder(project_dxid, folder, class_name)
+                   if fnmatch.fnmatch(dxfile_desc['name'], file_glob_name)
+                   and 'upload_complete' in dxfile_desc['properties']]
 
         # Determine whether they are complete file based on 'upload_complete' boolean flag
-        dxfiles = list(dxfile_generator)
         if len(dxfiles) == 0:
             print 'Info: Did not find any existing %s files on DNAnexus' % file_basename
-        for dxfile_dict in dxfiles:
+        for dxfile_desc in dxfiles:
             print 'Info: Found existing file %s on DNAnexus' % file_basename
-            dxfile = dxpy.DXFile(dxid=dxfile_dict['id'], project=dxfile_dict['project'])
-            properties = dxfile.get_properties()
+            properties = dxfile_desc['properties']
             if properties['upload_complete'] == 'false':
                 print 'Warning: Incomplete upload of file %s found; removing' % file_basename
-                dxfile.remove()
+                dxpy.DXFile(dxid=dxfile_desc['id'], project=dxfile_desc['project']).remove()
+                with self.upload_cache_lock:
+                    self.folder_files[(project_dxid, folder, class_name)].remove(dxfile_desc)
             elif properties['upload_complete'] == 'true':
                 print 'Info: File %s completed upload; skipping upload' % file_basename
-                upload_file_dxid = dxfile.get_id()
+                upload_file_dxid = dxfile_desc['id']
             else:
                 print 'Error: Unable to determine upload status of %s' % file_basename
                 sys.exit()
+        if upload_file_dxid:
+            self.record_completed_upload(file_basename, signature, project_dxid, upload_file_dxid)
+        else:
+            upload_file_dxid = self.clone_completed_upload(file_basename, signature, project_dxid, folder)
+        return upload_file_dxid
+
+    def describe_folder(self, project_dxid, folder, class_name):
+        """
+        Function : Lists the objects of class_name in a project folder with their names and
+                   properties, in one query, and caches the listing for this upload.
+        Returns  : A list of dicts with keys id, project, name and properties.
+        """
+        key = (project_dxid, folder, class_name)
+        with self.upload_cache_lock:
+            if key not in self.folder_files:
+                results = dxpy.find_data_objects(
+                                                 classname = class_name,
+                                                 project = project_dxid,
+                                                 folder = folder,
+                                                 describe = {'fields': {'name': True, 'properties': True}})
+                self.folder_files[key] = [{'id': result['id'],
+                                           'project': result['project'],
+                                           'name': result['describe']['name'],
+                                           'properties': result['describe']['properties']}
+                                          for result in results]
+            return list(self.folder_files[key])
+
+    def get_file_signature(self, file_path):
+        """
+        Returns : (size, mtime) of a local file, used with its name to recognize the same
+                  file when it is uploaded to more than one lane project.
+        """
+        stat = os.stat(file_path)
+        return (stat.st_size, int(stat.st_mtime))
+
+    def record_completed_upload(self, file_basename, signature, project_dxid, upload_file_dxid):
+        with self.upload_cache_lock:
+            self.completed_uploads.setdefault((file_basename, signature), (project_dxid, upload_file_dxid))
+
+    def clone_completed_upload(self, file_basename, signature, project_dxid, folder):
+        """
+        Function : Clones a file already uploaded to another project by this process into
+                   project_dxid. Cloning keeps the file's id and properties.
+        Returns  : The file dxid, or None if there is no such upload or cloning failed.
+        """
+        with self.upload_cache_lock:
+            cached = self.completed_uploads.get((file_basename, signature))
+        if not cached:
+            return None
+        (source_project_dxid, upload_file_dxid) = cached
+        if source_project_dxid == project_dxid:
+            return upload_file_dxid
+        print 'Info: Cloning uploaded file %s from %s' % (file_basename, source_project_dxid)
+        try:
+            dxpy.DXFile(dxid=upload_file_dxid, project=source_project_dxid).clone(project_dxid, folder=folder,
+                                                                                   parents=True)
+        except dxpy.exceptions.DXAPIError, e:
+            print 'Warning: Could not clone %s, uploading it instead: %s' % (file_basename, e)
+            return None
+        return upload_file_dxid
+
+    def upload_file(self, file_path, class_name, project_dxid, folder): 
+        file_basename = os.path.basename(file_path)
+        signature = self.get_file_signature(file_path)
+        print 'Info: Checking upload status of file: %s' % file_path
+        upload_file_dxid = self.find_uploaded_file(file_basename, class_name, project_dxid, folder, signature)
         # If complete copy of file does not exist on DNAnexus, upload it
         
         if not upload_file_dxid:
@@ -338,19 +513,21 @@ class DNAnexusUpload:
                 print 'Uploading file %s to DNAnexus' % file_basename
                 upload_file_dxfile = dxpy.upload_local_file(
                                                             filename = file_path,
+                                                            write_buffer_size = self.UPLOAD_PART_SIZE,
                                                     	    project = project_dxid,
                                                 	    folder = folder,
                                             		    properties = {'upload_complete': 'false'},
                                             		    parents = True)
       		upload_file_dxid = upload_file_dxfile.get_id()
-           	upload_file_dxfile.set_properties(properties = {'upload_complete': 'true'})
             
             elif self.upload_mode == 'UploadAgent':
 		
+                # The InterOp and metadata tars go to every lane project, possibly
+                # at the same time, so each project gets its own log.
                 if self.develop:
-                    log_file = '/seqctr/Runs/DNAnexus_Logs/dev_%s.ua.log' % file_basename
+                    log_file = '/seqctr/Runs/DNAnexus_Logs/dev_%s.%s.ua.log' % (file_basename, project_dxid)
                 else:
-                    log_file = '/seqctr/Runs/DNAnexus_Logs/%s.ua.log' % file_basename
+                    log_file = '/seqctr/Runs/DNAnexus_Logs/%s.%s.ua.log' % (file_basename, project_dxid)
 
                 command = '%s ' % self.upload_agent
                 command += '--auth-token %s ' % self.ua_token
@@ -360,7 +537,8 @@ class DNAnexusUpload:
                 command += '--read-threads 2 '          # default == 2
                 #command += '--compress-threads 8 '       # default == 1
                 command += '--upload-threads 200 '        # default == 8
-                command += '--chunk-size 40M '          # default == 75M
+                # Parts the size of the part MD5s, so check_upload() can verify the upload
+                command += '--chunk-size %dM ' % (self.UPLOAD_PART_SIZE / (1024 * 1024))   # default == 75M
                 command += '--do-not-compress '
 		command += '--no-round-robin-dns '
 		command += '%s '	% file_path 
@@ -379,23 +557,63 @@ class DNAnexusUpload:
 		if upload_file_dxid == None:
 			print 'Error: Could not determine file dxid from log: %s' % log_file
 			sys.exit()
-		else:
-			upload_file_dxfile = dxpy.DXFile(dxid=upload_file_dxid, project=project_dxid)
-			upload_file_dxfile.set_properties(properties = {'upload_complete': 'true'})
+            # Marked complete only once verified, so find_uploaded_file() doesn't
+            # take an unverified upload as done.
+            self.verify_upload(file_path, upload_file_dxid, project_dxid)
+            upload_file_dxfile = dxpy.DXFile(dxid=upload_file_dxid, project=project_dxid)
+            upload_file_dxfile.set_properties(properties = {'upload_complete': 'true'})
+        self.record_completed_upload(file_basename, signature, project_dxid, upload_file_dxid)
         return upload_file_dxid
+
+    def verify_upload(self, file_path, upload_file_dxid, project_dxid):
+        """
+        Function : Checks the upload of a local file against the checksums recorded in its
+                   sidecar when it was tarred, so the file needn't be read again.
+        """
+        file_basename = os.path.basename(file_path)
+        checksums = checksum.read_checksums(file_path)
+        if checksums is None:
+            print 'Warning: No checksums recorded for %s; upload not verified' % file_basename
+            return
+        self.check_upload(file_basename, checksums, upload_file_dxid, project_dxid)
+
+    def check_upload(self, file_basename, checksums, upload_file_dxid, project_dxid):
+        """
+        Function : Compares checksums with the MD5s DNAnexus reports for the parts of the
+                   uploaded file. An upload that doesn't match is marked incomplete, so that
+                   the next attempt removes it and uploads the file again, and
+                   DNAnexusUploadError is raised.
+        """
+        upload_file_dxfile = dxpy.DXFile(dxid=upload_file_dxid, project=project_dxid)
+        parts = upload_file_dxfile.describe(fields={'parts'})['parts']
+        matched = checksum.match_parts(checksums, parts)
+        if matched is None:
+            print 'Warning: %s was uploaded in parts of another size; upload not verified' % file_basename
+        elif matched:
+            print 'Info: Verified upload of %s (%d bytes, MD5 %s)' % (file_basename, checksums.size,
+                                                                        checksums.get_md5())
+        else:
+            upload_file_dxfile.set_properties(properties = {'upload_complete': 'false'})
+            raise DNAnexusUploadError('Upload of %s does not match its checksums' % file_basename)
     
-    def upload_lane(self, lane_index, lane_tar):
+    def upload_lane(self, lane_index, lane_tar, project_dxid):
+        if self.upload_mode == 'Stream':
+            # interop_tar, metadata_tar and lane_tar are (tar_name, members) specs
+            interop_dxid = self.stream_tar_upload(self.interop_tar, project_dxid, '/raw_data')
+            metadata_dxid = self.stream_tar_upload(self.metadata_tar, project_dxid, '/raw_data')
+            lane_dxid = self.stream_tar_upload(lane_tar, project_dxid, '/raw_data')
+            return [interop_dxid, metadata_dxid, lane_dxid]
         interop_dxid = self.upload_file(file_path = self.interop_tar,
                                         class_name = 'file', 
-                                        project_dxid = self.project_dxid, 
+                                        project_dxid = project_dxid, 
                                         folder = '/raw_data')
         metadata_dxid = self.upload_file(file_path = self.metadata_tar, 
                                          class_name = 'file', 
-                                         project_dxid = self.project_dxid, 
+                                         project_dxid = project_dxid, 
                                          folder = '/raw_data')
         lane_dxid = self.upload_file(file_path = lane_tar, 
                                      class_name = 'file',
-                                     project_dxid = self.project_dxid, 
+                                     project_dxid = project_dxid, 
                                      folder='/raw_data')
         return [interop_dxid, metadata_dxid, lane_dxid]
 
@@ -477,14 +695,14 @@ class DNAnexusUpload:
             sys.exit()
         return project_dxid
 
-    def call_initiate_analysis(self, lane_index):
+    def call_initiate_analysis(self, lane_index, project_dxid):
         # Initiate analysis
         print 'Info: Initiating analysis for %s L%d' % (self.rundir.get_dir(), int(lane_index))
         # List must contain only strings
         analysis_list = [self.initiate_analysis_script, 
                  '-n', self.rundir.get_dir(),
                  '-l', str(lane_index),
-                 '-p', self.project_dxid,
+                 '-p', project_dxid,
                  '-r', self.rta_version,
                  '-u', self.lims_url,
                  '-o', self.lims_token,
@@ -551,9 +769,31 @@ class Autocopy:
     SUBDIR_ABORTED = "DNAnexus_Runs_Aborted" # Runs are moved here if flagged 'sequencing_failed'
 
     LIMS_API_VERSION = 'v1'
+    LIMS_CACHE_SECONDS = 300 # LIMS RunInfo lookups are reused for this long
+    LIMS_NOT_FOUND_CACHE_SECONDS = 600 # Runs not in the LIMS yet are looked up again after this long
+    LIMS_ERROR_RETRY_SECONDS = 60 # Lookups that failed for other reasons are retried after this long
+    LIMS_MAX_STALE_SECONDS = 3600 # While the LIMS can't be reached, keep using RunInfo this much older
+    LIMS_CACHE_MAX_ENTRIES = 1000
+    LIMS_PREFETCH_THREADS = 8 # Concurrent LIMS lookups at the start of each pass
 
     MAX_COPY_PROCESSES = 1 # Cap the number of copy procs
                            # if --no_copy, this is set to 0.
+                           # Below the cap, the number follows measured copy throughput.
+    COPY_BANDWIDTH_BUDGET_MB = 0 # MB/s all copies may use together. 0 for no budget.
+    COPY_QUEUE_PRIORITIES = {} # LIMS sequencing queue -> priority. Runs with higher priority copy first.
+    COPY_AGE_HALVING_SECONDS = 6*3600 # Other runs copy smallest first, with size halved after waiting this long.
+    MAX_RUNDIR_WORKERS = 1 # Number of run dirs processed concurrently in each pass.
+                           # 1 processes them one after another.
+    MAX_LANE_UPLOADS = 1 # Lanes of one run uploaded to DNAnexus concurrently,
+                         # while the next lane is being tarred.
+    COPY_STREAMS = 1 # Concurrent rsyncs per run dir, sharing one ssh connection.
+    COPY_CHECKSUM = False # True compares every file by checksum (rsync -c) on every copy.
+                          # False copies only files missing or differing in size or mtime.
+    COPY_VERIFY = True # After a copy, compare the files at COPY_DEST_HOST with the source by size and mtime.
+    COPY_VERIFY_SAMPLES = 0 # Blocks per file also hashed on both ends when verifying. 0 for none.
+    COPY_VERIFY_SAMPLE_KB = 64 # Size of each block hashed.
+    COPY_VERIFY_PYTHON = 'python' # Python on COPY_DEST_HOST, which lists the copy for verification.
+    COPY_VERIFY_MAX_REPORTED = 20 # Mismatched files listed in the copy complete email, per kind of mismatch.
     EMAIL_TO = None
     EMAIL_FROM = None
 
@@ -571,6 +811,8 @@ class Autocopy:
     COPY_DEST_GROUP = grp.getgrgid(pwd.getpwuid(os.getuid()).pw_gid).gr_name
     COPY_SOURCE_RUN_ROOTS = [os.getcwd()]
     COPY_DEST_RUN_ROOT = '~/copied_runs'
+    SSH_CONTROL_DIR = os.path.join(os.path.expanduser('~'), '.ssh', 'autocopy') # ssh ControlMaster sockets
+    SSH_CONTROL_PERSIST_SECONDS = 600 # Idle ssh connections to COPY_DEST_HOST are closed after this long
 
     # Powers of two constants
     ONEKILO = 1024.0
@@ -581,9 +823,14 @@ class Autocopy:
     MIN_FREE_SPACE = ONETERA * 2 # Warn when run_root space is below this value
 
     MAIN_LOOP_DELAY_SECONDS = 600
+    STATE_JOURNAL_FILE = None # Journal of in-flight copies, replayed on restart. None to disable.
+    RUNROOT_WATCH_MODE = RunRootWatcher.MODE_INOTIFY # 'inotify', 'poll', or 'off'
+    RUNROOT_POLL_SECONDS = 60 # mtime poll interval for run roots on network filesystems
     RUNROOT_FREESPACE_CHECK_DELAY_SECONDS = 3600
     RUNDIRS_MONITORED_SUMMARY_DELAY_SECONDS = 3600*24
-    SECONDS_BEFORE_COPY_RESTART = 3600*24
+    SECONDS_BEFORE_COPY_RESTART = 3600*24 # Copies whose progress can't be measured are restarted after this long
+    COPY_STALL_WINDOW_SECONDS = 3600 # Copies reading less than COPY_STALL_MIN_KB_PER_SECOND
+    COPY_STALL_MIN_KB_PER_SECOND = 1024 # on average over this long are restarted as stalled
 
     last_runroot_freespace_check = None
     last_rundirs_monitored_summary = None
@@ -597,7 +844,14 @@ class Autocopy:
                  test_mode_lims=False, config=None, errors_to_terminal=False):
 
         self.dnanexus = dnanexus        # Boolean flag
-        self.upload_mode = upload_mode  # ['API', 'UploadAgent']
+        self.upload_mode = upload_mode  # ['API', 'UploadAgent', 'Stream']
+
+        # Guards rundirs_monitored and the copy candidates of a pass when
+        # run dirs are processed by several workers.
+        self.rundirs_lock = threading.RLock()
+        # Serializes writes to the log and the SMTP connection.
+        self.log_lock = threading.RLock()
+        self.smtp_lock = threading.RLock()
 	self.release = release
         self.develop = develop
         
@@ -611,12 +865,20 @@ class Autocopy:
         self.initialize_no_copy_option(no_copy)
         print 'Initialize hostname'
         self.initialize_hostname()
+        print 'Initialize ssh connections'
+        self.initialize_ssh_connections()
         print 'Initialize LIMS connection'
         self.initialize_lims_connection(test_mode_lims, no_lims)
         print 'Initialize mail server'
         self.initialize_mail_server(no_email)
         print 'Initialize run roots'
         self.initialize_run_roots()
+        print 'Initialize monitored run dirs'
+        self.initialize_rundirs_monitored()
+        print 'Initialize copy scheduler'
+        self.initialize_copy_scheduler()
+        print 'Initialize run root watcher'
+        self.initialize_runroot_watcher()
         print 'Initialize signals'
         self.initialize_signals()
         print 'Redirect output to log'
@@ -625,6 +887,10 @@ class Autocopy:
 
 
     def cleanup(self):
+        try:
+            self.runroot_watcher.close()
+        except Exception as e:
+            print e
         try:
             self.restore_stdout_stderr()
         except Exception as e:
@@ -639,13 +905,15 @@ class Autocopy:
                 print e
                 self.send_email_autocopy_exception(e)
             self.log_sleep()
-            time.sleep(self.MAIN_LOOP_DELAY_SECONDS)
+            if self.runroot_watcher.wait(self.MAIN_LOOP_DELAY_SECONDS):
+                self.log_woken_by_runroot_change()
 
     def _main(self):
-        self.log_main_loop
+        self.log_main_loop()
         self.update_rundirs_monitored()
-        for rundir in self.rundirs_monitored:
-            self.process_rundir(rundir)
+        self.sample_copy_progress()
+        self.process_rundirs(list(self.rundirs_monitored))
+        self.start_scheduled_copies()
 
         if self.is_time_for_rundirs_monitored_summary():
             self.send_email_rundirs_monitored_summary()
@@ -653,12 +921,35 @@ class Autocopy:
         if self.is_time_for_runroot_freespace_check():
             self.check_runroot_freespace()
 
-    def copy_processes_counter(self):
-        count = 0
-        for rundir in self.rundirs_monitored:
-            if rundir.is_copying():
-                count += 1
-        return count
+    def process_rundirs(self, rundirs):
+        """
+        Function : Runs process_rundir on each run dir, using up to MAX_RUNDIR_WORKERS threads so that
+                   a slow LIMS lookup, disk usage check or copy start for one run doesn't hold up the rest.
+        Args     : rundirs - a list of rundir.RunDir objects
+        """
+        workers = min(self.MAX_RUNDIR_WORKERS, len(rundirs))
+        if workers <= 1:
+            for rundir in rundirs:
+                self.process_rundir_safely(rundir)
+            return
+
+        pool = ThreadPool(workers)
+        try:
+            result = pool.map_async(self.process_rundir_safely, rundirs, chunksize=1)
+            # Wait with a timeout so signals still reach the main thread.
+            while not result.ready():
+                result.wait(1)
+        finally:
+            pool.close()
+            pool.join()
+
+    def process_rundir_safely(self, rundir):
+        # One bad run shouldn't stop the others from being processed.
+        try:
+            self.process_rundir(rundir)
+        except Exception as e:
+            print e
+            self.send_email_rundir_exception(rundir, e)
 
     def process_rundir(self, rundir):
         """
@@ -723,33 +1014,90 @@ class Autocopy:
             return "not_ready"
 
     def process_ready_for_copy_rundir(self, rundir, lims_runinfo):
-        if self.copy_processes_counter() >= self.MAX_COPY_PROCESSES:
-            self.log_reached_copy_processes_max(rundir)
-            return
-
-        if not lims_runinfo:
-            self.send_email_run_not_found_in_lims(rundir.get_dir())
-        self.log_start_copy(rundir)
-        self.start_copy(rundir, dnanexus=self.dnanexus)
+        # The copy is started by start_scheduled_copies, once every run of
+        # the pass has been looked at and the ready runs can be ranked.
+        candidate = CopyCandidate(rundir.get_path(), rundir.get_disk_usage(),
+                                  priority=self.get_copy_priority(rundir, lims_runinfo),
+                                  item=(rundir, lims_runinfo))
+        with self.rundirs_lock:
+            self.copy_candidates.append(candidate)
         #if lims_runinfo:
         # Commented out for testing
             #lims_runinfo.set_flags_for_sequencing_finished_analysis_started()
 
+    def get_copy_priority(self, rundir, lims_runinfo):
+        """
+        Returns : The highest COPY_QUEUE_PRIORITIES value of the LIMS queues of the run's lanes,
+                  or 0.
+        """
+        if not lims_runinfo or not self.COPY_QUEUE_PRIORITIES:
+            return 0
+        priorities = [0]
+        for lane_index in range(1, (rundir.get_lanes() or 0) + 1):
+            try:
+                queue = lims_runinfo.get_lane(lane_index)['queue']
+            except Exception:
+                # Lane not in the LIMS
+                continue
+            priorities.append(self.COPY_QUEUE_PRIORITIES.get(str(queue), 0))
+        return max(priorities)
+
+    def start_scheduled_copies(self):
+        """
+        Function : Starts copying the ready runs of this pass, highest ranked first, as far as
+                   the copy scheduler admits them.
+        """
+        with self.rundirs_lock:
+            candidates = self.copy_candidates
+            self.copy_candidates = []
+            copying = [rundir for rundir in self.rundirs_monitored if rundir.is_copying()]
+        self.copy_scheduler.sample(len(copying), self.copy_read_bytes)
+        (start, postponed) = self.copy_scheduler.select(candidates, len(copying))
+        for candidate in start:
+            (rundir, lims_runinfo) = candidate.item
+            try:
+                if not lims_runinfo:
+                    self.send_email_run_not_found_in_lims(rundir.get_dir())
+                self.log_start_copy(rundir)
+                self.start_copy(rundir, dnanexus=self.dnanexus)
+            except Exception as e:
+                print e
+                self.send_email_rundir_exception(rundir, e)
+        for candidate in postponed:
+            (rundir, lims_runinfo) = candidate.item
+            self.log_copy_postponed(rundir, len(copying) + len(start))
+
     def process_copying_rundir(self, rundir, lims_runinfo):
         # Check if the copy process finished successfully
         retcode = rundir.copy_proc.poll()
-        if retcode == 0:
+        if retcode is not None and getattr(rundir.copy_proc, 'reattached', False):
+            # A copy started before autocopy restarted has ended, with an
+            # unknown exit status. Copy again to finish or confirm it.
+            self.log_reattached_copy_ended(rundir)
+            rundir.reset_to_copy_not_started()
+            self.journal_rundir(rundir, 'copy_reset')
+        elif retcode == 0:
             self.process_completed_rundir(rundir, lims_runinfo)
         elif retcode == None:
-            if rundir.seconds_since_copy_started() > self.SECONDS_BEFORE_COPY_RESTART:
+            if self.copy_progress.is_measured(rundir.get_path()):
+                # Only restart a copy that has stopped making progress.
+                if self.copy_progress.is_stalled(rundir.get_path()):
+                    rate = self.copy_progress.get_rate(rundir.get_path())
+                    self.log_copy_stalled(rundir, rate)
+                    self.restart_copy(rundir)
+                    self.send_email_copy_stalled(rundir.get_dir(), rate)
+            elif rundir.seconds_since_copy_started() > self.SECONDS_BEFORE_COPY_RESTART:
                 self.restart_copy(rundir)
                 self.send_email_copy_restarted(rundir.get_dir())
         else:
             self.process_failed_copy_rundir(rundir, retcode)
 
     def restart_copy(self, rundir):
+        # Only stops the copy. The run is then ready for copy again, so
+        # process_rundir queues it for start_scheduled_copies, which starts
+        # it from the main thread as far as the copy scheduler admits it.
         rundir.kill_copy_process()
-        self.start_copy(rundir, dnanexus=self.dnanexus)
+        self.journal_rundir(rundir, 'copy_reset')
 
     def process_failed_copy_rundir(self,rundir,retcode):
         """
@@ -760,31 +1108,32 @@ class Autocopy:
         # Revert status so copy can restart.
         if rundir:
             rundir.reset_to_copy_not_started()
+            self.journal_rundir(rundir, 'copy_reset')
 
     def process_completed_rundir(self, rundir, lims_runinfo):
         are_files_missing = self.are_files_missing(rundir)
+        copy_verification = self.verify_copy(rundir)
         lims_problems = self.check_rundir_against_lims(rundir, lims_runinfo)
         disk_usage = rundir.get_disk_usage()
         rundir.unset_copy_proc_and_set_stop_time()
-        self.send_email_rundir_copy_complete(rundir, are_files_missing, lims_problems, disk_usage)
+        self.journal_rundir(rundir, 'copy_completed', bytes=disk_usage,
+                            copy_end_time=time.mktime(rundir.copy_end_time.timetuple()))
+        self.send_email_rundir_copy_complete(rundir, are_files_missing, lims_problems, disk_usage, copy_verification)
         dest = os.path.join(rundir.get_root(),self.SUBDIR_COMPLETED,rundir.get_dir())
         try:
             os.renames(rundir.get_path(),dest)
         except OSError as e:
             raise OSError("Cant move run %s to %s. %s" % (rundir.get_dir(),dest,e.message))
-        self.create_copy_complete_sentinel_file(rundir)
-        self.rundirs_monitored.remove(rundir)
+        if not self.dnanexus:
+            # DNAnexus uploads have no COPY_DEST_HOST destination to mark.
+            self.create_copy_complete_sentinel_file(rundir)
+        self.forget_rundir(rundir)
 
     def create_copy_complete_sentinel_file(self, rundir):
         COPY_COMPLETED_SENTINEL_FILE = 'Autocopy_complete.txt'
         self.log_creating_copy_complete_sentinel_file(rundir, COPY_COMPLETED_SENTINEL_FILE)
-        touch_cmd_list = ['ssh', 
-                          '-l', self.COPY_DEST_USER,
-                          self.COPY_DEST_HOST,
-                          'touch', os.path.join(self.COPY_DEST_RUN_ROOT, rundir.get_dir(), COPY_COMPLETED_SENTINEL_FILE)
-        ]
-        subprocess.call(touch_cmd_list,
-                        stdout=self.LOG_FILE, stderr=self.LOG_FILE)
+        self.get_dest_ssh_connection().touch(os.path.join(self.COPY_DEST_RUN_ROOT, rundir.get_dir(), COPY_COMPLETED_SENTINEL_FILE),
+                                             stderr=self.LOG_FILE)
 
     def process_aborted_rundir(self,lims_runinfo,rundirObject=None,rundirPath=None):
         if rundirObject:
@@ -798,7 +1147,7 @@ class Autocopy:
         except OSError as e:
             raise OSError("Cant move run %s to %s. %s" % (rundirName,dest,e.message))
         if rundirObject:
-            self.rundirs_monitored.remove(rundirObject)
+            self.forget_rundir(rundirObject)
         # Commented out for testing
             # lims_runinfo.set_flags_for_sequencing_failed() #may not be a flow cell, which is where scgpm_lims makes the status flag updates.
         self.send_email_rundir_aborted(rundirPath=rundirPath,dest_path=dest)
@@ -837,11 +1186,41 @@ class Autocopy:
         hostname = socket.gethostname()
         self.HOSTNAME = hostname[0:hostname.find('.')] # Remove domain part.
 
+    def initialize_ssh_connections(self):
+        self.ssh_connections = SSHConnectionPool(control_dir=self.SSH_CONTROL_DIR,
+                                                 persist_seconds=self.SSH_CONTROL_PERSIST_SECONDS,
+                                                 log_file=self.LOG_FILE)
+        if self.MAX_COPY_PROCESSES and not self.dnanexus:
+            # Open the connection to the copy destination now, so a login
+            # problem shows in the log at startup.
+            if not self.get_dest_ssh_connection().is_alive():
+                self.log_ssh_connection_failed()
+
+    def get_dest_ssh_connection(self):
+        """
+        Returns : The shared ssh connection to COPY_DEST_HOST, reconnected if it went down.
+        """
+        return self.ssh_connections.get(self.COPY_DEST_HOST, self.COPY_DEST_USER)
+
     def initialize_lims_connection(self, is_test_mode, no_lims):
         if no_lims:
             self.LIMS = None
         else:
             self.LIMS = Connection(apiversion=self.LIMS_API_VERSION, local_only=is_test_mode, lims_url=self.UHTS_LIMS_URL, lims_token=self.UHTS_LIMS_TOKEN)
+        self.lims_cache = LimsCache(fetch=lambda run_name: RunInfo(conn=self.LIMS, run=run_name),
+                                    ttl_seconds=self.LIMS_CACHE_SECONDS,
+                                    threads=self.LIMS_PREFETCH_THREADS,
+                                    is_not_found=self.is_lims_not_found_error,
+                                    not_found_ttl_seconds=self.LIMS_NOT_FOUND_CACHE_SECONDS,
+                                    error_ttl_seconds=self.LIMS_ERROR_RETRY_SECONDS,
+                                    max_stale_seconds=self.LIMS_MAX_STALE_SECONDS,
+                                    max_entries=self.LIMS_CACHE_MAX_ENTRIES,
+                                    log=self.log)
+
+    def is_lims_not_found_error(self, error):
+        # A 404 means the run just hasn't been entered in the LIMS yet.
+        return (isinstance(error, requests.exceptions.HTTPError) and
+                error.response is not None and error.response.status_code == 404)
 
     def initialize_mail_server(self, no_email=None):
         if no_email is not None:
@@ -894,6 +1273,80 @@ class Autocopy:
         for run_root in self.COPY_SOURCE_RUN_ROOTS:
             self.create_run_root_on_disk(run_root)
 
+    def initialize_rundirs_monitored(self):
+        self.rundirs_monitored = []
+        self.rundirs_index = {}  # (run_root, dirname) -> rundir.RunDir
+        self.runroot_scans = {}  # run_root -> ((st_ino, st_mtime), [dirname, ...], time listed)
+        if not self.STATE_JOURNAL_FILE:
+            self.state_journal = None
+            return
+        # Pick up the runs, and any copies still running, from before a restart.
+        self.state_journal = StateJournal(self.STATE_JOURNAL_FILE)
+        for state in self.state_journal.get_runs():
+            self.restore_rundir(state)
+
+    def restore_rundir(self, state):
+        """
+        Function : Monitors a run dir recorded in the state journal again, reattaching to its
+                   copy process if that is still running. Runs that are gone are dropped from
+                   the journal, and their copy processes are stopped.
+        Args     : state - a run's state from StateJournal.get_runs().
+        """
+        (run_root, dirname) = (state['run_root'], state['dir'])
+        pid = state.get('pid')
+        copy_running = pid and is_process_running(pid, state.get('proc_start'))
+        if run_root not in self.COPY_SOURCE_RUN_ROOTS or not os.path.isdir(os.path.join(run_root, dirname)):
+            if copy_running:
+                self.log_stopping_orphaned_copy(os.path.join(run_root, dirname), pid)
+                ReattachedProcess(pid, state.get('proc_start')).kill()
+            self.state_journal.record(run_root, dirname, 'forgotten')
+            return
+        rundir = RunDir(run_root, dirname)
+        if copy_running:
+            rundir.copy_proc = ReattachedProcess(pid, state.get('proc_start'))
+            rundir.copy_start_time = datetime.datetime.fromtimestamp(state['copy_start_time'])
+            self.log_reattached_copy(rundir, pid)
+        elif pid:
+            # Finished while autocopy was stopped; its exit status is lost,
+            # so the next pass copies again to finish or confirm it.
+            self.log_copy_ended_while_stopped(rundir, pid)
+            self.journal_rundir(rundir, 'copy_reset')
+        self.rundirs_monitored.append(rundir)
+        self.rundirs_index[(run_root, dirname)] = rundir
+
+    def journal_rundir(self, rundir, event, **fields):
+        if self.state_journal:
+            self.state_journal.record(rundir.get_root(), rundir.get_dir(), event, **fields)
+
+    def journal_copy_started(self, rundir):
+        pid = rundir.copy_proc.pid
+        self.journal_rundir(rundir, 'copy_started', pid=pid, proc_start=get_process_start_time(pid),
+                            copy_start_time=time.mktime(rundir.copy_start_time.timetuple()))
+
+    def sample_copy_progress(self):
+        with self.rundirs_lock:
+            copies = dict((rundir.get_path(), rundir.copy_proc.pid) for rundir in self.rundirs_monitored
+                          if rundir.is_copying() and hasattr(rundir.copy_proc, 'pid'))
+        self.copy_read_bytes = self.copy_progress.sample(copies)
+
+    def initialize_copy_scheduler(self):
+        self.copy_progress = ProgressMonitor(window_seconds=self.COPY_STALL_WINDOW_SECONDS,
+                                             min_rate=self.COPY_STALL_MIN_KB_PER_SECOND * self.ONEKILO)
+        self.copy_read_bytes = {}  # run dir path -> bytes read by its copy, at the last sample
+        self.copy_candidates = []  # CopyCandidates of the current pass
+        self.copy_scheduler = CopyScheduler(self.MAX_COPY_PROCESSES,
+                                            bandwidth_budget=self.COPY_BANDWIDTH_BUDGET_MB * self.ONEMEG,
+                                            age_halving_seconds=self.COPY_AGE_HALVING_SECONDS,
+                                            log=lambda msg: self.log(msg + '\n'))
+
+    def initialize_runroot_watcher(self):
+        self.runroot_watcher = RunRootWatcher(self.COPY_SOURCE_RUN_ROOTS,
+                                              self.RUNDIR_REG,
+                                              RunDir.STATUS_FILES,
+                                              mode=self.RUNROOT_WATCH_MODE,
+                                              poll_seconds=self.RUNROOT_POLL_SECONDS,
+                                              log=self.log)
+
     def create_run_root_on_disk(self, run_root):
         # Create and prepare run root dirs if they do not exist
         if not os.path.exists(run_root):
@@ -914,40 +1367,73 @@ class Autocopy:
                 f.write('Runs in this directory are generally OK to delete.')
 
     def update_rundirs_monitored(self):
-        if not hasattr(self, 'rundirs_monitored'):
-            # Initialize this instance var once after startup
-            self.rundirs_monitored = []
+        runroot_dirnames = [(run_root, self.list_rundir_names(run_root)) for run_root in self.COPY_SOURCE_RUN_ROOTS]
+        # Look up every run of this pass in the LIMS up front and concurrently;
+        # the lookups in get_or_create_rundir and process_rundir then come
+        # from the cache.
+        self.prefetch_runinfo_from_lims([dirname for (run_root, dirnames) in runroot_dirnames for dirname in dirnames])
 
         new_rundirs_monitored = []
-        for run_root in self.COPY_SOURCE_RUN_ROOTS:
-            new_rundirs_monitored.extend(self.scan_for_rundirs(run_root))
+        for (run_root, dirnames) in runroot_dirnames:
+            new_rundirs_monitored.extend(self.scan_for_rundirs(run_root, dirnames))
 
-        # We just removed any rundirs we found on disk from rundirs_monitored.
-        # Any dirs left are what we couldn't find on disk.
-        # Send email warning and then forget them.
+        # Any RunDirs not found on disk this pass are forgotten here.
 #        for missing_rundir in self.rundirs_monitored:
 #            self.send_email_missing_rundir(missing_rundir)
+        for missing_rundir in set(self.rundirs_monitored) - set(new_rundirs_monitored):
+            self.journal_rundir(missing_rundir, 'forgotten')
         self.rundirs_monitored = new_rundirs_monitored
+        self.rundirs_index = dict(((rundir.get_root(), rundir.get_dir()), rundir) for rundir in new_rundirs_monitored)
 
-    def scan_for_rundirs(self, run_root):
+    def scan_for_rundirs(self, run_root, dirnames=None):
         """
-        Returns : A list of rundir.RunDir objects.
+        Function : Finds the run directories in run_root. The directory listing is only re-read
+                   when the run root's inode or mtime has changed since the last pass, and only
+                   entries not seen before are checked with os.path.isdir. RunDir objects already
+                   monitored are reused, so their parsed metadata and copy state carry over.
+        Args     : dirnames - the run directory names in run_root, if already listed.
+        Returns  : A list of rundir.RunDir objects.
         """
+        if dirnames is None:
+            dirnames = self.list_rundir_names(run_root)
         rundirs_found_on_disk = []
-        for dirname in os.listdir(run_root):
-            # Get directories, not files
-            if (os.path.isdir(os.path.join(run_root, dirname))) and self.RUNDIR_REG.match(dirname):
-                rundir = self.get_or_create_rundir(run_root, dirname, remove=True)
-                if rundir:
-                    rundirs_found_on_disk.append(rundir)
+        for dirname in dirnames:
+            rundir = self.get_or_create_rundir(run_root, dirname)
+            if rundir:
+                rundirs_found_on_disk.append(rundir)
         return rundirs_found_on_disk
 
-    def get_or_create_rundir(self, run_root, dirname, remove=False):
+    def list_rundir_names(self, run_root):
+        """
+        Returns : A list of the names of the run directories in run_root.
+        """
+        stats = os.stat(run_root)
+        scan_key = (stats.st_ino, stats.st_mtime)
+        previous_scan = self.runroot_scans.get(run_root)
+        # Don't trust a listing taken within a second of the mtime; with
+        # coarse mtimes a later change in that second would go unnoticed.
+        if previous_scan and previous_scan[0] == scan_key and previous_scan[2] - stats.st_mtime > 1:
+            return previous_scan[1]
+
+        if previous_scan:
+            known_dirnames = set(previous_scan[1])
+        else:
+            known_dirnames = set()
+        listed_at = time.time()
+        dirnames = []
+        for dirname in sorted(os.listdir(run_root)):
+            if not self.RUNDIR_REG.match(dirname):
+                continue
+            # Get directories, not files. Only new entries need checking.
+            if dirname in known_dirnames or os.path.isdir(os.path.join(run_root, dirname)):
+                dirnames.append(dirname)
+        self.runroot_scans[run_root] = (scan_key, dirnames, listed_at)
+        return dirnames
+
+    def get_or_create_rundir(self, run_root, dirname):
         rundirPath = os.path.join(run_root,dirname)
-        matching_rundir = self.get_rundir(run_root=run_root, dirname=dirname)
+        matching_rundir = self.rundirs_index.get((run_root, dirname))
         if matching_rundir:
-            if remove:
-                self.rundirs_monitored.remove(matching_rundir)
             return matching_rundir
         else:
             #Don't create a rundir object unless we know that in the LIMS it's not aborted or failed.
@@ -958,9 +1444,9 @@ class Autocopy:
             #Before creating the RunDir object, need to check UHTS to make sure it's not aborted or failed.
             #Note that the possible sequncing run statuses in UHTS are given in app/helpers/sequencing_run_status.rb in the RAILS app.
             try:
-        	print >> self.LOG_FILE, 'Getting LIMS RunInfo for %s\n' % dirname
-        	self.LOG_FILE.flush()                
-        	limsRunInfo = self.get_runinfo_from_lims(rundirName=dirname)
+                print >> self.LOG_FILE, 'Getting LIMS RunInfo for %s\n' % dirname
+                self.LOG_FILE.flush()
+                limsRunInfo = self.get_runinfo_from_lims(rundirName=dirname)
                 if limsRunInfo == None:
                     print("Run " + dirname + " not found in UHTS; perhaps it just wasn't entered in yet. Skipping.")
                     return None
@@ -979,13 +1465,58 @@ class Autocopy:
                 return None
             else:
                 rundir = RunDir(run_root, dirname)
+                self.rundirs_index[(run_root, dirname)] = rundir
+                self.journal_rundir(rundir, 'monitored')
                 return rundir
 
+    def forget_rundir(self, rundir):
+        """
+        Function : Stops monitoring rundir, e.g. after it has been moved out of its run root.
+        """
+        with self.rundirs_lock:
+            if rundir in self.rundirs_monitored:
+                self.rundirs_monitored.remove(rundir)
+            self.rundirs_index.pop((rundir.get_root(), rundir.get_dir()), None)
+        self.journal_rundir(rundir, 'forgotten')
+
     def are_files_missing(self, rundir):
         # Check that the run directory has all the right files.
         files_missing = not rundir_utils.validate(rundir)
         return files_missing
 
+    def verify_copy(self, rundir):
+        """
+        Function : Compares the copy of rundir at COPY_DEST_HOST with the source: the
+                   destination is listed with one ssh command, and its listing compared
+                   with a manifest of the source as it comes in.
+        Returns  : A copy_manifest.CopyVerification, or None if copies aren't verified.
+        """
+        if not self.COPY_VERIFY or self.dnanexus:
+            return None
+        start_time = time.time()
+        sample_bytes = int(self.COPY_VERIFY_SAMPLE_KB * self.ONEKILO)
+        source = copy_manifest.build_manifest(rundir.get_path(), exclude=('Thumbnail_Images',))
+        if self.COPY_VERIFY_SAMPLES:
+            copy_manifest.add_sample_hashes(rundir.get_path(), source, sample_bytes, self.COPY_VERIFY_SAMPLES)
+
+        dest_dir = os.path.join(self.COPY_DEST_RUN_ROOT, rundir.get_dir())
+        remote_cmd = copy_manifest.get_remote_manifest_command(dest_dir, sample_bytes, self.COPY_VERIFY_SAMPLES,
+                                                               python=self.COPY_VERIFY_PYTHON)
+        proc = self.get_dest_ssh_connection().popen(remote_cmd, stdin=subprocess.PIPE, stderr=self.LOG_FILE)
+        try:
+            proc.stdin.write(copy_manifest.REMOTE_MANIFEST_SCRIPT)
+            proc.stdin.close()
+        except IOError:
+            # ssh exited early; its exit code says why.
+            pass
+        verification = copy_manifest.verify_copy(source, proc.stdout)
+        retcode = proc.wait()
+        if retcode != 0:
+            verification.error = 'listing %s:%s exited with %d' % (self.COPY_DEST_HOST, dest_dir, retcode)
+        verification.seconds = time.time() - start_time
+        self.log_copy_verified(rundir, verification)
+        return verification
+
     def get_runinfo_from_lims(self, rundirObject=None,rundirName=None):
         """
         Returns : A scgpm_lims.components.models.RunInfo object
@@ -995,7 +1526,7 @@ class Autocopy:
         if not rundirName:
             rundirName = rundirObject.get_dir()
         try:
-            runinfo = RunInfo(conn=self.LIMS, run=rundirName)
+            runinfo = self.lims_cache.get(rundirName)
         except Exception as e:
             print >> self.LOG_FILE, 'Error when getting LIMS RunInfo: %s' % e
             self.LOG_FILE.flush()
@@ -1006,6 +1537,11 @@ class Autocopy:
             runinfo = None
         return runinfo
 
+    def prefetch_runinfo_from_lims(self, rundirNames):
+        if self.LIMS == None:
+            return
+        self.lims_cache.prefetch(rundirNames)
+
     def check_rundir_against_lims(self, rundir, runinfo, test_only_dummy_problem=None):
         # Testproblem is for testing only
         if runinfo == None:
@@ -1055,18 +1591,33 @@ class Autocopy:
                                              develop = self.develop,
                                              region = self.REGION,
                                              upload_agent = self.UPLOAD_AGENT,
-                                             ua_token = self.UA_TOKEN)
-            dnanexus_upload.run()
-            #lims_runinfo = self.get_runinfo_from_lims(rundirObject=rundir) 
-            #self.process_completed_rundir(rundir, lims_runinfo)
-            #except:
-            #lims_runinfo = self.get_runinfo_from_lims(rundirObject=rundir)
-            #self.process_aborted_rundir(lims_runinfo=lims_runinfo,rundirObject=rundir)
+                                             ua_token = self.UA_TOKEN,
+                                             max_lane_uploads = self.MAX_LANE_UPLOADS)
+            # Upload in the background; process_copying_rundir polls it
+            # like an rsync copy and completes the run when it exits 0.
+            upload_proc = CopyTaskProcess(dnanexus_upload, 'dnanexus_upload_%s' % rundir.get_dir())
+            rundir.set_copy_proc_and_start_time(upload_proc)
+            self.journal_copy_started(rundir)
+        elif self.COPY_STREAMS > 1 or not self.COPY_CHECKSUM:
+            self.log_start_parallel_copy(rundir)
+            parallel_rsync = ParallelRsync(rundir.get_path(),
+                                           self.get_dest_ssh_connection(),
+                                           self.COPY_DEST_RUN_ROOT,
+                                           ['-rlpt',
+                                            '--exclude=Thumbnail_Images/',
+                                            '--chmod=Dug=rwX,Do=rX,Fug=rw,Fo=r'],
+                                           max(1, self.COPY_STREAMS),
+                                           exclude=('Thumbnail_Images',),
+                                           checksum=self.COPY_CHECKSUM,
+                                           log_file=self.LOG_FILE)
+            copy_proc = CopyTaskProcess(parallel_rsync, 'parallel_rsync_%s' % rundir.get_dir())
+            rundir.set_copy_proc_and_start_time(copy_proc)
+            self.journal_copy_started(rundir)
         else:
             source = rundir.get_path().rstrip('/')
             dest = self.COPY_DEST_RUN_ROOT.rstrip('/')
             copy_cmd_list = ['rsync', '-rlptc', 
-                             '-e', 'ssh -l %s' % self.COPY_DEST_USER,
+                             '-e', self.get_dest_ssh_connection().get_ssh_command(),
                              '--exclude=Thumbnail_Images/', 
                              '--chmod=Dug=rwX,Do=rX,Fug=rw,Fo=r',
                              source,
@@ -1075,6 +1626,7 @@ class Autocopy:
             copy_proc = subprocess.Popen(copy_cmd_list,
                                          stdout=self.LOG_FILE, stderr=self.LOG_FILE)
             rundir.set_copy_proc_and_start_time(copy_proc)
+            self.journal_copy_started(rundir)
 
     def send_email_autocopy_exception(self, exception):
         tb = traceback.format_exc(exception)
@@ -1082,6 +1634,13 @@ class Autocopy:
         email_body = "The autocopy daemon failed with Exception\n" + tb
         self.send_email(self.EMAIL_TO, email_subj, email_body)
 
+    def send_email_rundir_exception(self, rundir, exception):
+        tb = traceback.format_exc()
+        email_subj = "Autocopy exception processing run %s" % rundir.get_dir()
+        email_body = "Autocopy failed with Exception while processing run %s\n" % rundir.get_dir()
+        email_body += "Other runs were processed as usual; this run will be retried on the next pass.\n\n" + tb
+        self.send_email(self.EMAIL_TO, email_subj, email_body)
+
     def send_email_autocopy_started(self):
         email_body = "The autocopy daemon failed with Exception\n" + tb
         self.send_email(self.EMAIL_TO, email_subj, email_body)
@@ -1119,16 +1678,12 @@ class Autocopy:
         email_body += "Return code:\t%d\n" % retcode
         self.send_email(self.EMAIL_TO, email_subj, email_body)
 
-    def send_email_rundir_copy_complete(self, rundir, are_files_missing, lims_problems, disk_usage):
+    def send_email_rundir_copy_complete(self, rundir, are_files_missing, lims_problems, disk_usage, copy_verification=None):
         rundirName = rundir.get_dir()
         rundirPath = rundir.get_path()
-        if disk_usage > self.ONEKILO:
-            disk_usage /= self.ONEKILO
-            disk_usage_units = "Tb"
-        else:
-            disk_usage_units = "Gb"
+        copy_differs = copy_verification is not None and not copy_verification.is_ok()
 
-        if are_files_missing or (len(lims_problems) > 0):
+        if are_files_missing or (len(lims_problems) > 0) or copy_differs:
             email_subj = "Problems found. Finished copying run dir %s" % rundirName
         else:
             email_subj = "Finished copying run dir %s" % rundirName
@@ -1138,6 +1693,9 @@ class Autocopy:
         if are_files_missing:
             email_body += "*** RUN HAS MISSING FILES ***\n\n"
 
+        if copy_differs:
+            email_body += "*** COPY DOES NOT MATCH THE RUN ***\n\n"
+
         if len(lims_problems) > 0:
             email_body = "%s: *** RUN HAS INCONSISTENCIES WITH LIMS\n\n" % rundirName
             email_body = "Check the problems below and correct any errors in the LIMS:\n\n"
@@ -1152,9 +1710,32 @@ class Autocopy:
         email_body += "Cycles:\t\t\t%s\n" % " ".join(map(lambda d: str(d), rundir.get_cycle_list()))
         email_body += "\n"
         email_body += "Copy time:\t\t%s\n" % str(rundir.copy_end_time - rundir.copy_start_time)
-        email_body += "Disk usage:\t\t%.1f %s\n" % (disk_usage, disk_usage_units)
+        email_body += "Disk usage:\t\t%.1f %s\n" % self.get_size_and_units(disk_usage)
+        for (subtree, subtree_usage) in sorted(rundir.get_disk_usage_by_subtree().items()):
+            if subtree_usage is not None:
+                email_body += "  %s:\t%.1f %s\n" % ((subtree,) + self.get_size_and_units(subtree_usage))
+        if copy_verification is not None:
+            email_body += "\n"
+            email_body += "Copy verification:\t%s\n" % copy_verification
+            for (problem, paths) in (("Missing at destination", copy_verification.missing),
+                                     ("Size or mtime differs", copy_verification.changed),
+                                     ("Content differs", copy_verification.corrupt)):
+                if paths:
+                    email_body += "%s:\n" % problem
+                    for path in paths[0:self.COPY_VERIFY_MAX_REPORTED]:
+                        email_body += "  %s\n" % path
+                    if len(paths) > self.COPY_VERIFY_MAX_REPORTED:
+                        email_body += "  [...%d more]\n" % (len(paths) - self.COPY_VERIFY_MAX_REPORTED)
         self.send_email(self.EMAIL_TO, email_subj, email_body)
 
+    def get_size_and_units(self, nbytes):
+        """
+        Returns : (size, units) of nbytes in Gb, or in Tb from one Tb up.
+        """
+        if nbytes >= self.ONETERA:
+            return (nbytes / self.ONETERA, "Tb")
+        return (nbytes / self.ONEGIG, "Gb")
+
     def send_email_missing_rundir(self, rundir):
         rundirName = rundir.get_dir()
         email_subj = "Missing Run Dir %s" % rundirName
@@ -1175,10 +1756,14 @@ class Autocopy:
         email_body = ''
         for run_root in self.COPY_SOURCE_RUN_ROOTS:
             email_body += '%s\n\n' % os.path.abspath(run_root)
+            used_bytes = 0
             for run_dir in self.get_rundirs(run_root=run_root):
                 status = self.get_rundir_status(run_dir)
-                email_body += "%s\t%s\n" % (run_dir.get_dir(), status)
+                run_dir_bytes = run_dir.get_disk_usage()
+                used_bytes += run_dir_bytes
+                email_body += "%s\t%s\t%0.1f GB\n" % (run_dir.get_dir(), status, run_dir_bytes/self.ONEGIG)
             email_body += "\n"
+            email_body += '\t%0.1f GB used by run dirs\n' % (used_bytes/self.ONEGIG)
             email_body += '\t%0.1f GB free\n\n' % (self.get_freespace(run_root)/self.ONEGIG)
         self.send_email(self.EMAIL_TO, email_subj, email_body)
         self.last_rundirs_monitored_summary = time.time()
@@ -1197,6 +1782,14 @@ class Autocopy:
         email_body += 'If you see this email again, you may need to troubleshoot.\n'
         self.send_email(self.EMAIL_TO, email_subj, email_body)
 
+    def send_email_copy_stalled(self, run_name, rate):
+        email_subj = 'Stalled copy restarted for run %s' % run_name
+        email_body = 'The copy process for run %s read %.1f KB/s on average over the last %d minutes,\n' % (run_name, rate / self.ONEKILO, self.COPY_STALL_WINDOW_SECONDS / 60)
+        email_body += 'below the minimum of %d KB/s, so autocopy killed and restarted it.\n' % self.COPY_STALL_MIN_KB_PER_SECOND
+        email_body += 'The copy should resume where it left off.\n'
+        email_body += 'If you see this email again, you may need to troubleshoot.\n'
+        self.send_email(self.EMAIL_TO, email_subj, email_body)
+
     def send_email(self, to, subj, body, write_email_to_log=True):
         body += "\nSent at %s\n" % time.strftime('%X %x %Z') 
         subj_prefix = "AUTOCOPY (%s): " % self.HOSTNAME
@@ -1210,16 +1803,18 @@ class Autocopy:
         if self.NO_EMAIL:
             self.log("email suppressed because --no_email is set")
         else:
-            try:
-                self.smtp.sendmail(msg['From'], to, msg.as_string())
-            except smtplib.SMTPServerDisconnected:
-                self.log_lost_smtp_connection()
-                self.initialize_mail_server()
-                self.smtp.sendmail(msg['From'], to, msg.as_string())
+            with self.smtp_lock:
+                try:
+                    self.smtp.sendmail(msg['From'], to, msg.as_string())
+                except smtplib.SMTPServerDisconnected:
+                    self.log_lost_smtp_connection()
+                    self.initialize_mail_server()
+                    self.smtp.sendmail(msg['From'], to, msg.as_string())
         if write_email_to_log:
-            self.log("v----------- begin email -----------v")
-            self.log(msg.as_string())
-            self.log("^------------ end email ------------^\n")
+            with self.log_lock:
+                self.log("v----------- begin email -----------v")
+                self.log(msg.as_string())
+                self.log("^------------ end email ------------^\n")
 
 
     def log_starting_autocopy_message(self):
@@ -1232,6 +1827,21 @@ class Autocopy:
     def log_sleep(self):
         self.log("Sleeping for %s seconds\n" % self.MAIN_LOOP_DELAY_SECONDS)
 
+    def log_woken_by_runroot_change(self):
+        self.log("Woken early by a change in a run root\n")
+
+    def log_reattached_copy(self, rundir, pid):
+        self.log("Reattached to copy process %d of run %s, started before restart\n" % (pid, rundir.get_dir()))
+
+    def log_copy_ended_while_stopped(self, rundir, pid):
+        self.log("Copy process %d of run %s ended while autocopy was stopped. Copying again.\n" % (pid, rundir.get_dir()))
+
+    def log_reattached_copy_ended(self, rundir):
+        self.log("Copy process of run %s, started before restart, has ended. Copying again.\n" % rundir.get_dir())
+
+    def log_stopping_orphaned_copy(self, rundir_path, pid):
+        self.log("Stopping copy process %d of %s, which is no longer in a run root\n" % (pid, rundir_path))
+
     def log_processing_dir(self, rundir):
         self.log("processing %s" % rundir.get_dir())
 
@@ -1239,7 +1849,16 @@ class Autocopy:
         self.log("Starting copy of run %s\n" % rundir.get_dir())
 
     def log_start_dnanexus_upload(self, rundir):
-        self.log("Startuing DNAnexus upload of run %s\n" % rundir.get_dir())
+        self.log("Starting DNAnexus upload of run %s\n" % rundir.get_dir())
+
+    def log_ssh_connection_failed(self):
+        self.log("Could not open an ssh connection to %s@%s. Copies will fail until it can be opened.\n" % (self.COPY_DEST_USER, self.COPY_DEST_HOST))
+
+    def log_start_parallel_copy(self, rundir):
+        if self.COPY_CHECKSUM:
+            self.log("Starting copy of run %s with %d rsync streams\n" % (rundir.get_dir(), self.COPY_STREAMS))
+        else:
+            self.log("Starting copy of changed files of run %s with %d rsync streams\n" % (rundir.get_dir(), self.COPY_STREAMS))
 
     def log_lims_error(self, error):
         self.log("Encountered an error accessing the LIMS: %s" % error.message)
@@ -1250,8 +1869,16 @@ class Autocopy:
     def log_lost_smtp_connection(self):
         self.log("Lost SMTP Connection. Attempting to reconnect.")
 
-    def log_reached_copy_processes_max(self, rundir):
-        self.log("Postponing copy of run %s because MAX_COPY_PROCESSES=%s has been reached\n" % (rundir.get_dir(), self.MAX_COPY_PROCESSES))
+    def log_copy_stalled(self, rundir, rate):
+        self.log("Copy of run %s is stalled, reading %.1f KB/s over the last %d s. Restarting it.\n" %
+                 (rundir.get_dir(), rate / self.ONEKILO, self.COPY_STALL_WINDOW_SECONDS))
+
+    def log_copy_verified(self, rundir, verification):
+        self.log("Verified copy of run %s at %s: %s\n" % (rundir.get_dir(), self.COPY_DEST_HOST, verification))
+
+    def log_copy_postponed(self, rundir, copies_running):
+        self.log("Postponing copy of run %s: %d copies running, limit %d (MAX_COPY_PROCESSES=%s)\n" %
+                 (rundir.get_dir(), copies_running, self.copy_scheduler.limit, self.MAX_COPY_PROCESSES))
     
     def log_creating_copy_complete_sentinel_file(self, rundir, filename):
         self.log("Creating copy complete file '%s' in destination folder of run %s" % (filename, rundir.get_dir()))
@@ -1262,9 +1889,10 @@ class Autocopy:
         else:
             log_text = ''
         log_lines = log_text.split("\n")
-        for line in log_lines:
-            print >> self.LOG_FILE, "[%s] %s" % (datetime.datetime.now().strftime("%Y %b %d %H:%M:%S"), line)
-        self.LOG_FILE.flush()
+        with self.log_lock:
+            for line in log_lines:
+                print >> self.LOG_FILE, "[%s] %s" % (datetime.datetime.now().strftime("%Y %b %d %H:%M:%S"), line)
+            self.LOG_FILE.flush()
 
     def initialize_config(self, config):
         if config is None:
@@ -1292,9 +1920,18 @@ class Autocopy:
         def validate_int(key, value):
             if not isinstance(value, int):
                 raise ValidationError("Invalid value %s for config key %s. An integer is required." %(value, key))
+        def validate_dict(key, value):
+            if not isinstance(value, dict):
+                raise ValidationError("Invalid value %s for config key %s. An object is required." %(value, key))
         def validate_list(key, value):
             if not isinstance(value, list):
                 raise ValidationError("Invalid value %s for config key %s. A list is required." %(value, key))
+        def validate_bool(key, value):
+            if not isinstance(value, bool):
+                raise ValidationError("Invalid value %s for config key %s. true or false is required." %(value, key))
+        def validate_runroot_watch_mode(key, value):
+            if value not in RunRootWatcher.MODES:
+                raise ValidationError("Invalid value %s for config key %s. Must be one of %s" %(value, key, RunRootWatcher.MODES))
 
         def validate(key, value, config_fields):
             if key not in config_fields.keys():
@@ -1308,14 +1945,40 @@ class Autocopy:
             'SUBDIR_COMPLETED': validate_str,
             'SUBDIR_ABORTED': validate_str,
             'LIMS_API_VERSION': validate_str,
+            'LIMS_CACHE_SECONDS': validate_int,
+            'LIMS_NOT_FOUND_CACHE_SECONDS': validate_int,
+            'LIMS_ERROR_RETRY_SECONDS': validate_int,
+            'LIMS_MAX_STALE_SECONDS': validate_int,
+            'LIMS_CACHE_MAX_ENTRIES': validate_int,
+            'LIMS_PREFETCH_THREADS': validate_int,
             'MAX_COPY_PROCESSES': validate_int,
+            'COPY_BANDWIDTH_BUDGET_MB': validate_int,
+            'COPY_QUEUE_PRIORITIES': validate_dict,
+            'COPY_AGE_HALVING_SECONDS': validate_int,
+            'SECONDS_BEFORE_COPY_RESTART': validate_int,
+            'COPY_STALL_WINDOW_SECONDS': validate_int,
+            'COPY_STALL_MIN_KB_PER_SECOND': validate_int,
+            'MAX_RUNDIR_WORKERS': validate_int,
+            'MAX_LANE_UPLOADS': validate_int,
+            'COPY_STREAMS': validate_int,
+            'COPY_CHECKSUM': validate_bool,
+            'COPY_VERIFY': validate_bool,
+            'COPY_VERIFY_SAMPLES': validate_int,
+            'COPY_VERIFY_SAMPLE_KB': validate_int,
+            'COPY_VERIFY_PYTHON': validate_cmdline_safe_str,
+            'COPY_VERIFY_MAX_REPORTED': validate_int,
             'EMAIL_TO': validate_str,
             'EMAIL_FROM': validate_str,
             'COPY_SOURCE_RUN_ROOTS': validate_list,
             'COPY_SOURCE_RUN_TARS': validate_str,
             'COPY_DEST_RUN_ROOT': validate_cmdline_safe_str,
+            'SSH_CONTROL_DIR': validate_cmdline_safe_str,
+            'SSH_CONTROL_PERSIST_SECONDS': validate_int,
             'MIN_FREE_SPACE': validate_int,
             'MAIN_LOOP_DELAY_SECONDS': validate_int,
+            'STATE_JOURNAL_FILE': validate_str,
+            'RUNROOT_WATCH_MODE': validate_runroot_watch_mode,
+            'RUNROOT_POLL_SECONDS': validate_int,
             'RUNROOT_FREESPACE_CHECK_DELAY_SECONDS': validate_int,
             'RUNDIRS_MONITORED_SUMMARY_DELAY_SECONDS': validate_int,
             'UHTS_LIMS_URL': validate_str,
@@ -1378,6 +2041,8 @@ class Autocopy:
         """
         Function : Does the same as self.get_rundirs, but raises an Exception if more than one rundir.RunDir object is retrieved.
         """
+        if run_root is not None and dirname is not None:
+            return self.rundirs_index.get((run_root, dirname))
         rundirs = self.get_rundirs(run_root=run_root, dirname=dirname)
         if len(rundirs) == 0:
             return None
@@ -1433,7 +2098,7 @@ class Autocopy:
                           help="Upload runs to DNAnexus instead of SCG")
         parser.add_option("-u", "--upload_mode", dest="upload_mode",
                           default='UploadAgent', help="Specify how to upload files to DNAnexus", 
-                          choices=['API', 'UploadAgent'])
+                          choices=['API', 'UploadAgent', 'Stream'])
 	parser.add_option("-r", "--release", dest="release", action="store_true", default=False,
 			  help='Specify whether to automatically release DNAnexus projects to user')
         parser.add_option("-v", "--develop", dest="develop", action="store_true", default=False,
@@ -0,0 +1,302 @@
+#!/usr/bin/env python
+
+###############################################################################
+#
+# checksum.py - Checksum archives as they are written, with several hashes
+#   in one read, and keep the results in a sidecar file next to them.
+#
+# make_archive_tar used to run md5sum over each .tgz after writing it, and
+# lane tars for DNAnexus weren't checksummed at all: checksumming a
+# terabyte-scale archive that way reads it all a second time. A
+# MultiHasher is instead fed the archive's data while it's written (see
+# tar_writer.write_tar() and rundir_utils.make_archive_tar()), or, for a
+# file already written, read once in CHUNK_SIZE chunks (a multiple of the
+# page size).
+#
+# MD5 is always computed, as that's what md5sum users and DNAnexus expect;
+# a faster hash (xxh3_64 when the xxhash module is installed, or BLAKE2b
+# when hashlib has it) is computed alongside for later local checks. Each
+# hash after the first runs in its own thread, fed through a short queue:
+# hashlib and xxhash release the GIL while hashing a chunk, so the hashes
+# run on separate cores and together take about as long as MD5 alone.
+#
+# When a part size is given, the MD5 of each part of that size is kept
+# too. DNAnexus reports an MD5 per uploaded part, not for the whole file,
+# so an upload made in parts of the same size can be checked against them
+# (see match_parts()).
+#
+# The sidecar (the archive's path + CHECKSUMS_SUFFIX) is tab separated
+# lines of name and value:
+#
+#   size       1073741824
+#   md5        9e107d9d372bb6826bd81d3542a419d6
+#   xxh3_64    d4a1185009ebb0e0
+#   part_size  67108864
+#   part       1   6d0a...
+#
+###############################################################################
+
+import os
+import hashlib
+import threading
+import Queue
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+CHUNK_SIZE = 8 * 1024 * 1024
+QUEUE_CHUNKS = 4                # Chunks queued per hash thread before update() waits
+CHECKSUMS_SUFFIX = '.checksums'
+FAST_HASHES = ('xxh3_64', 'xxh64', 'blake2b')   # In order of preference
+
+def is_hash_available(hash_name):
+    if hash_name.startswith('xxh'):
+        return xxhash is not None and hasattr(xxhash, hash_name)
+    try:
+        hashlib.new(hash_name)
+    except ValueError:
+        return False
+    return True
+
+def new_hash(hash_name):
+    if hash_name.startswith('xxh'):
+        return getattr(xxhash, hash_name)()
+    return hashlib.new(hash_name)
+
+def get_default_hashes():
+    """
+    Returns : ['md5'], followed by the first of FAST_HASHES available.
+    """
+    for hash_name in FAST_HASHES:
+        if is_hash_available(hash_name):
+            return ['md5', hash_name]
+    return ['md5']
+
+class Checksums:
+    """
+    The size and hashes of one file.
+    """
+
+    def __init__(self, size=0, hexdigests=None, part_size=None, part_md5s=None):
+        self.size = size
+        self.hexdigests = hexdigests or {}  # hash name -> hex digest
+        self.part_size = part_size
+        self.part_md5s = part_md5s or []    # MD5 of each part_size part, in order
+
+    def get_md5(self):
+        return self.hexdigests.get('md5')
+
+    def __eq__(self, other):
+        return (isinstance(other, Checksums) and self.size == other.size and
+                self.hexdigests == other.hexdigests and
+                self.part_size == other.part_size and self.part_md5s == other.part_md5s)
+
+    def __ne__(self, other):
+        return not self == other
+
+class PartHasher:
+    # MD5s of consecutive part_size parts of the data.
+
+    def __init__(self, part_size):
+        self.part_size = part_size
+        self.part_md5s = []
+        self.current = hashlib.md5()
+        self.current_size = 0
+
+    def update(self, data):
+        start = 0
+        while start < len(data):
+            take = min(len(data) - start, self.part_size - self.current_size)
+            self.current.update(data[start:start + take] if take < len(data) else data)
+            self.current_size += take
+            start += take
+            if self.current_size == self.part_size:
+                self.end_part()
+
+    def end_part(self):
+        self.part_md5s.append(self.current.hexdigest())
+        self.current = hashlib.md5()
+        self.current_size = 0
+
+    def hexdigest(self):
+        if self.current_size or not self.part_md5s:
+            self.end_part()
+        return self.part_md5s
+
+class HashThread(threading.Thread):
+    # Feeds the chunks put on its queue to one hash.
+
+    def __init__(self, digest):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.digest = digest
+        self.queue = Queue.Queue(maxsize=QUEUE_CHUNKS)
+
+    def run(self):
+        while True:
+            data = self.queue.get()
+            if data is None:
+                return
+            self.digest.update(data)
+
+class MultiHasher:
+    """
+    Computes several hashes of the same data, each hash after the first in its own
+    thread. Feed it with update(), then call finish() once.
+    """
+
+    def __init__(self, hash_names=None, part_size=None):
+        """
+        Args : hash_names - list of hash names, as taken by new_hash(); default from
+                   get_default_hashes().
+               part_size - if given, the MD5 of each part of this many bytes is kept too.
+        """
+        self.hash_names = list(hash_names or get_default_hashes())
+        self.part_size = part_size
+        self.size = 0
+        self.digests = [new_hash(hash_name) for hash_name in self.hash_names]
+        if part_size:
+            self.digests.append(PartHasher(part_size))
+        self.threads = [HashThread(digest) for digest in self.digests[1:]]
+        for thread in self.threads:
+            thread.start()
+
+    def update(self, data):
+        if not data:
+            return
+        for thread in self.threads:
+            thread.queue.put(data)
+        self.digests[0].update(data)
+        self.size += len(data)
+
+    def finish(self):
+        """
+        Returns : The Checksums of the data.
+        """
+        for thread in self.threads:
+            thread.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        checksums = Checksums(self.size, part_size=self.part_size)
+        for (hash_name, digest) in zip(self.hash_names, self.digests):
+            checksums.hexdigests[hash_name] = digest.hexdigest()
+        if self.part_size:
+            checksums.part_md5s = self.digests[-1].hexdigest()
+        return checksums
+
+class HashingWriter:
+    """
+    A file-like object that writes to out, a file object, and feeds what's written
+    to hasher, a MultiHasher.
+    """
+
+    def __init__(self, out, hasher):
+        self.out = out
+        self.hasher = hasher
+
+    def write(self, data):
+        self.out.write(data)
+        self.hasher.update(data)
+
+    def flush(self):
+        self.out.flush()
+
+def checksum_file(path, hash_names=None, part_size=None, chunk_size=CHUNK_SIZE):
+    """
+    Function : Checksums a file in one read.
+    Args     : As for MultiHasher.
+    Returns  : The Checksums of the file.
+    """
+    hasher = MultiHasher(hash_names, part_size)
+    try:
+        with open(path, 'rb') as f:
+            while True:
+                data = f.read(chunk_size)
+                if not data:
+                    break
+                hasher.update(data)
+    finally:
+        checksums = hasher.finish()
+    return checksums
+
+def get_checksums_path(path):
+    return path + CHECKSUMS_SUFFIX
+
+def format_checksums(checksums):
+    lines = ['size\t%d\n' % checksums.size]
+    for hash_name in sorted(checksums.hexdigests, key=lambda name: (name != 'md5', name)):
+        lines.append('%s\t%s\n' % (hash_name, checksums.hexdigests[hash_name]))
+    if checksums.part_size:
+        lines.append('part_size\t%d\n' % checksums.part_size)
+        for (index, md5) in enumerate(checksums.part_md5s, 1):
+            lines.append('part\t%d\t%s\n' % (index, md5))
+    return ''.join(lines)
+
+def parse_checksums(text):
+    """
+    Returns : The Checksums in text, as written by format_checksums(), or None if text
+              isn't complete.
+    """
+    checksums = Checksums(size=None)
+    for line in text.splitlines():
+        fields = line.split('\t')
+        if fields[0] == 'size' and len(fields) == 2:
+            checksums.size = int(fields[1])
+        elif fields[0] == 'part_size' and len(fields) == 2:
+            checksums.part_size = int(fields[1])
+        elif fields[0] == 'part' and len(fields) == 3:
+            if int(fields[1]) != len(checksums.part_md5s) + 1:
+                return None
+            checksums.part_md5s.append(fields[2])
+        elif len(fields) == 2:
+            checksums.hexdigests[fields[0]] = fields[1]
+        else:
+            return None
+    if checksums.size is None or 'md5' not in checksums.hexdigests:
+        return None
+    return checksums
+
+def write_checksums(path, checksums):
+    """
+    Function : Writes the sidecar of the file at path, through a temporary file.
+    """
+    checksums_path = get_checksums_path(path)
+    tmp_path = '%s.tmp%d' % (checksums_path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        f.write(format_checksums(checksums))
+    os.rename(tmp_path, checksums_path)
+
+def read_checksums(path):
+    """
+    Returns : The Checksums from the sidecar of the file at path, or None if it has
+              none, or its size doesn't match the file's.
+    """
+    try:
+        with open(get_checksums_path(path)) as f:
+            checksums = parse_checksums(f.read())
+    except IOError:
+        return None
+    if checksums is None or checksums.size != os.path.getsize(path):
+        return None
+    return checksums
+
+def match_parts(checksums, parts):
+    """
+    Function : Compares checksums with the parts of an uploaded file, as in the 'parts'
+               field of a DNAnexus file description.
+    Args     : checksums - the Checksums of the local file.
+               parts - dict of part index (a string, from 1) -> dict with 'size' and 'md5'.
+    Returns  : True if the parts match, False if they don't, or None if they can't be
+               compared, because the file was uploaded in parts of a different size.
+    """
+    indexes = sorted(parts, key=int)
+    sizes = [parts[index]['size'] for index in indexes]
+    if sum(sizes) != checksums.size:
+        return False
+    if len(indexes) == 1:
+        return parts[indexes[0]]['md5'] == checksums.get_md5()
+    if not checksums.part_size or any(size != checksums.part_size for size in sizes[:-1]):
+        return None
+    return [parts[index]['md5'] for index in indexes] == checksums.part_md5s
@@ -0,0 +1,274 @@
+#!/usr/bin/env python
+
+###############################################################################
+#
+# copy_manifest.py - File manifests of a run directory and its copy, to find
+#   which files still need copying without reading them.
+#
+# rsync -c reads and checksums every file on both ends each time a copy
+# starts, so restarting an interrupted copy of a finished run costs as much
+# as the first copy. Instead, the source is listed once into a manifest of
+# size and mtime per file, the destination's manifest is listed with a
+# single `find` over ssh, and only the files that are missing or differ are
+# handed to rsync. Since rsync -t gives copied files the source's mtime, a
+# file that matches in size and mtime (to the second) is taken as copied.
+# Nothing is hashed to plan a copy: hashing the destination's files to
+# compare with would read the whole copy on every start, as rsync -c does.
+#
+# Manifests are dicts of path relative to the run directory -> FileEntry.
+# Listed as text, they are tab separated lines of path, size, mtime and
+# hash ('-' if none).
+#
+# After a copy, verify_copy() checks what landed at the destination. The
+# destination is listed by REMOTE_MANIFEST_SCRIPT, run with one ssh
+# command, in the same line format, and each line is compared with the
+# source manifest as it arrives. Optionally a few blocks of each file
+# (see get_sample_ranges()) are hashed on both ends, to catch files that
+# have the right size and mtime but not the right content, without reading
+# the whole run again.
+#
+###############################################################################
+
+import os
+import stat
+import hashlib
+from multiprocessing.pool import ThreadPool
+
+import tar_writer
+
+HASH_THREADS = 4
+READ_SIZE = 4 * 1024 * 1024
+SAMPLE_BYTES = 64 * 1024
+
+class FileEntry:
+
+    __slots__ = ('size', 'mtime', 'hash')
+
+    def __init__(self, size, mtime, hash=None):
+        self.size = size
+        self.mtime = mtime
+        self.hash = hash
+
+    def matches(self, other):
+        # Whole seconds, as not every filesystem or rsync keeps sub-second mtimes.
+        return self.size == other.size and int(self.mtime) == int(other.mtime)
+
+def is_excluded(rel_path, exclude):
+    return any(part in exclude for part in rel_path.split(os.sep))
+
+def build_manifest(root, exclude=(), threads=tar_writer.WALK_THREADS):
+    """
+    Function : Lists the regular files under root.
+    Args     : root - the run directory.
+               exclude - file and directory names to leave out, at any depth.
+               threads - number of directories listed at once.
+    Returns  : A manifest dict, without hashes.
+    """
+    members = sorted(name for name in os.listdir(root) if name not in exclude)
+    (entries, missing) = tar_writer.walk(root, members, threads=threads)
+    manifest = {}
+    for (rel_path, st) in entries:
+        if stat.S_ISREG(st.st_mode) and not is_excluded(rel_path, exclude):
+            manifest[rel_path] = FileEntry(st.st_size, st.st_mtime)
+    return manifest
+
+def parse_manifest_line(line):
+    """
+    Returns : (path, FileEntry) of a manifest line, or None if the line was cut short.
+    """
+    fields = line.rstrip('\n').split('\t')
+    if len(fields) != 4:
+        return None
+    (rel_path, size, mtime, digest) = fields
+    return (rel_path, FileEntry(int(size), float(mtime), None if digest == '-' else digest))
+
+def get_find_command(dest_dir):
+    """
+    Returns : A shell command that lists the files under dest_dir, in the format
+              parse_find_output reads, and lists nothing if dest_dir doesn't exist.
+    """
+    return "if [ -d %s ]; then find %s -type f -printf '%%P\\t%%s\\t%%T@\\n'; fi" % (dest_dir, dest_dir)
+
+def parse_find_output(output):
+    """
+    Returns : A manifest, without hashes, of the output of the get_find_command command.
+    """
+    manifest = {}
+    for line in output.splitlines():
+        fields = line.split('\t')
+        if len(fields) != 3:
+            continue
+        (rel_path, size, mtime) = fields
+        manifest[rel_path] = FileEntry(int(size), float(mtime))
+    return manifest
+
+def diff_manifests(source, dest):
+    """
+    Returns : A sorted list of the paths in source that are missing from dest, or differ
+              in size or mtime.
+    """
+    return sorted(rel_path for (rel_path, entry) in source.iteritems()
+                  if rel_path not in dest or not entry.matches(dest[rel_path]))
+
+def get_sample_ranges(size, sample_bytes, samples):
+    """
+    Returns : A list of (offset, length) of the blocks of a file of size bytes hashed for
+              verification: samples blocks of sample_bytes spread evenly from the start of
+              the file to its end, or the whole file if it's no bigger than that.
+              Must match sample_ranges() in REMOTE_MANIFEST_SCRIPT.
+    """
+    if samples < 2 or size <= sample_bytes * samples:
+        return [(0, size)]
+    return [((size - sample_bytes) * i // (samples - 1), sample_bytes) for i in range(samples)]
+
+def sample_hash_file(path, size, sample_bytes, samples):
+    """
+    Returns : The MD5 hex digest of the sampled blocks of the file at path, or None if it
+              can't be read.
+    """
+    digest = hashlib.md5()
+    try:
+        with open(path, 'rb') as f:
+            for (offset, length) in get_sample_ranges(size, sample_bytes, samples):
+                f.seek(offset)
+                while length > 0:
+                    data = f.read(min(length, READ_SIZE))
+                    if not data:
+                        break
+                    digest.update(data)
+                    length -= len(data)
+    except IOError:
+        return None
+    return digest.hexdigest()
+
+def add_sample_hashes(root, manifest, sample_bytes, samples, threads=HASH_THREADS):
+    """
+    Function : Sets the hash of each entry of manifest, a manifest of root, to its sampled hash.
+    """
+    rel_paths = sorted(manifest)
+    pool = ThreadPool(processes=max(1, threads))
+    try:
+        hashes = pool.map(lambda rel_path: sample_hash_file(os.path.join(root, rel_path), manifest[rel_path].size,
+                                                            sample_bytes, samples), rel_paths)
+    finally:
+        pool.close()
+        pool.join()
+    for (rel_path, digest) in zip(rel_paths, hashes):
+        manifest[rel_path].hash = digest
+
+#
+# Run on the destination host as `python - <dir> <sample bytes> <samples>`,
+#  with this script on stdin. Prints a manifest line for each file under
+#  <dir>, with its sampled hash if <samples> isn't 0, and nothing if <dir>
+#  doesn't exist. Kept to what Python 2.6 and 3 both have.
+#
+REMOTE_MANIFEST_SCRIPT = """
+import os, sys, stat, hashlib
+root = sys.argv[1]
+sample_bytes = int(sys.argv[2])
+samples = int(sys.argv[3])
+
+def sample_ranges(size):
+    if samples < 2 or size <= sample_bytes * samples:
+        return [(0, size)]
+    return [((size - sample_bytes) * i // (samples - 1), sample_bytes) for i in range(samples)]
+
+def sample_hash(path, size):
+    digest = hashlib.md5()
+    try:
+        f = open(path, 'rb')
+        try:
+            for (offset, length) in sample_ranges(size):
+                f.seek(offset)
+                while length > 0:
+                    data = f.read(min(length, 4194304))
+                    if not data:
+                        break
+                    digest.update(data)
+                    length -= len(data)
+        finally:
+            f.close()
+    except IOError:
+        return '-'
+    return digest.hexdigest()
+
+out = sys.stdout
+for (dirpath, dirnames, filenames) in os.walk(root):
+    for name in filenames:
+        path = os.path.join(dirpath, name)
+        try:
+            st = os.lstat(path)
+        except OSError:
+            continue
+        if not stat.S_ISREG(st.st_mode):
+            continue
+        if samples:
+            digest = sample_hash(path, st.st_size)
+        else:
+            digest = '-'
+        out.write('%s\\t%d\\t%.9f\\t%s\\n' % (os.path.relpath(path, root), st.st_size, st.st_mtime, digest))
+"""
+
+def get_remote_manifest_command(dest_dir, sample_bytes=SAMPLE_BYTES, samples=0, python='python'):
+    """
+    Returns : The command, as a list of words, that runs REMOTE_MANIFEST_SCRIPT given on its
+              standard input.
+    """
+    return [python, '-', dest_dir, str(sample_bytes), str(samples)]
+
+class CopyVerification:
+    """
+    The differences between a source manifest and the files found at the destination.
+    """
+
+    def __init__(self):
+        self.files = 0          # files in the source manifest
+        self.bytes = 0
+        self.missing = []       # paths not at the destination
+        self.changed = []       # paths whose size or mtime differ at the destination
+        self.corrupt = []       # paths whose sampled content differs at the destination
+        self.extra = 0          # files at the destination that aren't in the source
+        self.seconds = 0.0
+        self.error = None       # why the destination couldn't be listed, if it couldn't
+
+    def is_ok(self):
+        return self.error is None and not (self.missing or self.changed or self.corrupt)
+
+    def __str__(self):
+        if self.error is not None:
+            return 'not verified: %s' % self.error
+        return ('%d files, %d bytes in %.1f s: %d missing, %d changed, %d corrupt, %d extra at destination' %
+                (self.files, self.bytes, self.seconds, len(self.missing), len(self.changed),
+                 len(self.corrupt), self.extra))
+
+def verify_copy(source, dest_lines):
+    """
+    Function : Compares a source manifest with the destination's files, reading each
+               destination manifest line only once, as it comes.
+    Args     : source - manifest of the source; entries with a hash are compared by hash too.
+               dest_lines - iterable of manifest lines of the destination, e.g. the output
+                            of REMOTE_MANIFEST_SCRIPT.
+    Returns  : A CopyVerification, with the paths in each list sorted.
+    """
+    verification = CopyVerification()
+    verification.files = len(source)
+    verification.bytes = sum(entry.size for entry in source.itervalues())
+    unseen = set(source)
+    for line in dest_lines:
+        parsed = parse_manifest_line(line)
+        if parsed is None:
+            continue
+        (rel_path, dest_entry) = parsed
+        entry = source.get(rel_path)
+        if entry is None:
+            verification.extra += 1
+            continue
+        unseen.discard(rel_path)
+        if not entry.matches(dest_entry):
+            verification.changed.append(rel_path)
+        elif entry.hash and dest_entry.hash and entry.hash != dest_entry.hash:
+            verification.corrupt.append(rel_path)
+    verification.missing = sorted(unseen)
+    verification.changed.sort()
+    verification.corrupt.sort()
+    return verification
@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+
+###############################################################################
+#
+# copy_progress.py - Measure how fast each copy is going, to tell a copy
+#   that is slowly working through a large run from one that is stuck.
+#
+# A copy's progress is the data read by its processes (rsync, tar, the
+# upload child and whatever they start), from the rchar counters in
+# /proc/<pid>/io. This covers every kind of copy without parsing its output,
+# and counts both disk reads and data sent. ssh processes are left out, as
+# they only pass on what rsync has read. Processes come and go during a copy
+# (one rsync per shard), so each process's counter is followed separately
+# and only its increases are added to the copy's total.
+#
+# Each sample() of the copies in progress is kept for window_seconds. A copy
+# observed for a whole window that read less than min_rate bytes per second
+# over it is stalled. Where /proc isn't available progress can't be
+# measured, and is_measured() says so.
+#
+###############################################################################
+
+import os
+import time
+from collections import deque
+
+UNCOUNTED_COMMANDS = ('ssh',)
+
+def read_process_table():
+    """
+    Returns : A dict of pid -> (parent pid, command name, bytes read) of the processes
+              this user can see in /proc. Empty if there is no /proc.
+    """
+    table = {}
+    try:
+        pids = [int(name) for name in os.listdir('/proc') if name.isdigit()]
+    except OSError:
+        return table
+    for pid in pids:
+        try:
+            with open('/proc/%d/stat' % pid) as f:
+                stat = f.read()
+            with open('/proc/%d/io' % pid) as f:
+                io = f.read()
+        except IOError:
+            # Exited, or another user's
+            continue
+        comm = stat[stat.index('(') + 1:stat.rindex(')')]
+        ppid = int(stat[stat.rindex(')') + 2:].split()[1])
+        rchar = 0
+        for line in io.splitlines():
+            if line.startswith('rchar:'):
+                rchar = int(line.split()[1])
+        table[pid] = (ppid, comm, rchar)
+    return table
+
+def get_tree_read_bytes(table, pid):
+    """
+    Returns : A dict of pid -> bytes read so far, of process pid and its descendants,
+              leaving out UNCOUNTED_COMMANDS, or None if pid isn't in table.
+    """
+    if pid not in table:
+        return None
+    children = {}
+    for (child, (ppid, comm, rchar)) in table.iteritems():
+        children.setdefault(ppid, []).append(child)
+    read_bytes = {}
+    stack = [pid]
+    while stack:
+        current = stack.pop()
+        (ppid, comm, rchar) = table[current]
+        if comm not in UNCOUNTED_COMMANDS:
+            read_bytes[current] = rchar
+        stack.extend(children.get(current, []))
+    return read_bytes
+
+class CopyProgress:
+    """
+    The progress of one copy process.
+    """
+
+    def __init__(self, pid):
+        self.pid = pid
+        self.bytes = 0            # read by the copy's processes since it was first sampled
+        self.last_read = None     # pid -> bytes read, at the last sample
+        self.samples = deque()    # (time, self.bytes), oldest first
+
+    def add_sample(self, now, read_bytes, window_seconds):
+        if self.last_read is not None:
+            for (pid, count) in read_bytes.iteritems():
+                # A process started since the last sample read all of its count since.
+                self.bytes += max(0, count - self.last_read.get(pid, 0))
+        self.last_read = read_bytes
+        self.samples.append((now, self.bytes))
+        # Keep one sample older than the window, so the window is spanned.
+        while len(self.samples) > 2 and self.samples[1][0] <= now - window_seconds:
+            self.samples.popleft()
+
+    def get_rate(self, window_seconds):
+        """
+        Returns : Bytes read per second over the last window_seconds, or None if the copy
+                  hasn't been sampled over that long.
+        """
+        if len(self.samples) < 2:
+            return None
+        (first_time, first_bytes) = self.samples[0]
+        (last_time, last_bytes) = self.samples[-1]
+        if last_time - first_time < window_seconds:
+            return None
+        return (last_bytes - first_bytes) / float(last_time - first_time)
+
+class ProgressMonitor:
+
+    def __init__(self, window_seconds=3600, min_rate=1024*1024):
+        """
+        Args : window_seconds - how long a copy must go below min_rate to be stalled.
+               min_rate - bytes per second a copy must read, on average over the window.
+        """
+        self.window_seconds = window_seconds
+        self.min_rate = min_rate
+        self.progress = {}  # copy key -> CopyProgress
+
+    def sample(self, copies):
+        """
+        Function : Records the progress of the copies running now, forgetting the others.
+        Args     : copies - dict of copy key (e.g. the run dir path) -> pid of the copy process.
+        Returns  : A dict of copy key -> total bytes read by the copy so far, for the copies
+                   that could be measured.
+        """
+        now = time.time()
+        table = read_process_table()
+        totals = {}
+        for key in self.progress.keys():
+            if key not in copies:
+                del self.progress[key]
+        for (key, pid) in copies.iteritems():
+            read_bytes = get_tree_read_bytes(table, pid)
+            if read_bytes is None:
+                self.progress.pop(key, None)
+                continue
+            progress = self.progress.get(key)
+            if progress is None or progress.pid != pid:
+                # New, or restarted as a new process
+                progress = self.progress[key] = CopyProgress(pid)
+            progress.add_sample(now, read_bytes, self.window_seconds)
+            totals[key] = progress.bytes
+        return totals
+
+    def is_measured(self, key):
+        return key in self.progress
+
+    def get_rate(self, key):
+        """
+        Returns : The copy's read rate in bytes per second over the window, or None if it
+                  hasn't been measured over a whole window.
+        """
+        progress = self.progress.get(key)
+        if progress is None:
+            return None
+        return progress.get_rate(self.window_seconds)
+
+    def is_stalled(self, key):
+        rate = self.get_rate(key)
+        return rate is not None and rate < self.min_rate
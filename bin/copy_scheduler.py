@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+
+###############################################################################
+#
+# copy_scheduler.py - Decide which ready runs to start copying, and how many
+#   copies to run at once.
+#
+# Runs ready for copy are ranked by:
+#   1. priority, from the LIMS sequencing queue of their lanes, highest first;
+#   2. size, smallest first, so a MiSeq run doesn't wait hours behind a HiSeq
+#      run. The size counts for less the longer a run has been waiting (it's
+#      halved after age_halving_seconds, a third after twice that, and so on),
+#      so large runs aren't starved.
+#
+# Copies are admitted up to a concurrency limit between 1 and max_copies,
+# which follows the measured throughput of the copies: if running one more
+# copy didn't raise the total throughput by at least MIN_GAIN, the link or
+# the disks are saturated and the limit comes down; while it did, the limit
+# goes up. With a bandwidth budget, no copy is started while the copies
+# already running use the budget, or would with one more.
+#
+# Throughput is the rate at which the copies' processes read data, as
+# measured by copy_progress.ProgressMonitor, so it covers both network and
+# disk. Where it can't be measured, the limit stays at max_copies.
+#
+###############################################################################
+
+import time
+
+MIN_GAIN = 0.1              # One more copy must add this fraction of throughput to be worth it
+MIN_SAMPLE_SECONDS = 60     # Throughput isn't measured over shorter intervals than this
+SMOOTHING = 0.5             # Weight of the newest sample in the throughput averages
+
+class CopyCandidate:
+    """
+    A run ready for copy.
+    """
+
+    def __init__(self, key, bytes, priority=0, item=None):
+        self.key = key            # identifies the run between passes, e.g. its path
+        self.bytes = bytes
+        self.priority = priority
+        self.item = item          # anything the caller wants back from select()
+        self.waiting_seconds = 0
+
+class CopyScheduler:
+
+    def __init__(self, max_copies, bandwidth_budget=0, age_halving_seconds=6*3600, log=None):
+        """
+        Args : max_copies - most copies ever run at once.
+               bandwidth_budget - bytes per second the copies may use together; 0 for no limit.
+               age_halving_seconds - how long a run must wait for its size to count half.
+               log - optional function taking a string, used for log messages.
+        """
+        self.max_copies = max_copies
+        self.bandwidth_budget = bandwidth_budget
+        self.age_halving_seconds = age_halving_seconds
+        self.log = log or (lambda msg: None)
+        self.limit = max_copies
+        self.ready_since = {}           # candidate key -> time first seen ready
+        self.read_bytes = {}            # copy key -> bytes read by the copy, at the last sample
+        self.last_sample_time = None
+        self.throughput = None          # bytes per second of all copies at the last sample
+        self.throughput_by_copies = {}  # number of copies running -> smoothed throughput
+
+    def sample(self, running, read_bytes):
+        """
+        Function : Measures the throughput of the copies running now, and adapts the
+                   concurrency limit to it.
+        Args     : running - number of copies running now.
+                   read_bytes - dict of copy key -> bytes read by the copy so far, from
+                                ProgressMonitor.sample().
+        """
+        now = time.time()
+        if self.last_sample_time is not None and now - self.last_sample_time < MIN_SAMPLE_SECONDS:
+            return
+        # Only measure while the same copies ran since the last sample; a
+        # copy that started or ended in between would skew the rate.
+        if (self.last_sample_time is not None and read_bytes and
+            len(read_bytes) == running and set(read_bytes) == set(self.read_bytes)):
+            seconds = now - self.last_sample_time
+            self.throughput = sum(max(0, read_bytes[key] - self.read_bytes[key]) for key in read_bytes) / seconds
+            self.adapt(len(read_bytes), self.throughput)
+        elif not running:
+            self.throughput = 0
+        self.read_bytes = read_bytes
+        self.last_sample_time = now
+
+    def adapt(self, running, throughput):
+        previous = self.throughput_by_copies.get(running)
+        if previous is not None:
+            throughput = SMOOTHING * throughput + (1 - SMOOTHING) * previous
+        self.throughput_by_copies[running] = throughput
+        fewer = self.throughput_by_copies.get(running - 1)
+        old_limit = self.limit
+        if fewer is not None and throughput < fewer * (1 + MIN_GAIN):
+            self.limit = max(1, running - 1)
+        elif running >= self.limit:
+            self.limit = min(self.max_copies, running + 1)
+        if self.limit != old_limit:
+            self.log('Copy concurrency limit %d -> %d: %d copies at %.1f MB/s, %s MB/s with one fewer' %
+                     (old_limit, self.limit, running, throughput / 1e6,
+                      'unknown' if fewer is None else '%.1f' % (fewer / 1e6)))
+
+    def rank(self, candidates):
+        """
+        Returns : candidates in the order they should be copied.
+        """
+        now = time.time()
+        for candidate in candidates:
+            candidate.waiting_seconds = now - self.ready_since.setdefault(candidate.key, now)
+        def weighted_size(candidate):
+            return candidate.bytes / (1.0 + candidate.waiting_seconds / float(self.age_halving_seconds))
+        return sorted(candidates, key=lambda candidate: (-candidate.priority, weighted_size(candidate)))
+
+    def select(self, candidates, running):
+        """
+        Function : Picks the candidates to start copying now.
+        Args     : candidates - list of CopyCandidates ready for copy.
+                   running - number of copies running now.
+        Returns  : (start, postponed), two lists of CopyCandidates, each in rank order.
+        """
+        ranked = self.rank(candidates)
+        # Forget runs that have started copying or are gone.
+        keys = set(candidate.key for candidate in candidates)
+        for key in self.ready_since.keys():
+            if key not in keys:
+                del self.ready_since[key]
+
+        slots = max(0, min(self.limit, self.max_copies) - running)
+        if self.bandwidth_budget and self.throughput is not None and running:
+            # Leave room for each new copy to run as fast as the current ones.
+            per_copy = self.throughput / running
+            if per_copy > 0:
+                spare = self.bandwidth_budget - self.throughput
+                slots = min(slots, max(0, int(spare / per_copy)))
+        return (ranked[:slots], ranked[slots:])
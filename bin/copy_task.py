@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+
+###############################################################################
+#
+# copy_task.py - Run a copy task (a DNAnexusUpload or a ParallelRsync) in
+#   a background process that autocopy manages like an rsync process.
+#
+# The task runs in a forked child that leads its own process group, so
+# kill() stops it together with any tar, Upload Agent or rsync processes
+# it started. The child is forked with os.fork() rather than as a
+# multiprocessing.Process: multiprocessing joins its children when the
+# parent exits, so stopping autocopy would wait for every copy in flight,
+# hours for a HiSeq upload. Forked this way the copy outlives autocopy,
+# which journals its pid (see state_journal.py) and reattaches to it on
+# restart.
+#
+###############################################################################
+
+import os
+import sys
+import errno
+import signal
+import traceback
+
+class CopyTaskProcess:
+    """
+    Runs a copy task's run() in a background child process. Provides the pid, poll(),
+    wait() and kill() of subprocess.Popen so it can be stored in RunDir.copy_proc.
+    Start it from the main thread: a fork while other threads hold locks could leave
+    the child waiting on them forever.
+    """
+
+    def __init__(self, task, name):
+        self.task = task
+        self.name = name
+        self.returncode = None
+        # Don't leave buffered output for the child to write a second time.
+        for f in (sys.stdout, sys.stderr):
+            f.flush()
+        self.pid = os.fork()
+        if self.pid == 0:
+            self._run()
+        try:
+            # Also done in the child; whichever runs first, kill() can count
+            # on the group from here on.
+            os.setpgid(self.pid, self.pid)
+        except OSError:
+            pass
+
+    def _run(self):
+        # Runs in the child, and never returns. Don't inherit the daemon's
+        # signal handlers (they send emails and exit 0) or run its exit
+        # handlers.
+        returncode = 1
+        try:
+            os.setpgid(0, 0)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGUSR1, signal.SIG_DFL)
+            # Any sys.exit() from DNAnexusUpload means the upload failed.
+            # ParallelRsync.run() returns the exit code of the rsync that failed.
+            returncode = get_exit_code(self.task.run())
+        except SystemExit, e:
+            returncode = get_exit_code(e.code)
+        except:
+            traceback.print_exc()
+        finally:
+            try:
+                sys.stdout.flush()
+                sys.stderr.flush()
+            finally:
+                os._exit(returncode)
+
+    def poll(self):
+        if self.returncode is None:
+            self.wait(os.WNOHANG)
+        return self.returncode
+
+    def wait(self, options=0):
+        if self.returncode is not None:
+            return self.returncode
+        while True:
+            try:
+                (pid, status) = os.waitpid(self.pid, options)
+                break
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno == errno.ECHILD:
+                    # Reaped elsewhere; the exit status is lost.
+                    self.returncode = 1
+                return self.returncode
+        if pid == self.pid:
+            if os.WIFSIGNALED(status):
+                self.returncode = -os.WTERMSIG(status)
+            else:
+                self.returncode = os.WEXITSTATUS(status)
+        return self.returncode
+
+    def kill(self):
+        if self.poll() is not None:
+            return
+        try:
+            os.killpg(self.pid, signal.SIGTERM)
+        except OSError:
+            pass
+
+def get_exit_code(code):
+    # As sys.exit() does: None is success, a message is failure.
+    if code is None:
+        return 0
+    if isinstance(code, (int, long)):
+        return code & 0xff
+    return 1
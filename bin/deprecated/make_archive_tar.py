@@ -74,6 +74,15 @@ parser.add_option("-c", "--cif", dest="cif", action="store_true",
 parser.add_option("-s", "--ssh_socket", dest="ssh_socket", type="string",
                   default=None,
                   help="SSH Control Master socket to run all ssh commands through")
+parser.add_option("-z", "--compression", dest="compression", type="choice",
+                  choices=["gzip", "zstd"], default="gzip",
+                  help='Compress the tar with gzip (.tgz) or zstd (.tar.zst) [default = gzip]')
+parser.add_option("-l", "--compressLevel", dest="compressLevel", type="int",
+                  default=None,
+                  help='Compression level [default = 6 for gzip, 3 for zstd]')
+parser.add_option("-t", "--compressThreads", dest="compressThreads", type="int",
+                  default=None,
+                  help='Threads to compress with [default = one per core]')
 
 
 (opts, args) = parser.parse_args()
@@ -90,7 +99,8 @@ for arg in args:
 
     if rundir_utils.make_archive_tar(rundir, destDir=opts.destDir, verbose=opts.verbose, debug=opts.debug,
                                      fileCheck=not opts.skipFileCheck, deleteAfter=opts.deleteAfter,
-                                     cif=opts.cif, sshSocket=opts.ssh_socket):
+                                     cif=opts.cif, sshSocket=opts.ssh_socket, compression=opts.compression,
+                                     compressLevel=opts.compressLevel, compressThreads=opts.compressThreads):
         print >> sys.stderr, "make_archive_tar.py: %s failed" % rundir.get_dir()
         error_rundirs += 1
 
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+
+###############################################################################
+#
+# disk_usage.py - Measure the disk usage of a run directory in-process,
+#   instead of forking `du -s`.
+#
+# Directories are listed in parallel, one level of the tree at a time. What
+# each directory listing found is cached under the directory's path and
+# reused while the directory's mtime stays the same, so measuring the same
+# run again only costs one stat per directory. As with the run root
+# listings, a directory listed within a second of its mtime is listed again
+# next time, since a change in that second would not move the mtime.
+#
+# Sizes are allocated bytes (st_blocks * 512, as du reports), with hard
+# linked files counted once. Files rewritten in place without adding or
+# removing directory entries don't change their directory's mtime, so the
+# cache is only meant for run directories whose files are written once,
+# which sequencer output is.
+#
+###############################################################################
+
+import os
+import stat
+import time
+from multiprocessing.pool import ThreadPool
+
+WALK_THREADS = 8
+MTIME_GRACE_SECONDS = 1
+
+class DiskUsage:
+    """
+    Disk usage of a directory tree, in bytes.
+    """
+
+    def __init__(self, path, total, subtrees):
+        self.path = path
+        self.bytes = total
+        self.subtrees = subtrees  # relative subtree path -> bytes, or None if it doesn't exist
+
+class DirListing:
+
+    __slots__ = ('mtime', 'listed_at', 'bytes', 'linked', 'subdirs')
+
+    def __init__(self, mtime, listed_at, bytes, linked, subdirs):
+        self.mtime = mtime
+        self.listed_at = listed_at
+        self.bytes = bytes        # the directory itself plus its singly linked files
+        self.linked = linked      # ((st_dev, st_ino), bytes) of hard linked files
+        self.subdirs = subdirs    # names of subdirectories
+
+def list_dir(path, cached):
+    """
+    Returns : A DirListing for path, cached if path hasn't changed since it was made,
+              or None if path can't be read.
+    """
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return None
+    if (cached is not None and cached.mtime == st.st_mtime and
+        cached.listed_at - st.st_mtime > MTIME_GRACE_SECONDS):
+        return cached
+    listed_at = time.time()
+    try:
+        names = os.listdir(path)
+    except OSError:
+        return None
+    total = st.st_blocks * 512
+    linked = []
+    subdirs = []
+    for name in names:
+        try:
+            child = os.lstat(os.path.join(path, name))
+        except OSError:
+            # Removed since it was listed
+            continue
+        if stat.S_ISDIR(child.st_mode):
+            subdirs.append(name)
+        elif child.st_nlink > 1 and not stat.S_ISLNK(child.st_mode):
+            linked.append(((child.st_dev, child.st_ino), child.st_blocks * 512))
+        else:
+            total += child.st_blocks * 512
+    return DirListing(st.st_mtime, listed_at, total, linked, subdirs)
+
+def get_disk_usage(path, subtrees=(), cache=None, threads=WALK_THREADS):
+    """
+    Function : Measures the disk usage of the tree at path.
+    Args     : path - directory to measure.
+               subtrees - paths relative to path to also report separately.
+               cache - dict kept by the caller between calls, to skip unchanged directories.
+               threads - number of directories to list at once.
+    Returns  : A DiskUsage.
+    """
+    if cache is None:
+        cache = {}
+    listings = {}
+    levels = []
+    level = [path]
+    pool = ThreadPool(processes=max(1, threads))
+    try:
+        while level:
+            levels.append(level)
+            next_level = []
+            results = pool.map(lambda dir_path: list_dir(dir_path, cache.get(dir_path)), level)
+            for (dir_path, listing) in zip(level, results):
+                if listing is None:
+                    continue
+                listings[dir_path] = listing
+                next_level.extend(os.path.join(dir_path, name) for name in listing.subdirs)
+            level = next_level
+    finally:
+        pool.close()
+        pool.join()
+
+    # Keep the listings of this tree for next time, dropping directories
+    # that are gone.
+    prefix = os.path.join(path, '')
+    for dir_path in cache.keys():
+        if (dir_path == path or dir_path.startswith(prefix)) and dir_path not in listings:
+            del cache[dir_path]
+    cache.update(listings)
+
+    # Add up from the deepest level, counting each hard linked file once.
+    totals = {}
+    seen = set()
+    for level in reversed(levels):
+        for dir_path in level:
+            listing = listings.get(dir_path)
+            if listing is None:
+                continue
+            total = listing.bytes
+            for (key, size) in listing.linked:
+                if key not in seen:
+                    seen.add(key)
+                    total += size
+            for name in listing.subdirs:
+                total += totals.get(os.path.join(dir_path, name), 0)
+            totals[dir_path] = total
+
+    subtree_totals = dict((subtree, totals.get(os.path.join(path, subtree))) for subtree in subtrees)
+    return DiskUsage(path, totals.get(path, 0), subtree_totals)
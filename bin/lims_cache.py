@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+
+###############################################################################
+#
+# lims_cache.py - Short-lived cache of LIMS RunInfo lookups.
+#
+# Autocopy looks up the LIMS RunInfo of each run directory at several steps
+# of a pass. Each pass starts by prefetching the RunInfo of every run
+# directory found, with the lookups spread over a small thread pool, and
+# later steps of the pass read the cached results. Entries expire after
+# ttl_seconds, so each pass still sees current LIMS data, in keeping with
+# autocopy's rule of querying the LIMS, using the answer and forgetting it.
+#
+# Failed lookups are cached too, and raise the same exception again when
+# read, so callers handle a 404 from the cache just as they did before:
+#   - Runs not in the LIMS yet (is_not_found) are cached for
+#     not_found_ttl_seconds, so a new run isn't looked up on every pass.
+#   - Other errors (LIMS down or slow) are cached for error_ttl_seconds.
+#     If the run was found before, its last RunInfo keeps being served for
+#     up to max_stale_seconds instead, so autocopy carries on without the
+#     LIMS as its guidelines ask.
+# A found entry that has expired but is within max_stale_seconds is returned
+# at once by get() while it is looked up again in the background
+# (stale-while-revalidate).
+#
+# The cache holds at most max_entries runs, dropping the least recently
+# used.
+#
+###############################################################################
+
+import threading
+import time
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+
+class CacheEntry:
+
+    def __init__(self, value, error, fetched_at, expires_at, stale_until):
+        self.value = value
+        self.error = error
+        self.fetched_at = fetched_at    # when value or error was looked up
+        self.expires_at = expires_at    # fresh until
+        self.stale_until = stale_until  # value may be served, while being refreshed, until
+
+class LimsCache:
+
+    def __init__(self, fetch, ttl_seconds=300, threads=8, is_not_found=None,
+                 not_found_ttl_seconds=600, error_ttl_seconds=60, max_stale_seconds=3600,
+                 max_entries=1000, log=None):
+        """
+        Args : fetch - function taking a run name and returning its RunInfo. It may raise.
+               ttl_seconds - how long a found RunInfo is reused.
+               threads - number of concurrent lookups when prefetching.
+               is_not_found - function taking an exception raised by fetch, returning True
+                              if it means the run is not in the LIMS.
+               not_found_ttl_seconds - how long a not found result is reused.
+               error_ttl_seconds - how long other errors are reused before retrying.
+               max_stale_seconds - how long past ttl_seconds a found RunInfo may still be
+                                   served while the LIMS can't be reached.
+               max_entries - most runs kept in the cache.
+               log - optional function taking a string, used for log messages.
+        """
+        self.fetch = fetch
+        self.ttl_seconds = ttl_seconds
+        self.threads = threads
+        self.is_not_found = is_not_found or (lambda error: False)
+        self.not_found_ttl_seconds = not_found_ttl_seconds
+        self.error_ttl_seconds = error_ttl_seconds
+        self.max_stale_seconds = max_stale_seconds
+        self.max_entries = max_entries
+        self.log = log or (lambda msg: None)
+        self.entries = OrderedDict()  # run name -> CacheEntry, least recently used first
+        self.refreshing = set()       # run names being looked up in the background
+        self.lock = threading.Lock()
+
+    def get(self, run_name):
+        """
+        Returns : The RunInfo of run_name, from the cache while it is fresh, or stale while
+                  it is refreshed. Raises the lookup's exception if it failed.
+        """
+        now = time.time()
+        entry = self.get_entry(run_name)
+        if entry is None or now >= entry.stale_until:
+            entry = self.load(run_name)
+        elif now >= entry.expires_at:
+            self.refresh_in_background(run_name)
+        if entry.error is not None:
+            raise entry.error
+        return entry.value
+
+    def prefetch(self, run_names):
+        """
+        Function : Looks up every run in run_names that has no fresh cache entry, concurrently.
+                   Errors are stored in the cache, for get() to raise.
+        """
+        now = time.time()
+        stale = []
+        for run_name in set(run_names):
+            entry = self.get_entry(run_name)
+            if entry is None or now >= entry.expires_at:
+                stale.append(run_name)
+        if not stale:
+            return
+        if len(stale) == 1 or self.threads <= 1:
+            map(self.load, stale)
+            return
+        pool = ThreadPool(processes=min(self.threads, len(stale)))
+        try:
+            pool.map(self.load, stale)
+        finally:
+            pool.close()
+            pool.join()
+
+    def invalidate(self, run_name):
+        with self.lock:
+            self.entries.pop(run_name, None)
+
+    def get_entry(self, run_name):
+        with self.lock:
+            entry = self.entries.pop(run_name, None)
+            if entry is not None:
+                # Most recently used goes last
+                self.entries[run_name] = entry
+        return entry
+
+    def refresh_in_background(self, run_name):
+        with self.lock:
+            if run_name in self.refreshing:
+                return
+            self.refreshing.add(run_name)
+        thread = threading.Thread(target=self.load, args=(run_name,), name='lims_refresh_%s' % run_name)
+        thread.daemon = True
+        thread.start()
+
+    def load(self, run_name):
+        """
+        Function : Looks up run_name and stores the result.
+        Returns  : The new CacheEntry, or the previous one if the LIMS couldn't be reached
+                   and the previous RunInfo may still be served.
+        """
+        now = time.time()
+        try:
+            value = self.fetch(run_name)
+            entry = CacheEntry(value, None, now, now + self.ttl_seconds,
+                               now + self.ttl_seconds + self.max_stale_seconds)
+        except Exception as e:
+            if self.is_not_found(e):
+                entry = CacheEntry(None, e, now, now + self.not_found_ttl_seconds,
+                                   now + self.not_found_ttl_seconds)
+            else:
+                entry = self.get_entry(run_name)
+                if entry is not None and entry.error is None and now < entry.stale_until:
+                    self.log('LIMS lookup of %s failed (%s); using RunInfo from %d seconds ago' %
+                             (run_name, e, now - entry.fetched_at))
+                    # Don't try again until error_ttl_seconds have passed.
+                    entry.expires_at = min(now + self.error_ttl_seconds, entry.stale_until)
+                else:
+                    entry = CacheEntry(None, e, now, now + self.error_ttl_seconds,
+                                       now + self.error_ttl_seconds)
+        with self.lock:
+            self.entries.pop(run_name, None)
+            self.entries[run_name] = entry
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+            self.refreshing.discard(run_name)
+        return entry
@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+
+###############################################################################
+#
+# parallel_rsync.py - Copy one run directory with several concurrent rsyncs.
+#
+# A single rsync over ssh moves data through one TCP stream and checksums
+# with one thread, well below what the link to the cluster can carry. Here
+# the run directory is split into shards of about equal size, and each shard
+# is copied by its own rsync (given the shard's paths with --files-from).
+# The rsyncs share one ssh connection through an ssh ControlMaster (see
+# ssh_connection.py), so none of them pays for an ssh handshake.
+#
+# Shards are made from the run's top level entries, splitting the largest
+# directories into their contents until there are enough pieces to balance,
+# so on a HiSeq run the lane directories of BaseCalls and Intensities each
+# end up as a piece, with InterOp and the top level files as others. The
+# pieces are then dealt out to the streams, largest first, each to the
+# stream with the least data so far.
+#
+# Without checksum, shards are instead planned from manifests (see
+# copy_manifest.py): only the files missing from the destination, or
+# differing in size or mtime, are dealt out to the streams, by size. A
+# restarted copy then only moves what the interrupted one didn't.
+#
+# Once every shard has copied, a final rsync of the whole run directory
+# without --checksum reconciles the copy: it picks up files written since
+# the shards were planned, symlinks, and the modes and times of the
+# directories, comparing the rest by size and mtime only.
+#
+###############################################################################
+
+import os
+import stat
+import time
+import tempfile
+import subprocess
+from multiprocessing.pool import ThreadPool
+
+import disk_usage
+import copy_manifest
+
+SHARD_PIECES_PER_STREAM = 4  # Split directories until there are this many pieces per stream
+MAX_SPLIT_DEPTH = 4           # Don't split directories deeper than this, e.g. Data/Intensities/BaseCalls/L001
+
+def get_piece_size(source, rel_path, st, cache):
+    if stat.S_ISDIR(st.st_mode):
+        return disk_usage.get_disk_usage(os.path.join(source, rel_path), cache=cache).bytes
+    return st.st_blocks * 512
+
+def list_pieces(source, rel_dir, exclude, cache):
+    """
+    Returns : A list of (relative path, is a directory, bytes) of the entries of rel_dir,
+              leaving out names in exclude.
+    """
+    pieces = []
+    for name in sorted(os.listdir(os.path.join(source, rel_dir))):
+        if name in exclude:
+            continue
+        rel_path = os.path.join(rel_dir, name)
+        try:
+            st = os.lstat(os.path.join(source, rel_path))
+        except OSError:
+            # Removed since it was listed
+            continue
+        pieces.append((rel_path, stat.S_ISDIR(st.st_mode), get_piece_size(source, rel_path, st, cache)))
+    return pieces
+
+def plan_shards(source, streams, exclude=(), pieces_per_stream=SHARD_PIECES_PER_STREAM,
+                max_split_depth=MAX_SPLIT_DEPTH):
+    """
+    Function : Splits the tree at source into at most streams shards of about equal size.
+    Args     : source - directory to split.
+               streams - number of shards wanted.
+               exclude - file and directory names to leave out, at any depth split.
+               pieces_per_stream - directories are split until there are this many pieces
+                                   per shard, or nothing more can be split.
+               max_split_depth - directories deeper than this are kept whole.
+    Returns  : A list of (paths, bytes), where paths are relative to source, largest shard
+               first. Empty shards are left out.
+    """
+    cache = {}
+    pieces = list_pieces(source, '', exclude, cache)
+    empty_dirs = set()
+    while len(pieces) < streams * pieces_per_stream:
+        splittable = [piece for piece in pieces
+                      if piece[1] and piece[0] not in empty_dirs and
+                      piece[0].count(os.sep) + 1 < max_split_depth]
+        if not splittable:
+            break
+        largest = max(splittable, key=lambda piece: piece[2])
+        children = list_pieces(source, largest[0], exclude, cache)
+        if not children:
+            # Keep an empty directory as a piece, so it's still created on
+            # the destination.
+            empty_dirs.add(largest[0])
+            continue
+        pieces.remove(largest)
+        pieces.extend(children)
+    return balance_shards([(rel_path, size) for (rel_path, is_dir, size) in pieces], streams)
+
+def balance_shards(pieces, streams):
+    """
+    Function : Deals pieces out to streams shards, largest first, each to the shard with
+               the fewest bytes so far.
+    Args     : pieces - list of (relative path, bytes).
+    Returns  : A list of (paths, bytes), largest shard first. Empty shards are left out.
+    """
+    shards = [([], 0) for i in range(streams)]
+    for (rel_path, size) in sorted(pieces, key=lambda piece: piece[1], reverse=True):
+        i = min(range(streams), key=lambda i: shards[i][1])
+        shards[i][0].append(rel_path)
+        shards[i] = (shards[i][0], shards[i][1] + size)
+    shards = [shard for shard in shards if shard[0]]
+    shards.sort(key=lambda shard: shard[1], reverse=True)
+    return shards
+
+class ParallelRsync:
+    """
+    Copies a run directory to <host>:dest_root/<run dir name> with streams concurrent
+    rsyncs, then reconciles the copy with one more rsync of the whole directory.
+    """
+
+    def __init__(self, source, ssh_connection, dest_root, options, streams,
+                 exclude=(), checksum=True, log_file=None):
+        """
+        Args : source - the run directory to copy.
+               ssh_connection - an SSHConnection to the host to copy to.
+               dest_root - the directory on the host to copy into.
+               options - rsync options for every rsync, e.g. ['-rlpt', '--chmod=...'].
+               streams - number of concurrent rsyncs.
+               exclude - names excluded from the copy by options, left out of the shards.
+               checksum - if True, the whole tree is sharded and copied with --checksum.
+                          If False, only files whose size or mtime differ are copied.
+               log_file - file the rsyncs' output and the shard plan are written to.
+        """
+        self.source = source.rstrip('/')
+        self.ssh_connection = ssh_connection
+        self.dest_dir = os.path.join(dest_root.rstrip('/'), os.path.basename(self.source))
+        self.options = list(options)
+        self.streams = streams
+        self.exclude = exclude
+        self.checksum = checksum
+        self.log_file = log_file
+
+    def log(self, msg):
+        if self.log_file:
+            self.log_file.write('%s: parallel rsync of %s: %s\n' % (time.strftime('%c'), os.path.basename(self.source), msg))
+            self.log_file.flush()
+
+    def get_dest(self):
+        return '%s:%s/' % (self.ssh_connection.host, self.dest_dir)
+
+    def get_rsync_command(self, files_from=None):
+        cmd = ['rsync'] + self.options + ['-e', self.ssh_connection.get_ssh_command()]
+        if files_from:
+            cmd += ['--files-from=%s' % files_from]
+            if self.checksum:
+                cmd += ['--checksum']
+        return cmd + [self.source + '/', self.get_dest()]
+
+    def call(self, cmd):
+        return subprocess.call(cmd, stdout=self.log_file, stderr=self.log_file)
+
+    def make_dest_dir(self):
+        return self.ssh_connection.call(['mkdir', '-p', self.dest_dir], stdout=self.log_file, stderr=self.log_file)
+
+    def plan_delta_shards(self):
+        """
+        Returns : Shards, as for plan_shards, of the files not yet on the destination or
+                  differing there in size or mtime.
+        """
+        source_manifest = copy_manifest.build_manifest(self.source, exclude=self.exclude)
+        (retcode, output) = self.ssh_connection.check_output([copy_manifest.get_find_command(self.dest_dir)],
+                                                             stderr=self.log_file)
+        if retcode:
+            # rsync will still skip files that match by size and mtime.
+            self.log('could not list %s, ssh exited %d; copying every file' % (self.get_dest(), retcode))
+            output = ''
+        changed = copy_manifest.diff_manifests(source_manifest, copy_manifest.parse_find_output(output))
+        pieces = [(rel_path, source_manifest[rel_path].size) for rel_path in changed]
+        self.log('%d of %d files (%.1f GB) to copy' %
+                 (len(changed), len(source_manifest), sum(size for (rel_path, size) in pieces) / 1e9))
+        return balance_shards(pieces, self.streams)
+
+    def copy_shard(self, shard):
+        (index, paths, size) = shard
+        start_time = time.time()
+        (fd, files_from) = tempfile.mkstemp(prefix='autocopy_shard%d_' % index)
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(''.join(path + '\n' for path in paths))
+            retcode = self.call(self.get_rsync_command(files_from))
+        finally:
+            os.remove(files_from)
+        seconds = time.time() - start_time
+        self.log('shard %d (%d paths, %.1f GB) exited %d after %d s' %
+                 (index, len(paths), size / 1e9, retcode, seconds))
+        return retcode
+
+    def run(self):
+        """
+        Returns : 0 if the run directory was copied, else the exit code of the first rsync
+                  or ssh command that failed.
+        """
+        start_time = time.time()
+        retcode = self.make_dest_dir()
+        if retcode:
+            self.log('could not create %s, ssh exited %d' % (self.get_dest(), retcode))
+            return retcode
+        if self.checksum:
+            shards = plan_shards(self.source, self.streams, exclude=self.exclude)
+        else:
+            shards = self.plan_delta_shards()
+        self.log('%d shards of %s GB' % (len(shards), ', '.join('%.1f' % (size / 1e9) for (paths, size) in shards)))
+        if shards:
+            pool = ThreadPool(processes=len(shards))
+            try:
+                retcodes = pool.map(self.copy_shard, [(i, paths, size) for (i, (paths, size)) in enumerate(shards)])
+            finally:
+                pool.close()
+                pool.join()
+            failed = [code for code in retcodes if code]
+            if failed:
+                return failed[0]
+        retcode = self.call(self.get_rsync_command())
+        self.log('reconciliation exited %d, %d s in all' % (retcode, time.time() - start_time))
+        return retcode
@@ -4,15 +4,207 @@ import datetime
 import glob
 import os
 import os.path
-import platform
 import re
-import subprocess
 import sys
+import time
 import xml.dom.minidom
 import xml.dom.pulldom
+import xml.etree.cElementTree
 
+import disk_usage
 import rundir_utils
 
+#
+# Metadata records for the XML files RunDir reads its run parameters from.
+#
+# Each file is parsed once, in a single streaming pass, into a small record.
+# RunDir keeps the record and only parses the file again if its mtime or size
+# changes, so the accessors below can all share one parse.
+#
+class XmlMetadata(object):
+
+    __slots__ = ('path', 'mtime', 'size')
+
+    @classmethod
+    def load(cls, path, cached=None):
+        """
+        Function : Returns cached if it was read from path and the file hasn't changed since,
+                   otherwise parses path into a new record.
+        Returns  : An instance of cls, or None if path doesn't exist.
+        """
+        try:
+            stats = os.stat(path)
+        except OSError:
+            return None
+        if (cached is not None and cached.path == path and
+            cached.mtime == stats.st_mtime and cached.size == stats.st_size):
+            return cached
+
+        record = cls()
+        record.path = path
+        record.mtime = stats.st_mtime
+        record.size = stats.st_size
+        record.parse()
+        return record
+
+    def parse(self):
+        tag_stack = []
+        for (event, elem) in xml.etree.cElementTree.iterparse(self.path, events=("start", "end")):
+            if event == "start":
+                tag_stack.append(elem.tag)
+                self.start_element(tag_stack, elem)
+            else:
+                self.end_element(tag_stack, elem)
+                tag_stack.pop()
+                elem.clear()
+
+    def start_element(self, tag_stack, elem):
+        pass
+
+    def end_element(self, tag_stack, elem):
+        pass
+
+    @staticmethod
+    def read_tuple(elem):
+        # (number, cycles, is_indexed) from the attributes of a <Read> or <RunInfoRead> element.
+        return (int(elem.get("Number")), int(elem.get("NumCycles")), elem.get("IsIndexedRead"))
+
+class RunParametersMetadata(XmlMetadata):
+    # Values read from runParameters.xml.
+    #
+    # Text values are taken from the first matching element inside <Setup>
+    # (HiSeq, and ApplicationName/ApplicationVersion for MiSeq), falling back
+    # to the first matching element anywhere in the file (MiSeq).
+
+    TEXT_TAGS = {
+        "ApplicationName": "application_name",
+        "ApplicationVersion": "application_version",
+        "RunStartDate": "run_start_date",
+        "Barcode": "barcode",
+        "Flowcell": "flowcell",
+        "RTAVersion": "rta_version",
+    }
+
+    __slots__ = ('application_name', 'application_version', 'run_start_date', 'barcode',
+                 'flowcell', 'rta_version',
+                 'setup_reads',     # HiSeq: <Setup><Reads><Read>
+                 'runinfo_reads',   # MiSeq: <Reads><RunInfoRead>
+                 '_in_setup_text', '_setup_seen', '_reads_seen', '_in_reads')
+
+    def parse(self):
+        for attr in self.TEXT_TAGS.values():
+            setattr(self, attr, None)
+        self.setup_reads = []
+        self.runinfo_reads = []
+        self._in_setup_text = {}
+        self._setup_seen = False
+        self._reads_seen = False
+        self._in_reads = False
+
+        XmlMetadata.parse(self)
+
+        for (tag, attr) in self.TEXT_TAGS.items():
+            if tag in self._in_setup_text:
+                setattr(self, attr, self._in_setup_text[tag])
+        del self._in_setup_text, self._setup_seen, self._reads_seen, self._in_reads
+
+    def start_element(self, tag_stack, elem):
+        if elem.tag == "Reads" and not self._reads_seen:
+            self._reads_seen = True
+            self._in_reads = True
+
+    def end_element(self, tag_stack, elem):
+        tag = elem.tag
+        in_setup = "Setup" in tag_stack[:-1] and not self._setup_seen
+
+        if tag in self.TEXT_TAGS:
+            if in_setup and tag not in self._in_setup_text:
+                self._in_setup_text[tag] = elem.text
+            attr = self.TEXT_TAGS[tag]
+            if getattr(self, attr) is None:
+                setattr(self, attr, elem.text)
+
+        elif tag == "Read" and in_setup and "Reads" in tag_stack[:-1] and self._in_reads:
+            self.setup_reads.append(self.read_tuple(elem))
+
+        elif tag == "RunInfoRead" and self._in_reads:
+            self.runinfo_reads.append(self.read_tuple(elem))
+
+        elif tag == "Reads" and self._in_reads:
+            self._in_reads = False
+
+        elif tag == "Setup":
+            self._setup_seen = True
+
+class RunInfoMetadata(XmlMetadata):
+    # Values read from RunInfo.xml: <RunInfo><Run Id="" Number=""> and its children.
+
+    __slots__ = ('run_id', 'run_number', 'flowcell', 'instrument', 'date', 'reads',
+                 'lane_count', 'surface_count', 'swath_count', 'tile_count',
+                 'section_per_lane', 'tile_naming', 'tiles')
+
+    def parse(self):
+        self.run_id = None
+        self.run_number = None
+        self.flowcell = None
+        self.instrument = None
+        self.date = None
+        self.reads = []
+        self.lane_count = None
+        self.surface_count = None
+        self.swath_count = None
+        self.tile_count = None
+        self.section_per_lane = None
+        self.tile_naming = None
+        self.tiles = []     # <TileSet><Tiles><Tile>, as "<lane>_<tile>" strings
+        XmlMetadata.parse(self)
+
+    def start_element(self, tag_stack, elem):
+        if elem.tag == "Run" and self.run_id is None:
+            self.run_id = elem.get("Id")
+            self.run_number = elem.get("Number")
+        elif elem.tag == "FlowcellLayout":
+            for (attr, key) in (("lane_count", "LaneCount"), ("surface_count", "SurfaceCount"),
+                                ("swath_count", "SwathCount"), ("tile_count", "TileCount"),
+                                ("section_per_lane", "SectionPerLane")):
+                value = elem.get(key)
+                if value is not None:
+                    setattr(self, attr, int(value))
+        elif elem.tag == "TileSet":
+            self.tile_naming = elem.get("TileNamingConvention")
+
+    def end_element(self, tag_stack, elem):
+        tag = elem.tag
+        if tag == "Flowcell" and self.flowcell is None:
+            self.flowcell = elem.text
+        elif tag == "Instrument" and self.instrument is None:
+            self.instrument = elem.text
+        elif tag == "Date" and self.date is None:
+            self.date = elem.text
+        elif tag == "Read" and "Reads" in tag_stack[:-1]:
+            self.reads.append(self.read_tuple(elem))
+        elif tag == "Tile" and "Tiles" in tag_stack[:-1] and elem.text:
+            self.tiles.append(elem.text.strip())
+
+    def get_tile_list(self):
+        # The tile numbers of a lane, from <TileSet><Tiles> if it lists them, or else
+        # from the <FlowcellLayout> counts: <surface><swath><tile:02d> (FourDigit), or
+        # <surface><swath><section><tile:02d> (FiveDigit). None without a FlowcellLayout.
+        if self.tiles:
+            return sorted(set(int(tile.split('_')[-1]) for tile in self.tiles))
+        if not (self.surface_count and self.swath_count and self.tile_count):
+            return None
+        if self.tile_naming == "FiveDigit":
+            return [surface * 10000 + swath * 1000 + section * 100 + tile
+                    for surface in range(1, self.surface_count + 1)
+                    for swath in range(1, self.swath_count + 1)
+                    for section in range(1, (self.section_per_lane or 1) + 1)
+                    for tile in range(1, self.tile_count + 1)]
+        return [surface * 1000 + swath * 100 + tile
+                for surface in range(1, self.surface_count + 1)
+                for swath in range(1, self.swath_count + 1)
+                for tile in range(1, self.tile_count + 1)]
+
 #
 # The RunDir object encapsulates all the functionality associated with an Illumina run directory.
 #
@@ -132,6 +324,13 @@ class RunDir:
 
     ANALYSIS_STATUS_PATH = os.path.join("Analysis","Status")
 
+    # How long get_status() may reuse its last listing of the run dir
+    #  while the run dir's mtime is unchanged.
+    STATUS_CACHE_SECONDS = 60
+
+    # Parts of the run directory whose disk usage is reported separately.
+    DISK_USAGE_SUBTREES = ['Data/Intensities', 'Data/Intensities/BaseCalls', 'Thumbnail_Images']
+
     # Path relative to run directory to Status.xml file,
     #  which contains reads and cycles.
     DATA_STATUS_PATH = os.path.join("Data","reports","Status.xml")
@@ -180,6 +379,18 @@ class RunDir:
         self.machine = None
         self.number = None
         self.flowcell = None
+
+        # Last status found by get_status(), with the run dir mtime and time it was listed.
+        self.status = None
+        self.status_mtime = None
+        self.status_listed_at = None
+
+        # Directory listings kept by scan_disk_usage().
+        self.disk_usage_cache = {}
+
+        # Parsed XML metadata records (see XmlMetadata).
+        self.run_parameters = None
+        self.run_info = None
         
     def str(self):
         s = ""
@@ -208,6 +419,15 @@ class RunDir:
         return self.dir
     def get_path(self):
         return os.path.join(self.root,self.dir)
+    def get_run_parameters(self):
+        # Returns a RunParametersMetadata record, or None if there's no runParameters.xml.
+        self.run_parameters = RunParametersMetadata.load(os.path.join(self.get_path(), "runParameters.xml"),
+                                                         self.run_parameters)
+        return self.run_parameters
+    def get_run_info(self):
+        # Returns a RunInfoMetadata record, or None if there's no RunInfo.xml.
+        self.run_info = RunInfoMetadata.load(os.path.join(self.get_path(), "RunInfo.xml"), self.run_info)
+        return self.run_info
     def get_data_volume(self):
         m = re.search(r'(IlluminaRuns[0-9]+)', self.get_root())
         if not m:
@@ -229,34 +449,13 @@ class RunDir:
                     print >> sys.stderr, "RunDir.get_start_date(): RunDir %s: Start Date %s is not 6 digits." % (self.get_dir(),name_parse[0])
                     self.start_date = None
 
-            elif platform == self.PLATFORM_ILLUMINA_HISEQ :
-
-                # Get start date from runParameters.xml.
-                # XML Path: <RunParameters><Setup><RunStartDate>
-                run_params_file = os.path.join(self.get_path(), "runParameters.xml")
-                if os.path.exists(run_params_file):
-                    run_params_doc = xml.dom.minidom.parse(run_params_file)
-
-                    # Get <RunParameters><Setup><RunStartDate>.
-                    runparams_node = run_params_doc.getElementsByTagName("RunParameters")[0]
-                    setup_node = runparams_node.getElementsByTagName("Setup")[0]
-                    runstartdate_node = setup_node.getElementsByTagName("RunStartDate")[0]
-
-                    self.start_date = runstartdate_node.firstChild.nodeValue
-
-            elif platform == self.PLATFORM_ILLUMINA_MISEQ:
+            elif platform in (self.PLATFORM_ILLUMINA_HISEQ, self.PLATFORM_ILLUMINA_MISEQ):
 
                 # Get start date from runParameters.xml.
-                # XML Path: <RunParameters><RunStartDate>
-                run_params_file = os.path.join(self.get_path(), "runParameters.xml")
-                if os.path.exists(run_params_file):
-                    run_params_doc = xml.dom.minidom.parse(run_params_file)
-
-                    # Get <RunParameters><Setup><RunStartDate>.
-                    runparams_node = run_params_doc.getElementsByTagName("RunParameters")[0]
-                    runstartdate_node = runparams_node.getElementsByTagName("RunStartDate")[0]
-
-                    self.start_date = runstartdate_node.firstChild.nodeValue
+                # XML Path: <RunParameters><Setup><RunStartDate> (HiSeq), <RunParameters><RunStartDate> (MiSeq)
+                run_params = self.get_run_parameters()
+                if run_params is not None:
+                    self.start_date = run_params.run_start_date
 
             else:
                 print >> sys.stderr, "RunDir.get_start_date(): Platform unknown."
@@ -304,21 +503,9 @@ class RunDir:
 
             # Get run number from RunInfo.xml.
             # XML Path: <RunInfo><Run Number="">
-            run_info_file = os.path.join(self.get_path(), "RunInfo.xml")
-            if os.path.exists(run_info_file):
-                run_info_doc = xml.dom.minidom.parse(run_info_file)
-
-                # Get <RunInfo><Run><Instrument>.
-                runinfo_node = run_info_doc.getElementsByTagName("RunInfo")[0]
-                run_node = runinfo_node.getElementsByTagName("Run")[0]
-
-                # Find Number attribute in Run node.
-                run_attrs = run_node.attributes
-                for attr_idx in range(run_attrs.length):
-                    attr_name = run_attrs.item(attr_idx).name
-                    if attr_name == "Number":
-                        self.number = run_attrs.item(attr_idx).value
-                        break
+            run_info = self.get_run_info()
+            if run_info is not None:
+                self.number = run_info.run_number
 
         return self.number
 
@@ -353,36 +540,19 @@ class RunDir:
 
                 # Get flowcell from runParameters.xml.
                 # XML Path: <RunParameters><Setup><Barcode> (Alternative: From RunInfo.xml <RunInfo><Run><Flowcell>)
-                run_params_file = os.path.join(self.get_path(), "runParameters.xml")
-                if os.path.exists(run_params_file):
-                    run_params_doc = xml.dom.minidom.parse(run_params_file)
-
-                    # Get <RunParameters><Setup><RunStartDate>.
-                    runparams_node = run_params_doc.getElementsByTagName("RunParameters")[0]
-                    setup_node = runparams_node.getElementsByTagName("Setup")[0]
-                    barcode_node = setup_node.getElementsByTagName("Barcode")[0]
-
-                    flowcell_name = barcode_node.firstChild.nodeValue
-
+                run_params = self.get_run_parameters()
+                if run_params is not None and run_params.barcode is not None:
                     # Remove tail (e.g., "ACXX") from flowcell name.
-                    self.flowcell = flowcell_name[:5]
+                    self.flowcell = run_params.barcode[:5]
 
             elif platform == self.PLATFORM_ILLUMINA_MISEQ:
 
                 # Get flowcell from runParameters.xml.
                 # XML Path: <RunParameters><Barcode> (Alternative: From RunInfo.xml <RunInfo><Run><Flowcell>)
-                run_params_file = os.path.join(self.get_path(), "runParameters.xml")
-                if os.path.exists(run_params_file):
-                    run_params_doc = xml.dom.minidom.parse(run_params_file)
-
-                    # Get <RunParameters><Setup><RunStartDate>.
-                    runparams_node = run_params_doc.getElementsByTagName("RunParameters")[0]
-                    barcode_node = runparams_node.getElementsByTagName("Barcode")[0]
-
-                    flowcell_name = barcode_node.firstChild.nodeValue
-
+                run_params = self.get_run_parameters()
+                if run_params is not None and run_params.barcode is not None:
                     # Remove "000000000-" from flowcell name.
-                    self.flowcell = flowcell_name[-5:]
+                    self.flowcell = run_params.barcode[-5:]
             else:
                 print >> sys.stderr, "RunDir.get_flowcell(): Platform unknown."
                 return None
@@ -463,11 +633,33 @@ class RunDir:
     def get_status(self):
         # Find the highest numbered status (latest in workflow) that
         #  is represented by a file in the run dir.
+        #
+        # Writing a status file changes the run dir's mtime, so one stat of the
+        #  run dir tells whether the last listing can be reused. Otherwise the
+        #  run dir is listed once and all status files are looked up in that.
+        try:
+            mtime = os.stat(self.get_path()).st_mtime
+        except OSError:
+            return RunDir.STATUS_INITIALIZED
+
+        if (self.status is not None and mtime == self.status_mtime and
+            time.time() - self.status_listed_at < RunDir.STATUS_CACHE_SECONDS):
+            return self.status
+
+        listed_at = time.time()
+        try:
+            entries = set(os.listdir(self.get_path()))
+        except OSError:
+            return RunDir.STATUS_INITIALIZED
         for status in range(RunDir.STATUS_MAX_INDEX - 1, RunDir.STATUS_INITIALIZED, -1):
-            if os.path.exists(os.path.join(self.get_path(), RunDir.STATUS_FILES[status])):
+            if RunDir.STATUS_FILES[status] in entries:
                 break
         else:
             status = RunDir.STATUS_INITIALIZED
+
+        self.status = status
+        self.status_mtime = mtime
+        self.status_listed_at = listed_at
         return status
 
     def get_seq_status(self):
@@ -616,33 +808,23 @@ class RunDir:
                 os.remove(status_path)
 
     def get_disk_usage(self):
-        #
-        # Run 'du' on the run directory.
-        #
-        du_cmd_list = ['du', '-s']
-
-        # Set block size switches for various platforms.
-        #  The desired unit of measure is gigabytes.
-        platfm = platform.system()
-        if platfm == "Linux":
-            du_cmd_list.append("--block-size=1G")
-        elif platfm == "Darwin":
-            du_cmd_list.append("-g")
-        else:
-            print >> sys.stderr, "get_disk_usage(): Unknown OS platform %s" % (platfm)
-            disk_usage = None
-            return self.disk_usage
-
-        # Add the run directory path to the command.
-        du_cmd_list.append(self.get_path())
+        """
+        Returns : Disk usage of the run directory in bytes.
+        """
+        return self.scan_disk_usage().bytes
 
-        # Run the disk usage command and get the output.
-        du_cmd_pipe = subprocess.Popen(du_cmd_list, stdout=subprocess.PIPE)
-        (du_stdout, du_stderr) = du_cmd_pipe.communicate()
+    def get_disk_usage_by_subtree(self):
+        """
+        Returns : Dict of disk usage in bytes for each of RunDir.DISK_USAGE_SUBTREES,
+                  with None for subtrees the run doesn't have.
+        """
+        return self.scan_disk_usage().subtrees
 
-        # Parse the output.
-        (disk_usage, dir) = du_stdout.split()
-        return int(disk_usage)
+    def scan_disk_usage(self):
+        # Directories that haven't changed since the last call are not
+        # listed again (see disk_usage.py), so repeat calls are cheap.
+        return disk_usage.get_disk_usage(self.get_path(), RunDir.DISK_USAGE_SUBTREES,
+                                         cache=self.disk_usage_cache)
 
     ###
     # Other methods
@@ -650,6 +832,8 @@ class RunDir:
     def find_reads_cycles(self):
 
         (reads, cycle_list, pairedend_run, indexed_reads) = self.get_reads_cycles_from_runparameters()
+        if reads is None:
+            (reads, cycle_list, pairedend_run, indexed_reads) = self.get_reads_cycles_from_runinfo()
         if reads is None:
             (reads, cycle_list, pairedend_run, indexed_reads) = self.get_reads_cycles_from_status()
         if reads is None:
@@ -675,51 +859,36 @@ class RunDir:
         indexed_reads = False
 
         #
-        # Open the runParameters.xml file as an XML document.
+        # Get the reads from the parsed runParameters.xml file.
         #
-        run_dir = self.get_path()
-        run_parameters_path = os.path.join(run_dir, "runParameters.xml")
+        run_parameters = self.get_run_parameters()
 
-        if os.path.exists(run_parameters_path):
-            run_parameters_doc = xml.dom.minidom.parse(run_parameters_path)
+        if run_parameters is not None:
 
             cycle_hash = dict()
 
             if self.platform == RunDir.PLATFORM_ILLUMINA_HISEQ:
-                # Get <RunParameters><Setup><Reads>
-                run_parameters_node = run_parameters_doc.getElementsByTagName("RunParameters")[0]
-                setup_node = run_parameters_node.getElementsByTagName("Setup")[0]
-                reads_node = setup_node.getElementsByTagName("Reads")[0]
-
-                # Get <Read> subnodes
-                read_nodes = reads_node.getElementsByTagName("Read")
+                # <RunParameters><Setup><Reads><Read>
+                read_tuples = run_parameters.setup_reads
 
             elif self.platform == RunDir.PLATFORM_ILLUMINA_MISEQ:
-
-                # Get <RunParameters><Reads>
-                run_parameters_node = run_parameters_doc.getElementsByTagName("RunParameters")[0]
-                reads_node = run_parameters_node.getElementsByTagName("Reads")[0]
-
-                # Get <RunInfoReads> subnodes
-                read_nodes = reads_node.getElementsByTagName("RunInfoRead")
+                # <RunParameters><Reads><RunInfoRead>
+                read_tuples = run_parameters.runinfo_reads
 
             else:
                 # Platform has runParameters.xml, but isn't HiSeq/MiSeq?!
                 return (None, None, None, None)
 
             # Decode platforms HiSeq and MiSeq
-            for read_node in read_nodes:
-                # Get "Number" attribute to search for number of reads.
-                read_number = int(read_node.getAttribute("Number"))
+            for (read_number, cycles, indexed_read) in read_tuples:
+                # Track "Number" attribute to search for number of reads.
                 if read_number > reads: reads = read_number
 
-                # Get "NumCycles" attribute for cycle list.
-                cycles = int(read_node.getAttribute("NumCycles"))
+                # "NumCycles" attribute for cycle list.
                 cycle_hash[read_number] = cycles
 
                 # Check for "IsIndexedRead" attribute to determine if this is an indexed run.
                 #  Also, if a non-indexed read is read number > 1, this is a paired-end run.
-                indexed_read = read_node.getAttribute("IsIndexedRead")
                 if indexed_read == 'Y':
                     indexed_reads = True
                 elif indexed_read == "N" and read_number > 1:
@@ -739,6 +908,20 @@ class RunDir:
         return (reads, cycle_list, pairedend_run, indexed_reads)
 
 
+    def get_reads_cycles_from_runinfo(self):
+        # As get_reads_cycles_from_runparameters(), from <RunInfo><Run><Reads>, for
+        # instruments whose runParameters.xml isn't read (NextSeq, HiSeq X, NovaSeq).
+        run_info = self.get_run_info()
+        if run_info is None or not run_info.reads:
+            return (None, None, None, None)
+
+        read_tuples = sorted(run_info.reads)
+        cycle_list = [cycles for (read_number, cycles, indexed_read) in read_tuples]
+        indexed_reads = any(indexed_read == 'Y' for (read_number, cycles, indexed_read) in read_tuples)
+        pairedend_run = any(indexed_read == 'N' and read_number > 1
+                            for (read_number, cycles, indexed_read) in read_tuples)
+        return (len(read_tuples), cycle_list, pairedend_run, indexed_reads)
+
     def get_reads_cycles_from_status(self):
             
         #
@@ -864,16 +1047,9 @@ class RunDir:
 
         # Get machine name from RunInfo.xml (this works for HiSeq and GAIIx).
         # XML Path: <RunInfo><Run><Instrument>
-        run_info_file = os.path.join(self.get_path(), "RunInfo.xml")
-        if os.path.exists(run_info_file):
-            run_info_doc = xml.dom.minidom.parse(run_info_file)
-
-            # Get <RunInfo><Run><Instrument>.
-            runinfo_node = run_info_doc.getElementsByTagName("RunInfo")[0]
-            run_node = runinfo_node.getElementsByTagName("Run")[0]
-            instrum_node = run_node.getElementsByTagName("Instrument")[0]
-
-            return instrum_node.firstChild.nodeValue
+        run_info = self.get_run_info()
+        if run_info is not None:
+            return run_info.instrument
         else:
             return None
 
@@ -887,20 +1063,15 @@ class RunDir:
             # Platform is HiSeq if file "runParameters.xml" has an
             # entry <RunParameters><Setup><ApplicationName> which
             # includes "HiSeq" (Also MiSeq if "MiSeq").
-            run_params_path = os.path.join(self.get_path(),"runParameters.xml")
-            if os.path.exists(run_params_path):
-                run_params_doc = xml.dom.minidom.parse(run_params_path)
+            run_params = self.get_run_parameters()
+            if run_params is not None:
+                appname = run_params.application_name or ""
 
-                # Get <Configuration><NumberOfReads>.
-                run_params_node = run_params_doc.getElementsByTagName("RunParameters")[0]
-                setup_node = run_params_node.getElementsByTagName("Setup")[0]
-                appname_node = setup_node.getElementsByTagName("ApplicationName")[0]
-
-                hiseq_match = re.search("^HiSeq", appname_node.firstChild.nodeValue)
+                hiseq_match = re.search("^HiSeq", appname)
                 if hiseq_match:
                     self.platform = RunDir.PLATFORM_ILLUMINA_HISEQ
                 else:
-                    miseq_match = re.search("^MiSeq", appname_node.firstChild.nodeValue)
+                    miseq_match = re.search("^MiSeq", appname)
                     if miseq_match:
                         self.platform = RunDir.PLATFORM_ILLUMINA_MISEQ
                     else:
@@ -948,16 +1119,9 @@ class RunDir:
 
                 # Control software version is in file "runParameters.xml",
                 # entry <RunParameters><Setup><ApplicationVersion> .
-                run_params_path = os.path.join(self.get_path(),"runParameters.xml")
-                if os.path.exists(run_params_path):
-                    run_params_doc = xml.dom.minidom.parse(run_params_path)
-
-                    # Get <RunParameters><Setup><ApplicationVersion> .
-                    run_params_node = run_params_doc.getElementsByTagName("RunParameters")[0]
-                    setup_node = run_params_node.getElementsByTagName("Setup")[0]
-                    appvers_node = setup_node.getElementsByTagName("ApplicationVersion")[0]
-
-                    self.control_software_version =  appvers_node.firstChild.nodeValue
+                run_params = self.get_run_parameters()
+                if run_params is not None:
+                    self.control_software_version = run_params.application_version
 
             else:
                 print >> sys.stderr, "RunDir.get_control_software_version(): Platform unknown"
@@ -994,12 +1158,12 @@ class RunDir:
     #
     def get_control_software_version_integer(self):
 
-        #sw_version = self.get_control_software_version()
+        sw_version = self.get_control_software_version()
         if sw_version is None:
             return None
         else:
             # convert the SW version to an integer.
-            digits = self.control_software_version.split('.')
+            digits = sw_version.split('.')
 
             if len(digits) >= 3:
                 version_int = int(digits[0])*1000 + int(digits[1])*100 + int(digits[2])
@@ -1021,16 +1185,9 @@ class RunDir:
 
                 # Control software version is in file "runParameters.xml",
                 # entry <RunParameters><Setup><Flowcell> .
-                run_params_path = os.path.join(self.get_path(),"runParameters.xml")
-                if os.path.exists(run_params_path):
-                    run_params_doc = xml.dom.minidom.parse(run_params_path)
-
-                    # Get <RunParameters><Setup><Flowcell>.
-                    run_params_node = run_params_doc.getElementsByTagName("RunParameters")[0]
-                    setup_node = run_params_node.getElementsByTagName("Setup")[0]
-                    flowcell_node = setup_node.getElementsByTagName("Flowcell")[0]
-
-                    if flowcell_node.firstChild.nodeValue.endswith('v3'):
+                run_params = self.get_run_parameters()
+                if run_params is not None:
+                    if (run_params.flowcell or "").endswith('v3'):
                         self.seq_kit_version = 'hiseq_v3'
                     else:
                         self.seq_kit_version = 'hiseq_v1'
@@ -1051,8 +1208,14 @@ class RunDir:
 
 
     def get_tile_list(self):
-        # Make tile lists per platform.
+        # Make tile lists from the <FlowcellLayout> of RunInfo.xml, or else per platform.
         # Output: list of integers.
+        run_info = self.get_run_info()
+        if run_info is not None:
+            tile_list = run_info.get_tile_list()
+            if tile_list is not None:
+                return tile_list
+
         tile_list = []
         platform = self.get_platform()
         if platform == RunDir.PLATFORM_ILLUMINA_GA:
@@ -1067,8 +1230,8 @@ class RunDir:
             #   Otherwise, SeqKit v1 uses four digit tile numbers and has 2 swaths.
             #              SeqKit v3 uses four digit tile numbers and has 3 swaths.
             #
-            #sw_version = self.get_control_software_version()
-            seq_kit_version = self.get_seq_kit_version()
+            sw_version = self.get_control_software_version() or ""
+            seq_kit_version = self.get_seq_kit_version() or ""
             if sw_version.startswith("1.1.37"):
                 # Tiles 1..8, 21..28, 41..48, 61..68
                 swaths = ['',2,4,6]
@@ -1101,6 +1264,11 @@ class RunDir:
 
     def get_lane_list(self):
 
+        # <FlowcellLayout LaneCount=""> of RunInfo.xml, if it has one.
+        run_info = self.get_run_info()
+        if run_info is not None and run_info.lane_count:
+            return range(1, run_info.lane_count + 1)
+
         platform = self.get_platform()
         if platform == self.PLATFORM_ILLUMINA_GA or platform == self.PLATFORM_ILLUMINA_HISEQ:
             # 8 lanes for GA and HiSeq
@@ -1115,6 +1283,13 @@ class RunDir:
 
         return lane_list
 
+    def get_surface_list(self):
+        # <FlowcellLayout SurfaceCount=""> of RunInfo.xml, or None if it has none.
+        run_info = self.get_run_info()
+        if run_info is not None and run_info.surface_count:
+            return range(1, run_info.surface_count + 1)
+        return None
+
 ###
 #
 # Test code: displays the fields of the run directories given on the command line.
@@ -1154,9 +1329,13 @@ if __name__ == "__main__":
         print rundir.str(),
 
         if opts.disk_usage:
-            disk_usage = rundir.get_disk_usage()
+            # (not named disk_usage, which would hide the module)
+            usage_bytes = rundir.get_disk_usage()
 
-            print "  Disk Usage: %d Gb" % disk_usage
+            print "  Disk Usage: %.1f Gb" % (usage_bytes / (1024.0 ** 3))
+            for (subtree, subtree_usage) in sorted(rundir.get_disk_usage_by_subtree().items()):
+                if subtree_usage is not None:
+                    print "    %s: %.1f Gb" % (subtree, subtree_usage / (1024.0 ** 3))
 
         if opts.validate:
             print
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+
+###############################################################################
+#
+# rundir_index.py - Index the files under a run directory's Data/Intensities
+#   by (lane, cycle, tile, kind), for rundir_utils.validate().
+#
+# validate() used to list each lane and cycle directory as it came to it,
+# and look each expected file name up in the listing, a list: a HiSeq run
+# of 8 lanes x 300 cycles x 32 tiles took minutes. Here the tree is listed
+# once, a level at a time with every directory of a level listed in
+# parallel (as tar_writer.walk does, but without a stat of each file), and
+# every file name is parsed into a key. The files a run should have are
+# keys too, so the ones it's missing are a set difference.
+#
+# Which files are indexed, and how their names are parsed, is given by the
+# FileSpecs of the run's layout (see rundir_layout.py). Only the
+# directories of those files, and their parents, are listed.
+#
+###############################################################################
+
+import os
+from multiprocessing.pool import ThreadPool
+
+WALK_THREADS = 8
+
+class RunDirIndex:
+    """
+    The directories and files found under a Data/Intensities directory.
+    """
+
+    def __init__(self, path, file_specs):
+        self.path = path
+        self.file_specs = file_specs
+        self.listings = {}  # relative path of each directory listed -> set of its names
+        self.keys = set()   # (lane, cycle, tile or surface, kind) of each file recognized;
+                            # None for the fields a kind of file doesn't have
+        # Regexes of the directories to list, by depth, so the names in the deepest
+        # directories (most of them) aren't matched against any.
+        self.dir_res_by_depth = {}
+        for spec in file_specs:
+            for (depth, dir_re) in enumerate(spec.parent_dir_res, 1):
+                self.dir_res_by_depth.setdefault(depth, []).append(dir_re)
+
+    def build(self, threads=WALK_THREADS):
+        """
+        Function : Lists the directories of the index, in parallel, and parses their files.
+        Returns  : self
+        """
+        def list_dir(rel_dir):
+            try:
+                return (rel_dir, os.listdir(os.path.join(self.path, rel_dir)))
+            except OSError:
+                # Missing, or not a directory
+                return (rel_dir, None)
+
+        level = ['']
+        depth = 0
+        pool = ThreadPool(processes=max(1, threads))
+        try:
+            while level:
+                depth += 1
+                dir_res = self.dir_res_by_depth.get(depth, [])
+                next_level = []
+                for (rel_dir, names) in pool.map(list_dir, level):
+                    if names is None:
+                        continue
+                    self.listings[rel_dir] = set(names)
+                    self.add_files(rel_dir, names)
+                    if dir_res:
+                        next_level.extend(rel_path for rel_path in (os.path.join(rel_dir, name) for name in names)
+                                          if any(dir_re.match(rel_path) for dir_re in dir_res))
+                level = next_level
+        finally:
+            pool.close()
+            pool.join()
+        return self
+
+    def add_files(self, rel_dir, names):
+        for spec in self.file_specs:
+            dir_values = spec.parse_dir(rel_dir)
+            if dir_values is None:
+                continue
+            for name in names:
+                key = spec.parse_name(name, dir_values)
+                if key is not None:
+                    self.keys.add(key)
+
+    def has_dir(self, rel_dir):
+        return rel_dir in self.listings
+
+    def has_file(self, rel_dir, name):
+        return name in self.listings.get(rel_dir, ())
+
+    def get_missing(self, spec, lanes, cycles, units):
+        """
+        Returns : The set of keys of the files of FileSpec spec expected for lanes, cycles
+                  and units (tiles or surfaces) that aren't in the index.
+        """
+        return spec.get_keys(lanes, cycles, units) - self.keys
+
+def index_intensities(intensities_path, file_specs, threads=WALK_THREADS):
+    """
+    Returns : The RunDirIndex of the files of file_specs under the Data/Intensities
+              directory intensities_path.
+    """
+    return RunDirIndex(intensities_path, file_specs).build(threads)
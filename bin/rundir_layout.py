@@ -0,0 +1,252 @@
+#!/usr/bin/env python
+
+###############################################################################
+#
+# rundir_layout.py - The files each kind of Illumina run directory should
+#   have under Data/Intensities, for rundir_utils.validate().
+#
+# A Layout is a list of FileSpecs, one per kind of file, each a pair of
+# format strings for the file's directory and name relative to
+# Data/Intensities, with fields {lane}, {cycle}, and {tile} or {surface}:
+#
+#   FileSpec('bcl', 'BaseCalls/L{lane:03d}/C{cycle}.1', 's_{lane}_{tile}.bcl')
+#
+# The same templates are used to parse the names found on disk into
+# (lane, cycle, tile or surface, kind) keys (see rundir_index.py) and to
+# print the files that are missing. Which lanes, cycles, tiles and
+# surfaces to expect comes from the run: the <FlowcellLayout> of
+# RunInfo.xml when there is one (see RunDir.get_tile_list()).
+#
+# get_layout() returns the first registered layout that matches a run.
+# Layouts for formats written since RTA 1.18 match on the files of the
+# first cycle, since the instruments that write them can't all be told
+# apart from their metadata; the older ones match on platform and control
+# software version. Sites with other instruments can add layouts with
+# register_layout().
+#
+###############################################################################
+
+import os
+import re
+import string
+
+class FileSpec:
+    """
+    The files of one kind in a layout.
+    """
+
+    def __init__(self, kind, dir_template, name_template, option=None):
+        """
+        Args : kind - name of the kind of file, e.g. 'bcl', used in messages and index keys.
+               dir_template, name_template - format strings for the directory, relative
+                   to Data/Intensities, and the name of each file.
+               option - name of the validate() argument that turns on the check of these
+                   files, e.g. 'cif'; None to always check them.
+        """
+        self.kind = kind
+        self.dir_template = dir_template
+        self.name_template = name_template
+        self.option = option
+        (self.dir_re, self.dir_fields) = template_to_regex(dir_template)
+        (self.name_re, self.name_fields) = template_to_regex(name_template)
+        fields = set(self.dir_fields + self.name_fields)
+        self.per_lane = 'lane' in fields
+        self.per_cycle = 'cycle' in fields
+        if 'tile' in fields:
+            self.unit = 'tile'
+        elif 'surface' in fields:
+            self.unit = 'surface'
+        else:
+            self.unit = None
+        # The directory and its parents, which have to be listed to find the files
+        parts = dir_template.split('/') if dir_template else []
+        self.parent_dir_res = [template_to_regex('/'.join(parts[:i]))[0] for i in range(1, len(parts) + 1)]
+
+    def parse_dir(self, rel_dir):
+        """
+        Returns : A dict of the fields of rel_dir, if it's a directory of these files, or None.
+        """
+        return parse_fields(self.dir_re, self.dir_fields, rel_dir, {})
+
+    def parse_name(self, name, dir_values):
+        """
+        Returns : The key of file name, in the directory whose fields are dir_values, or
+                  None if it isn't one of these files.
+        """
+        values = parse_fields(self.name_re, self.name_fields, name, dict(dir_values))
+        if values is None:
+            return None
+        return (values.get('lane'), values.get('cycle'), values.get(self.unit), self.kind)
+
+    def get_keys(self, lanes, cycles, units):
+        """
+        Returns : The set of keys of the files expected for lanes, cycles and units (tiles
+                  or surfaces); the arguments a spec doesn't have fields for are ignored.
+        """
+        if not self.per_lane: lanes = [None]
+        if not self.per_cycle: cycles = [None]
+        if self.unit is None: units = [None]
+        return set((lane, cycle, unit, self.kind) for lane in lanes for cycle in cycles for unit in units)
+
+    def format(self, template, key):
+        (lane, cycle, unit, kind) = key
+        return template.format(lane=lane, cycle=cycle, tile=unit, surface=unit)
+
+    def get_dir(self, key):
+        return self.format(self.dir_template, key)
+
+    def get_name(self, key):
+        return self.format(self.name_template, key)
+
+def template_to_regex(template):
+    """
+    Returns : (regex, fields) - the compiled regex matching the strings template formats to,
+              with a group per field, and the field name of each group.
+    """
+    pattern = ''
+    fields = []
+    for (literal, field, format_spec, conversion) in string.Formatter().parse(template):
+        pattern += re.escape(literal)
+        if field is not None:
+            pattern += r'(\d+)'
+            fields.append(field)
+    return (re.compile(pattern + '$'), fields)
+
+def parse_fields(regex, fields, text, values):
+    """
+    Returns : values, updated with the fields of text, or None if text doesn't match regex
+              or gives a field two different values (e.g. a lane 2 file in a lane 1 directory).
+    """
+    match = regex.match(text)
+    if match is None:
+        return None
+    for (field, digits) in zip(fields, match.groups()):
+        value = int(digits)
+        if values.setdefault(field, value) != value:
+            return None
+    return values
+
+class Layout:
+    """
+    A kind of run directory: the files it has, and how to recognize it.
+    """
+
+    def __init__(self, name, file_specs, probes=(), condition=None):
+        """
+        Args : name - shown in validate() messages.
+               file_specs - list of FileSpecs.
+               probes - list of (directory, file name regex) relative to Data/Intensities;
+                   the layout only matches runs with a matching file in each directory.
+               condition - optional function of a RunDir that must return True for the
+                   layout to match.
+        """
+        self.name = name
+        self.file_specs = file_specs
+        self.probes = [(rel_dir, re.compile(pattern + '$')) for (rel_dir, pattern) in probes]
+        self.condition = condition
+
+    def matches(self, rundir, intensities_path):
+        for (rel_dir, name_re) in self.probes:
+            try:
+                names = os.listdir(os.path.join(intensities_path, rel_dir))
+            except OSError:
+                return False
+            if not any(name_re.match(name) for name in names):
+                return False
+        return self.condition is None or self.condition(rundir)
+
+def get_platform(rundir):
+    # The platform of rundir, or None for the instruments RunDir doesn't know.
+    try:
+        return rundir.get_platform()
+    except Exception:
+        return None
+
+def is_hiseq(rundir, min_version=None, max_version=None):
+    # True if rundir is a HiSeq run with control software version min_version <= v < max_version.
+    if get_platform(rundir) != rundir.PLATFORM_ILLUMINA_HISEQ:
+        return False
+    version = rundir.get_control_software_version_integer()
+    if version is None:
+        return False
+    return ((min_version is None or version >= min_version) and
+            (max_version is None or version < max_version))
+
+# Files shared by several layouts
+CONFIG = FileSpec('config', 'BaseCalls', 'config.xml')
+CIF = FileSpec('cif', 'L{lane:03d}/C{cycle}.1', 's_{lane}_{tile}.cif', option='cif')
+STATS = FileSpec('stats', 'BaseCalls/L{lane:03d}/C{cycle}.1', 's_{lane}_{tile}.stats')
+LANE_FILTER = FileSpec('filter', 'BaseCalls/L{lane:03d}', 's_{lane}_{tile:04d}.filter')
+RUN_LOCS = FileSpec('locs', '', 's.locs')
+
+LAYOUTS = [
+    # RTA 3: NovaSeq, NextSeq 1000/2000, iSeq. One CBCL file per lane, cycle and surface.
+    Layout('CBCL',
+           [FileSpec('cbcl', 'BaseCalls/L{lane:03d}/C{cycle}.1', 'L{lane:03d}_{surface}.cbcl'),
+            LANE_FILTER, RUN_LOCS],
+           probes=[('BaseCalls/L001/C1.1', r'L001_\d+\.cbcl')]),
+
+    # RTA 2, NextSeq 500/550: one BGZF file per lane and cycle, with its index.
+    Layout('NextSeq BGZF',
+           [FileSpec('bcl.bgzf', 'BaseCalls/L{lane:03d}', '{cycle:04d}.bcl.bgzf'),
+            FileSpec('bci', 'BaseCalls/L{lane:03d}', '{cycle:04d}.bcl.bgzf.bci'),
+            FileSpec('filter', 'BaseCalls/L{lane:03d}', 's_{lane}.filter'),
+            RUN_LOCS],
+           probes=[('BaseCalls/L001', r'\d{4}\.bcl\.bgzf')]),
+
+    # RTA 2, HiSeq X/3000/4000: gzipped BCLs per tile, one s.locs for the patterned flowcell.
+    Layout('HiSeq X/4000 bcl.gz',
+           [FileSpec('bcl.gz', 'BaseCalls/L{lane:03d}/C{cycle}.1', 's_{lane}_{tile}.bcl.gz'),
+            LANE_FILTER, RUN_LOCS],
+           probes=[('BaseCalls/L001/C1.1', r's_1_\d+\.bcl\.gz'), ('', r's\.locs')]),
+
+    # RTA 1.18, HiSeq 2500 HCS 2.2: gzipped BCLs per tile, .clocs per tile.
+    Layout('HiSeq RTA 1.18 bcl.gz',
+           [FileSpec('clocs', 'L{lane:03d}', 's_{lane}_{tile:04d}.clocs'),
+            CIF, CONFIG, LANE_FILTER,
+            FileSpec('bcl.gz', 'BaseCalls/L{lane:03d}/C{cycle}.1', 's_{lane}_{tile}.bcl.gz'),
+            STATS],
+           probes=[('BaseCalls/L001/C1.1', r's_1_\d+\.bcl\.gz')]),
+
+    # GA, HCS 1.1.37: _pos.txt position files and .filter files for all lanes.
+    Layout('GA/HCS 1.1.37',
+           [FileSpec('pos', '', 's_{lane}_{tile:04d}_pos.txt'),
+            CIF, CONFIG,
+            FileSpec('filter', 'BaseCalls', 's_{lane}_{tile:04d}.filter'),
+            FileSpec('bcl', 'BaseCalls/L{lane:03d}/C{cycle}.1', 's_{lane}_{tile}.bcl'),
+            STATS],
+           condition=lambda rundir: (get_platform(rundir) == rundir.PLATFORM_ILLUMINA_GA or
+                                     is_hiseq(rundir, max_version=1308))),
+
+    # HCS 1.3.8 on: .clocs and .filter files by lane.
+    Layout('HiSeq',
+           [FileSpec('clocs', 'L{lane:03d}', 's_{lane}_{tile:04d}.clocs'),
+            CIF, CONFIG, LANE_FILTER,
+            FileSpec('bcl', 'BaseCalls/L{lane:03d}/C{cycle}.1', 's_{lane}_{tile}.bcl'),
+            STATS],
+           condition=lambda rundir: is_hiseq(rundir, min_version=1308)),
+
+    # MiSeq: .locs files by lane.
+    Layout('MiSeq',
+           [FileSpec('locs', 'L{lane:03d}', 's_{lane}_{tile:04d}.locs'),
+            CIF, CONFIG,
+            FileSpec('bcl', 'BaseCalls/L{lane:03d}/C{cycle}.1', 's_{lane}_{tile}.bcl'),
+            STATS],
+           condition=lambda rundir: get_platform(rundir) == rundir.PLATFORM_ILLUMINA_MISEQ),
+]
+
+def register_layout(layout, index=0):
+    """
+    Function : Adds layout to the layouts get_layout() tries, by default ahead of the others.
+    """
+    LAYOUTS.insert(index, layout)
+
+def get_layout(rundir, intensities_path):
+    """
+    Returns : The first of LAYOUTS that matches rundir, whose Data/Intensities directory is
+              intensities_path, or None.
+    """
+    for layout in LAYOUTS:
+        if layout.matches(rundir, intensities_path):
+            return layout
+    return None
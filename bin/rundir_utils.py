@@ -1,10 +1,17 @@
+import collections
+import gzip
 import os
 import os.path
-import platform
 import shutil
 import subprocess
 import sys
 import tarfile
+import tempfile
+
+import checksum
+import parallel_compress
+import rundir_index
+import rundir_layout
 
 ##########################################################################
 #
@@ -16,46 +23,40 @@ import tarfile
 
 #
 # validate() confirms that a set of files necessary to analyze
-#  an Illumina run directory exist and have non-zero size.
+#  an Illumina run directory exist.
 #
-def validate(rundir, cif=False, verbose=False):
+def validate(rundir, cif=False, verbose=False, threads=rundir_index.WALK_THREADS):
 
-    # Confirms non-zero-size existence of:
+    # Confirms existence of:
     #  Data/
     #  Data/Intensities
-    #  Data/Intensities/s_<lane>_00<tile>_pos.txt
-    #  Data/Intensities/L00<lane>
-    #  Data/Intensities/L00<lane>/C<cyc>.1
-    #  Data/Intensities/L00<lane>/C<cyc>.1/s_<lane>_<tile>.cif
-    #  Data/Intensities/BaseCalls
-    #  Data/Intensities/BaseCalls/config.xml
-    #  Data/Intensities/BaseCalls/s_<lane>_<tile>.filter
-    #  Data/Intensities/BaseCalls/L00<lane>
-    #  Data/Intensities/BaseCalls/L00<lane>/C<cyc>.1
-    #  Data/Intensities/BaseCalls/L00<lane>/C<cyc>.1/s_<lane>_<tile>.bcl
-    #  Data/Intensities/BaseCalls/L00<lane>/C<cyc>.1/s_<lane>_<tile>.stats
+    #  the files of the run's layout under Data/Intensities (see rundir_layout.py), e.g. for HiSeq:
+    #   Data/Intensities/L00<lane>/s_<lane>_<tile>.clocs
+    #   Data/Intensities/L00<lane>/C<cyc>.1/s_<lane>_<tile>.cif  [if cif]
+    #   Data/Intensities/BaseCalls/config.xml
+    #   Data/Intensities/BaseCalls/L00<lane>/s_<lane>_<tile>.filter
+    #   Data/Intensities/BaseCalls/L00<lane>/C<cyc>.1/s_<lane>_<tile>.bcl
+    #   Data/Intensities/BaseCalls/L00<lane>/C<cyc>.1/s_<lane>_<tile>.stats
+    #  and the directories they are in.
+    #
+    # The directories of the layout are listed once up front (see rundir_index.py),
+    # and missing files are found as set differences on the index.
     #
 
     # This constant denotes how many items to print in verbose
     # mode before saying "and a bunch more..."
     MAX_VERBOSE_COUNT = 20
 
-    lane_list = rundir.get_lane_list()
-    if lane_list is None:
-        # Platform is unknown -- what do we do?
-        print >> sys.stderr, "validate(): %s: Platform Unknown" % rundir.get_dir()
-        return False
-
-    tile_list = rundir.get_tile_list()
-
-    if tile_list is None:
-        # Platform is unknown -- what do we do?
-        print >> sys.stderr, "validate(): %s: Platform unknown" % rundir.get_dir()
-        return False
-
-    total_cycles = sum(rundir.get_cycle_list())
+    def print_items(items):
+        if verbose:
+            for item in items[0:MAX_VERBOSE_COUNT]: print >> sys.stderr, item
+            if len(items) > MAX_VERBOSE_COUNT:
+                print >> sys.stderr, "[...%d more items]" % (len(items) - MAX_VERBOSE_COUNT)
 
-    exit_status = True
+    def intensities_subpath(rel_path):
+        if rel_path:
+            return "Data/Intensities/" + rel_path
+        return "Data/Intensities"
 
     # Confirm that the "Data/" directory exists.
     data_path = os.path.join(rundir.get_path(), "Data")
@@ -69,251 +70,68 @@ def validate(rundir, cif=False, verbose=False):
         print >> sys.stderr, "validate(): %s: No Intensities directory" % rundir.get_dir()
         return False
 
-    missing_position_files = []
-    missing_lane_dirs = []
-    for lane in lane_list:
-        # GA, HCS 1.1.37: Confirm that the 's_<lane>_00<tile>_pos.txt' files exist in Data/Intensities/.
-        if (rundir.get_platform() == rundir.PLATFORM_ILLUMINA_GA or
-            (rundir.get_platform() == rundir.PLATFORM_ILLUMINA_HISEQ and rundir.get_control_software_version_integer() < 1308)):
-            intensities_files = os.listdir(intensities_path)
-            for tile in tile_list:
-                pos_file = "s_%d_%04d_pos.txt" % (lane, tile)
-                if pos_file not in intensities_files:
-                    missing_position_files.append(pos_file)
-
-        # Confirm that the Data/Intensities/L00<lane>/ directory exists.
-        intensities_lane_path = os.path.join(intensities_path, "L%03d" % lane)
-        if not os.path.exists(intensities_lane_path) or not os.path.isdir(intensities_lane_path):
-            missing_lane_dirs.append("L%03d" % lane)
-            continue
-
-        if verbose:
-            print >> sys.stderr, "validate(): Examining Data/Intensities/L%03d" % lane
-
-        # As of HCS 1.3.8: Confirm that the 's_<lane>_<tile>.clocs' files exist in Data/Intensities/L00<lane>.
-        intensities_lane_files = os.listdir(intensities_lane_path)
-        if (rundir.get_platform() == rundir.PLATFORM_ILLUMINA_HISEQ and rundir.get_control_software_version_integer() >= 1308):
-            for tile in tile_list:
-                 pos_file = "s_%d_%04d.clocs" % (lane, tile)
-                 if pos_file not in intensities_lane_files:
-                     missing_position_files.append(pos_file)
-
-        # MiSeq has .locs files in Data/Intensities/L001.
-        if (rundir.get_platform() == rundir.PLATFORM_ILLUMINA_MISEQ):
-            for tile in tile_list:
-                pos_file = "s_%d_%04d.locs" % (lane, tile)
-                if pos_file not in intensities_lane_files:
-                    missing_position_files.append(pos_file)
-
-        if cif:
-            missing_cycle_dirs = []
-            found_one_cif_file = False
-            for cyc in range(1, total_cycles+1):
-
-                # Confirm that the Data/Intensities/L00<lane>/C<cyc>.1/ directory exists.
-                intensities_lane_cycle_path = os.path.join(intensities_lane_path, "C%d.1" % cyc)
-                if not os.path.exists(intensities_lane_cycle_path) or not os.path.isdir(intensities_lane_cycle_path):
-                    missing_cycle_dirs.append("L%03d/C%d.1" % (lane, cyc))
-                    exit_status = False
-                    continue
-
-                if verbose:
-                    sys.stderr.write(".")
-
-                # Confirm that the Data/Intensities/L00<lane>/C<cyc>.1/s_<lane>_<tile>.cif files exist.
-                intensities_lane_cycle_files = os.listdir(intensities_lane_cycle_path)
-                missing_cif_files = []
-                for tile in tile_list:
-                    cif_file = "s_%d_%d.cif" % (lane, tile)
-                    # cif_path = os.path.join(intensities_lane_cycle_path, cif_file)
-                    # if not os.path.exists(cif_path) : # or os.path.getsize(cif_path) == 0:
-                    if cif_file not in intensities_lane_cycle_files:
-                        missing_cif_files.append("L%03d/C%d.1/%s" % (lane, cyc, cif_file))
-                        exit_status = False
-                    else:
-                        found_one_cif_file = True
-
-                if len(missing_cif_files) > 0 and found_one_cif_file:
-                    print >> sys.stderr, "validate(): %s: Missing %d Data/Intensities/L%03d/C%d.1 .cif files" % (rundir.get_dir(),len(missing_cif_files), lane, cyc)
-                    if verbose:
-                        for f in missing_cif_files[0:MAX_VERBOSE_COUNT]: print >> sys.stderr, f
-                        if len(missing_cif_files) > MAX_VERBOSE_COUNT:
-                            print >> sys.stderr, "[...%d more items]" % (len(missing_cif_files) - MAX_VERBOSE_COUNT)
-
-            if verbose:
-                print >> sys.stderr
-
-            if not found_one_cif_file:
-                print >> sys.stderr, "validate(): %s: No .cif files in lane L%03d" % (rundir.get_dir(), lane)
-
-            if len(missing_cycle_dirs) > 0:
-                exit_status = False
-                print >> sys.stderr, "validate(): %s: Missing %d Data/Intensities/L%03d cycle dirs" % (rundir.get_dir(),len(missing_cycle_dirs),lane)
-                if verbose:
-                    for d in missing_cycle_dirs[0:MAX_VERBOSE_COUNT]: print >> sys.stderr, d
-                    if len(missing_cycle_dirs) > MAX_VERBOSE_COUNT:
-                        print >> sys.stderr, "[...%d more items]" % (len(missing_cycle_dirs) - MAX_VERBOSE_COUNT)
-
-    if len(missing_position_files) > 0:
-        exit_status = False
-        if (rundir.get_platform() == rundir.PLATFORM_ILLUMINA_GA or
-            (rundir.get_platform() == rundir.PLATFORM_ILLUMINA_HISEQ and rundir.get_control_software_version_integer() <= 1137)): # "1.1.37"
-            position_file_ext = "_pos.txt"
-        elif (rundir.get_platform() == rundir.PLATFORM_ILLUMINA_HISEQ and rundir.get_control_software_version_integer() >= 1308):
-            position_file_ext = ".clocs"
-        elif (rundir.get_platform() == rundir.PLATFORM_ILLUMINA_MISEQ):
-            position_file_ext = ".locs"
-        else:
-            position_file_ext = "UNKNOWN POSITION"
-        print >> sys.stderr, "validate(): %s: Missing %d Data/Intensities %s files" % (rundir.get_dir(),len(missing_position_files),position_file_ext)
-        if verbose:
-            for f in missing_position_files[0:MAX_VERBOSE_COUNT]: print >> sys.stderr, f
-            if len(missing_position_files) > MAX_VERBOSE_COUNT:
-                print >> sys.stderr, "[...%d more items]" % (len(missing_position_files) - MAX_VERBOSE_COUNT)
-
-    if len(missing_lane_dirs) > 0:
-        exit_status = False
-        print >> sys.stderr, "validate(): %s: Missing %d Data/Intensities lane dirs"  % (rundir.get_dir(),len(missing_lane_dirs))
-        if verbose:
-            for d in missing_lane_dirs[0:MAX_VERBOSE_COUNT]: print >> sys.stderr, d
-            if len(missing_lane_dirs) > MAX_VERBOSE_COUNT:
-                print >> sys.stderr, "[...%d more items]" % (len(missing_lane_dirs) - MAX_VERBOSE_COUNT)
-
-
-    # Confirm that the "Data/Intensities/BaseCalls/" directory exists.
-    basecalls_path = os.path.join(intensities_path, "BaseCalls")
-    if not os.path.exists(basecalls_path) or not os.path.isdir(basecalls_path):
-        print >> sys.stderr, "validate(): %s: No BaseCalls directory" % rundir.get_dir()
+    layout = rundir_layout.get_layout(rundir, intensities_path)
+    if layout is None:
+        # Platform is unknown -- what do we do?
+        print >> sys.stderr, "validate(): %s: Run directory layout unknown" % rundir.get_dir()
         return False
 
-    if verbose:
-        print >> sys.stderr, "validate(): Examining Data/Intensities/BaseCalls"
-
-    basecalls_files = os.listdir(basecalls_path)
-
-    # Confirm that the "Data/Intensities/BaseCalls/config.xml" file exists.
-    #basecalls_config_file = os.path.join(basecalls_path, "config.xml")
-    #if not os.path.exists(basecalls_config_file):
-    if "config.xml" not in basecalls_files:
-        print >> sys.stderr, "validate(): %s: No BaseCalls/config.xml" % rundir.get_dir()
-        exit_status = False
-
-    # GA, HCS v 1.1.37.8: Confirm that .filter files exist in Data/Intensities/BaseCalls.
-    if (rundir.get_platform() == rundir.PLATFORM_ILLUMINA_GA or
-        (rundir.get_platform() == rundir.PLATFORM_ILLUMINA_HISEQ and rundir.get_control_software_version_integer() <= 1137)): # "1.1.37"
-        missing_filter_files = []
-        for lane in lane_list:
-            for tile in tile_list:
-                tile_prefix = "s_%d_%04d" % (lane, tile)
-
-                filter_file = tile_prefix + ".filter"
-                if filter_file not in basecalls_files:
-                    missing_filter_files.append(filter_file)
-
-        if len(missing_filter_files) > 0:
-            print >> sys.stderr, "validate(): %s: Missing %d Data/Intensities/BaseCalls/ .filter files" % (rundir.get_dir(),len(missing_filter_files))
-            if verbose:
-                for f in missing_filter_files[0:MAX_VERBOSE_COUNT]: print >> sys.stderr, f
-                if len(missing_filter_files) > MAX_VERBOSE_COUNT:
-                    print >> sys.stderr, "[...%d more items]" % (len(missing_filter_files) - MAX_VERBOSE_COUNT)
-
-    missing_lane_dirs = []
-    for lane in lane_list:
-        # Confirm that the Data/Intensities/BaseCalls/L00<lane>/ directory exists.
-        basecalls_lane_path = os.path.join(basecalls_path, "L%03d" % lane)
-        if not os.path.exists(basecalls_lane_path) or not os.path.isdir(basecalls_lane_path):
-            missing_lane_dirs.append("L%03d" % lane)
-            continue
-
-        if verbose:
-            print >> sys.stderr, "validate(): Examining Data/Intensities/BaseCalls/L%03d" % lane
-
-        basecalls_lane_files = os.listdir(basecalls_lane_path)
-
-        # As of HCS v 1.3.8: Confirm that .filter files exist in Data/Intensities/BaseCalls/L00<lane>.
-        if (rundir.get_platform() == rundir.PLATFORM_ILLUMINA_HISEQ and rundir.get_control_software_version_integer() >= 1308):
-            missing_filter_files = []
-            for tile in tile_list:
-                tile_prefix = "s_%d_%04d" % (lane, tile)
-
-                filter_file = tile_prefix + ".filter"
-                if filter_file not in basecalls_lane_files:
-                    missing_filter_files.append(filter_file)
-
-        missing_cycle_dirs = []
-        for cyc in range(1, total_cycles+1):
-            # Confirm that the Data/Intensities/BaseCalls/L00<lane>/C<cyc>.1/ directory exists.
-            basecalls_lane_cycle_dir  = "C%d.1" % cyc
-            basecalls_lane_cycle_path = os.path.join(basecalls_lane_path, basecalls_lane_cycle_dir)
-            #if not os.path.exists(basecalls_lane_cycle_path) or not os.path.isdir(basecalls_lane_cycle_path):
-            if basecalls_lane_cycle_dir not in basecalls_lane_files:
-                missing_cycle_dirs.append("L%03d/C%d.1" % (lane, cyc))
-                continue
-
-            if verbose:
-                sys.stderr.write(".")
-
-            basecalls_lane_cycle_files = os.listdir(basecalls_lane_cycle_path)
-
-            missing_bcl_files = []
-            missing_stats_files = []
-            for tile in tile_list:
-                tile_prefix = "s_%d_%d" % (lane, tile)
-
-                # Confirm that '.bcl' files exist in Data/Intensities/BaseCalls/L00<lane>/C<cyc>.1/
-                bcl_file = tile_prefix + ".bcl"
-                if bcl_file not in basecalls_lane_cycle_files:
-                    missing_bcl_files.append("L%03d/C%d.1/%s" % (lane, cyc, bcl_file))
-
-                # Confirm that '.stats' files exist in Data/Intensities/BaseCalls/L00<lane>/C<cyc>.1/
-                stats_file = tile_prefix + ".stats"
-                if stats_file not in basecalls_lane_cycle_files:
-                    missing_stats_files.append("L%03d/C%d.1/%s" % (lane, cyc, stats_file))
-
-            if len(missing_bcl_files) > 0:
-                exit_status = False
-                print >> sys.stderr, "validate(): %s: Missing %d Data/Intensities/BaseCalls/L%03d/C%d.1 .bcl files" % (rundir.get_dir(),len(missing_bcl_files),lane,cyc)
-                if verbose:
-                    for f in missing_bcl_files[0:MAX_VERBOSE_COUNT]: print >> sys.stderr, f
-                    if len(missing_bcl_files) > MAX_VERBOSE_COUNT:
-                        print >> sys.stderr, "[...%d more items]" % (len(missing_bcl_files) - MAX_VERBOSE_COUNT)
-
-            if len(missing_stats_files) > 0:
-                exit_status = False
-                print >> sys.stderr, "validate(): %s: Missing %d Data/Intensities/BaseCalls/L%03d/C%d.1 .stats files" % (rundir.get_dir(),len(missing_stats_files),lane,cyc)
-                if verbose:
-                    for f in missing_stats_files[0:MAX_VERBOSE_COUNT]: print >> sys.stderr, f
-                    if len(missing_stats_files) > MAX_VERBOSE_COUNT:
-                        print >> sys.stderr, "[...%d more items]" % (len(missing_stats_files) - MAX_VERBOSE_COUNT)
+    options = {'cif': cif}
+    file_specs = [spec for spec in layout.file_specs if spec.option is None or options.get(spec.option)]
+
+    # Get the lanes, cycles, tiles and surfaces the files of the layout are for.
+    fields = set()
+    for spec in file_specs:
+        if spec.per_lane: fields.add('lane')
+        if spec.per_cycle: fields.add('cycle')
+        if spec.unit: fields.add(spec.unit)
+    field_lists = {}
+    if 'lane' in fields:
+        field_lists['lane'] = rundir.get_lane_list()
+    if 'cycle' in fields:
+        field_lists['cycle'] = range(1, sum(rundir.get_cycle_list())+1)
+    if 'tile' in fields:
+        field_lists['tile'] = rundir.get_tile_list()
+    if 'surface' in fields:
+        field_lists['surface'] = rundir.get_surface_list()
+    for field in sorted(fields):
+        if not field_lists[field]:
+            print >> sys.stderr, "validate(): %s: No %s list for %s layout" % (rundir.get_dir(), field, layout.name)
+            return False
 
-        if verbose:
-            print >> sys.stderr
+    if verbose:
+        print >> sys.stderr, "validate(): Examining Data/Intensities (%s layout)" % layout.name
+
+    index = rundir_index.index_intensities(intensities_path, file_specs, threads=threads)
+
+    # Each missing file is reported under its directory, or if the directory is
+    #  missing too, under the highest missing directory above it.
+    missing_files = collections.OrderedDict()  # (directory, kind) -> names
+    missing_dirs = set()
+    for spec in file_specs:
+        missing = index.get_missing(spec, field_lists.get('lane'), field_lists.get('cycle'),
+                                    field_lists.get(spec.unit))
+        for key in sorted(missing):
+            rel_dir = spec.get_dir(key)
+            if index.has_dir(rel_dir):
+                missing_files.setdefault((rel_dir, spec.kind), []).append(spec.get_name(key))
+            else:
+                while os.path.dirname(rel_dir) and not index.has_dir(os.path.dirname(rel_dir)):
+                    rel_dir = os.path.dirname(rel_dir)
+                missing_dirs.add(rel_dir)
 
-        if len(missing_cycle_dirs) > 0:
-            exit_status = False
-            print >> sys.stderr, "validate(): %s: Missing %d Data/Intensities/BaseCalls/L%03d cycle dirs" % (rundir.get_dir(),len(missing_cycle_dirs),lane)
-            if verbose:
-                for d in missing_cycle_dirs[0:MAX_VERBOSE_COUNT]: print >> sys.stderr, d
-                if len(missing_cycle_dirs) > MAX_VERBOSE_COUNT:
-                    print >> sys.stderr, "[...%d more items]" % (len(missing_cycle_dirs) - MAX_VERBOSE_COUNT)
-
-        if ((rundir.get_platform() == rundir.PLATFORM_ILLUMINA_HISEQ and rundir.get_control_software_version_integer() >= 1308) and
-            len(missing_filter_files) > 0):
-            exit_status = False
-            print >> sys.stderr, "validate(): %s: Missing %d Data/Intensities/BaseCalls/L%03d .filter files" % (rundir.get_dir(),len(missing_filter_files),lane)
-            if verbose:
-                 for f in missing_filter_files[0:MAX_VERBOSE_COUNT]: print >> sys.stderr, f
-                 if len(missing_filter_files) > MAX_VERBOSE_COUNT:
-                     print >> sys.stderr, "[...%d more items]" % (len(missing_filter_files) - MAX_VERBOSE_COUNT)
+    for ((rel_dir, kind), names) in missing_files.items():
+        print >> sys.stderr, "validate(): %s: Missing %d %s %s files" % (rundir.get_dir(),len(names),intensities_subpath(rel_dir),kind)
+        print_items(names)
 
+    missing_dirs_by_parent = {}
+    for rel_dir in missing_dirs:
+        missing_dirs_by_parent.setdefault(os.path.dirname(rel_dir), []).append(rel_dir)
+    for (parent, rel_dirs) in sorted(missing_dirs_by_parent.items()):
+        print >> sys.stderr, "validate(): %s: Missing %d %s dirs" % (rundir.get_dir(),len(rel_dirs),intensities_subpath(parent))
+        print_items(sorted(rel_dirs))
 
-    if len(missing_lane_dirs) > 0:
-        exit_status = False
-        print >> sys.stderr, "validate(): %s: Missing %d Data/Intensities/BaseCalls lane dirs"  % (rundir.get_dir(),len(missing_lane_dirs))
-        if verbose:
-            for d in missing_lane_dirs[0:MAX_VERBOSE_COUNT]: print >> sys.stderr, d
-            if len(missing_lane_dirs) > MAX_VERBOSE_COUNT:
-                print >> sys.stderr, "[...%d more items]" % (len(missing_lane_dirs) - MAX_VERBOSE_COUNT)
+    exit_status = not missing_files and not missing_dirs
 
     rundir.validated = exit_status
 
@@ -424,7 +242,7 @@ def fix_missing_stats_files(rundir, verbose=False):
     return exit_status
 
 
-def make_thumbnail_subset_tar(rundir, overwrite=False, verbose=False):
+def make_thumbnail_subset_tar(rundir, overwrite=False, verbose=False, compress_level=None, compress_threads=None):
 
     tar_filename     = "Thumbnail_subset.tgz"
     tar_filename_tmp = tar_filename + ".tmp"
@@ -555,23 +373,30 @@ def make_thumbnail_subset_tar(rundir, overwrite=False, verbose=False):
         # Change current directory to rundir.
         os.chdir(rundir.get_path())
 
-        # Open tar file object.
-        tar_file = tarfile.open(tar_filename_tmp, "w:gz")
-        
-        # Add all the files from the file_subset list.
-        for f in file_subset:
-            tar_file.add(f)
+        try:
+            # Open tar file object, gzipped on all cores.
+            tar_file_out = open(tar_filename_tmp, "wb")
+            compressor = parallel_compress.open_compressor(tar_file_out, "gzip", compress_level, compress_threads)
+            tar_file = tarfile.open(fileobj=compressor, mode="w|")
 
-        # Close the tar.
-        tar_file.close()
+            # Add all the files from the file_subset list.
+            for f in file_subset:
+                tar_file.add(f)
 
-        # Move the temporary tar file into its final place.
-        if verbose:
-            print >> sys.stderr, "Moving %s to %s..." % (tar_filename_tmp,tar_filename)
-        os.rename(tar_filename_tmp, tar_filename)
+            # Close the tar.
+            tar_file.close()
+            compression_stats = compressor.close()
+            tar_file_out.close()
+            if verbose:
+                print >> sys.stderr, "Compressed %s: %s" % (tar_filename_tmp, compression_stats)
 
-        # Restore the saved current directory
-        os.chdir(saved_curdir)
+            # Move the temporary tar file into its final place.
+            if verbose:
+                print >> sys.stderr, "Moving %s to %s..." % (tar_filename_tmp,tar_filename)
+            os.rename(tar_filename_tmp, tar_filename)
+        finally:
+            # Restore the saved current directory
+            os.chdir(saved_curdir)
         
         return True
     else:
@@ -588,6 +413,9 @@ def make_thumbnail_subset_tar(rundir, overwrite=False, verbose=False):
 #   deleteAfter : Should we delete the run directory after archiving? (default = False)
 #   cif :       Should we also tar the Intensity files? (default = False: "go ahead and tar .cifs")
 #   sshSocket :   Which ssh socket file to use to stream the tar files? (default = None)
+#   compression : How to compress the tar, "gzip" (.tgz) or "zstd" (.tar.zst)? (default = "gzip")
+#   compressLevel : Compression level (default = None: the format's default)
+#   compressThreads : How many threads to compress with? (default = None: one per core)
 #   verbose :     Should we get chatty? (default = False)
 #   debug :       Should we talk about everything? (default = False)
 #
@@ -604,6 +432,7 @@ def make_archive_tar(rundir, **opts):
     ERROR_MKARCHTAR_TAR_FILE_LIST_COMPRESS = 7
     ERROR_MKARCHTAR_MD5_FILE               = 8
     ERROR_MKARCHTAR_INTEROP_TAR            = 9
+    ERROR_MKARCHTAR_COMPRESSION            = 10
 
     # Store defaults for all options.
     defaults = dict(destDir=rundir.get_root(),
@@ -611,6 +440,9 @@ def make_archive_tar(rundir, **opts):
                     deleteAfter=False,
                     cif=False,
                     sshSocket=None,
+                    compression="gzip",
+                    compressLevel=None,
+                    compressThreads=None,
                     verbose=False,
                     debug=False)
 
@@ -630,6 +462,13 @@ def make_archive_tar(rundir, **opts):
         if deflt not in opts.keys():
             opts[deflt] = defaults[deflt]
 
+    if not parallel_compress.is_format_available(opts['compression']):
+        print >> sys.stderr, "make_archive_tar(): Compression %s not available" % (opts['compression'])
+        return ERROR_MKARCHTAR_COMPRESSION  # ERROR compression not available
+    if not parallel_compress.is_level_valid(opts['compression'], opts['compressLevel']):
+        print >> sys.stderr, "make_archive_tar(): Invalid %s compression level %s" % (opts['compression'], opts['compressLevel'])
+        return ERROR_MKARCHTAR_COMPRESSION  # ERROR compression level out of range
+
     # Save frequently used options in variables.
     ssh_socket = opts['sshSocket']
     debug = opts['debug']
@@ -659,7 +498,7 @@ def make_archive_tar(rundir, **opts):
             ]
 
     # Create paths for the files we'll be creating.
-    compressed_tar_path = os.path.join(opts['destDir'], rundir.get_dir() + ".tgz")
+    compressed_tar_path = os.path.join(opts['destDir'], rundir.get_dir() + parallel_compress.get_extension(opts['compression']))
     compressed_tar_path_tmp = compressed_tar_path + ".tmp"
     list_tar_path = compressed_tar_path + ".list"
     list_tar_path_tmp = list_tar_path + ".tmp"
@@ -677,7 +516,13 @@ def make_archive_tar(rundir, **opts):
 
         # Check for thumbnail subset tar.  If not there, make it.
         if not os.path.exists(os.path.join(rundir.get_path(), THUMBNAIL_SUBSET_TAR)):
-            if not make_thumbnail_subset_tar(rundir, verbose=verbose):
+            # The thumbnail subset tar is always gzipped; a zstd level doesn't apply to it.
+            if opts['compression'] == "gzip":
+                thumbnail_compress_level = opts['compressLevel']
+            else:
+                thumbnail_compress_level = None
+            if not make_thumbnail_subset_tar(rundir, verbose=verbose, compress_level=thumbnail_compress_level,
+                                             compress_threads=opts['compressThreads']):
                 print >> sys.stderr, "make_archive_tar(): Couldn't make missing thumbnail subset tar...exiting..."
                 return ERROR_MKARCHTAR_THUMBNAIL_TAR  # ERROR Can't make thumbnail subset tar
 
@@ -696,7 +541,13 @@ def make_archive_tar(rundir, **opts):
             return ERROR_MKARCHTAR_SPOT_CHECK_ORIG  # ERROR Spot check failed
 
     #
-    # Make compressed tar file.
+    # Make compressed tar file, and its file list.
+    #
+    # The tar passes through here once, on its way to the file or to the ssh
+    # for copy to the remote machine. On the way it's compressed on all cores
+    # (see parallel_compress.py), checksummed, and fed to a local tar -tv to
+    # make the file list, so it isn't read back to list it or checksum it.
+    # (Rationale for the list: touch all the blocks in the tar to see if they are valid.)
     #
 
     # Check if compressed tar file already exists.
@@ -709,6 +560,15 @@ def make_archive_tar(rundir, **opts):
         else:
             already_have_compressed_tar = False
 
+    # The tar file list is made on this machine; only its compressed form is
+    # written to destDir.
+    if ssh_socket is None:
+        list_tar_path_local = list_tar_path_tmp
+    else:
+        (list_tar_fd, list_tar_path_local) = tempfile.mkstemp(prefix=rundir.get_dir() + ".", suffix=".tgz.list")
+        os.close(list_tar_fd)
+
+    compressed_tar_checksums = None
     if not already_have_compressed_tar:
         #
         # Compress and tar the directory into a temporary file.
@@ -720,81 +580,108 @@ def make_archive_tar(rundir, **opts):
         if not opts['cif']:
             tar_cmd_list.extend(["--exclude", "Data/Intensities/L00*/C*"])
 
-        tar_cmd_list.extend(["-c", "-z"])
-
-        if ssh_socket is None:
-            tar_cmd_list.extend(["-f", compressed_tar_path_tmp])
+        tar_cmd_list.append("-c")
 
         tar_cmd_list.append(rundir.get_dir())
 
         if verbose:
-            print >> sys.stderr, "make_archive_tar(): creating tar file for %s" % rundir.get_dir()
+            print >> sys.stderr, "make_archive_tar(): creating tar file and tar file listing for %s" % rundir.get_dir()
 
-        # If we have an ssh socket, pipe the tar into the ssh for copy to the remote machine.
         if ssh_socket is None:
-            if debug: print >> sys.stderr, "DEBUG: %s" % " ".join(tar_cmd_list)
-            retcode = subprocess.call(tar_cmd_list)
+            if debug: print >> sys.stderr, "DEBUG: %s > %s" % (" ".join(tar_cmd_list), compressed_tar_path_tmp)
+            (retcode, list_retcode, compressed_tar_checksums, compression_stats) = write_archive_stream(
+                tar_cmd_list, list_tar_path_local, out_path=compressed_tar_path_tmp,
+                compression=opts['compression'], level=opts['compressLevel'], threads=opts['compressThreads'])
         else:
             ssh_cmd_list = ["ssh", "-S", ssh_socket, "", "dd bs=1M of=%s" % (compressed_tar_path_tmp)]
 
             if debug: print >> sys.stderr, "DEBUG: %s | %s" % (" ".join(tar_cmd_list), " ".join(ssh_cmd_list))
-            tar_pipe_out = subprocess.Popen(tar_cmd_list, stdout=subprocess.PIPE)
-            retcode = subprocess.call(ssh_cmd_list, stdin=tar_pipe_out.stdout)
+            (retcode, list_retcode, compressed_tar_checksums, compression_stats) = write_archive_stream(
+                tar_cmd_list, list_tar_path_local, ssh_cmd_list=ssh_cmd_list,
+                compression=opts['compression'], level=opts['compressLevel'], threads=opts['compressThreads'])
 
         if retcode:
             print >> sys.stderr, "make_archive_tar(): Error creating tar file %s (ret = %d)" % (compressed_tar_path_tmp, retcode)
+            os.remove(list_tar_path_local)
             return ERROR_MKARCHTAR_TAR_FILE  # ERROR Couldn't create tar file.
 
+        if verbose:
+            print >> sys.stderr, "make_archive_tar(): compressed tar file for %s: %s" % (rundir.get_dir(), compression_stats)
+
         # Rename the temporary file to the final compressed tar file name.
         if ssh_socket is None:
             os.rename(compressed_tar_path_tmp, compressed_tar_path)
         else:
             if not remote_rename(ssh_socket, compressed_tar_path_tmp, compressed_tar_path):
                 print >> sys.stderr, "make_archive_tar(): Error renaming tar file %s" % (compressed_tar_path_tmp)
+                os.remove(list_tar_path_local)
                 return ERROR_MKARCHTAR_TAR_FILE  # ERROR Couldn't create tar file.
             
     else:
         print >> sys.stderr, "make_archive_tar(): Compressed tar file %s already exists...skipping creation..." % (compressed_tar_path)
 
+        # List the existing tar file where it is.
+        if verbose:
+            print >> sys.stderr, "make_archive_tar(): creating tar file listing for %s" % rundir.get_dir()
+
+        list_tar_cmd_list = ["tar"] + parallel_compress.get_tar_list_options(opts['compression']) + ["-f", compressed_tar_path]
+        if ssh_socket is not None:
+            list_tar_cmd_list = ["ssh", "-S", ssh_socket, "", " ".join(list_tar_cmd_list)]
+        if debug: print >> sys.stderr, "DEBUG: %s > %s" % (" ".join(list_tar_cmd_list), list_tar_path_local)
+        list_tar_file_out = open(list_tar_path_local, "w")
+        list_retcode = subprocess.call(list_tar_cmd_list, stdout=list_tar_file_out)
+        list_tar_file_out.close()
+
+    if list_retcode:
+        print >> sys.stderr, "make_archive_tar(): Error creating tar file list %s (ret = %d)" % (list_tar_path_local, list_retcode)
+        os.remove(list_tar_path_local)
+        return ERROR_MKARCHTAR_TAR_FILE_LIST  # ERROR Couldn't create tar file list
+
     #
-    # Make list of files in tar.
-    # (Rationale: touch all the blocks in the tar to see if they are valid.)
+    # Compress the tar file list into a temporary file, and spot-check it for
+    # some files in the same read.
+    # (Rationale: confirm that at least some interesting files made it in.)
     #
+    if verbose:
+        print >> sys.stderr, "make_archive_tar(): compressing tar list file for %s" % rundir.get_dir()
+
+    if opts['fileCheck']:
+        spot_check_paths = [rundir.get_dir() + "/" + f
+                            for file in SPOT_CHECK_FILES
+                            for f in (file if isinstance(file,list) else [file])]
+    else:
+        spot_check_paths = []
 
-    # Check for existing tar file list.
     if ssh_socket is None:
-        already_have_tar_file_list = os.path.isfile(list_tar_path)
+        compress_list_proc = None
+        compressed_list_tar_file = open(compressed_list_tar_path_tmp, "wb")
     else:
-        list_tar_size = remote_stat(ssh_socket, list_tar_path, verbose=opts['verbose'])
-        already_have_tar_file_list = (list_tar_size is not None)
+        compress_list_cmd_list = ["ssh", "-S", ssh_socket, "",
+                                  "unset noclobber ; cat > %s" % (compressed_list_tar_path_tmp)]
+        if debug: print >> sys.stderr, "DEBUG: %s" % " ".join(compress_list_cmd_list)
+        compress_list_proc = subprocess.Popen(compress_list_cmd_list, stdin=subprocess.PIPE)
+        compressed_list_tar_file = compress_list_proc.stdin
 
-    if already_have_tar_file_list:
-        if verbose:
-            print >> sys.stderr, "make_archive_tar(): Tar file list %s already exists...overwriting..." % (list_tar_path)
+    retcode = 0
+    try:
+        found_paths = compress_tar_list(list_tar_path_local, compressed_list_tar_file,
+                                        os.path.basename(list_tar_path), spot_check_paths)
+        compressed_list_tar_file.close()
+    except IOError, e:
+        print >> sys.stderr, "make_archive_tar(): Error writing %s: %s" % (compressed_list_tar_path_tmp, e)
+        retcode = 1
+    if compress_list_proc is not None:
+        retcode = compress_list_proc.wait() or retcode
 
+    # Remove the uncompressed tar list file.
     if verbose:
-        print >> sys.stderr, "make_archive_tar(): creating tar file listing for %s" % rundir.get_dir()
-
-    if ssh_socket is None:
-        list_tar_file_out = open(list_tar_path_tmp, "w")
-        list_tar_cmd_list = ["tar", "-tvz", "-f", compressed_tar_path]
-        if debug: print >> sys.stderr, "DEBUG: %s" % " ".join(list_tar_cmd_list)
-        retcode = subprocess.call(list_tar_cmd_list, stdout=list_tar_file_out)
-        list_tar_file_out.close()
-    else:
-        list_tar_cmd_list = ["ssh", "-S", ssh_socket, "",
-                             "tar -tvz -f %s --index-file=%s" % (compressed_tar_path, list_tar_path_tmp)]
-        if debug: print >> sys.stderr, "DEBUG: %s" % " ".join(list_tar_cmd_list)
-        retcode = subprocess.call(list_tar_cmd_list)
+        print >> sys.stderr, "make_archive_tar(): removing uncompressed tar list file for %s" % rundir.get_dir()
+    os.remove(list_tar_path_local)
 
     if retcode:
-        print >> sys.stderr, "make_archive_tar(): Error creating tar file list %s (ret = %d)" % (list_tar_path_tmp, retcode)
-        return ERROR_MKARCHTAR_TAR_FILE_LIST  # ERROR Couldn't create tar file list
-    
-    #
-    # Spot-check the tar file list for some files.
-    # (Rationale: confirm that at least some interesting files made it in.)
-    #
+        print >> sys.stderr, "make_archive_tar(): Error compressing tar list file %s (ret = %d)" % (list_tar_path, retcode)
+        return ERROR_MKARCHTAR_TAR_FILE_LIST_COMPRESS  # ERROR compressing tar file list.
+
     if opts['fileCheck']:
         for file in SPOT_CHECK_FILES:
 
@@ -805,18 +692,10 @@ def make_archive_tar(rundir, **opts):
 
             found_file = False
             for f in files_to_check:
-                if ssh_socket is None:
-                    fgrep_cmd_list = ["fgrep", "-q", rundir.get_dir() + "/" + f, list_tar_path_tmp]
-                else:
-                    fgrep_cmd_list = ["ssh", "-S", ssh_socket, "",
-                                      "fgrep -q %s %s" % (rundir.get_dir() + "/" + f, list_tar_path_tmp)]
-
                 if verbose:
                     print >> sys.stderr, "make_archive_tar(): looking in tar file list for %s" % f,
 
-                retcode = subprocess.call(fgrep_cmd_list)
-
-                if not retcode:
+                if rundir.get_dir() + "/" + f in found_paths:
                     found_file = True
                     if verbose: print >> sys.stderr, "found"
                 else:
@@ -824,44 +703,15 @@ def make_archive_tar(rundir, **opts):
 
             if not found_file:
                 print >> sys.stderr, "make_archive_tar(): Tar file list is missing %s" % (file)
+                if ssh_socket is None:
+                    os.remove(compressed_list_tar_path_tmp)
+                else:
+                    remote_remove(ssh_socket, compressed_list_tar_path_tmp)
                 return ERROR_MKARCHTAR_SPOT_CHECK_LIST  # ERROR Spot check tar file list failed.
     else:
         if verbose:
             print >> sys.stderr, "make_archive_tar(): skipping file check for %s" % rundir.get_dir()
 
-    #
-    # File check above confirms proper creation of .tgz.list_tmp file: compress it.
-    #
-
-    # Compress the tar list temporary file into its final file.
-    if verbose:
-        print >> sys.stderr, "make_archive_tar(): compressing tar list file for %s" % rundir.get_dir()
-
-    if ssh_socket is None:
-        compressed_list_tar_file = open(compressed_list_tar_path_tmp, "w")
-        compress_list_cmd_list = ["gzip", "-c", list_tar_path_tmp]
-        if debug: print >> sys.stderr, "DEBUG: %s" % " ".join(compress_list_cmd_list)
-        retcode = subprocess.call(compress_list_cmd_list, stdout=compressed_list_tar_file)
-        compressed_list_tar_file.close()
-    else:
-        compress_list_cmd_list = ["ssh", "-S", ssh_socket, "",
-                                  "unset noclobber ; gzip -c %s > %s" % (list_tar_path_tmp, compressed_list_tar_path_tmp) ]
-        if debug: print >> sys.stderr, "DEBUG: %s" % " ".join(compress_list_cmd_list)
-        retcode = subprocess.call(compress_list_cmd_list)
-
-    if retcode:
-        print >> sys.stderr, "make_archive_tar(): Error compressing tar list file %s (ret = %d)" % (list_tar_path, retcode)
-        return ERROR_MKARCHTAR_TAR_FILE_LIST_COMPRESS  # ERROR compressing tar file list.
-
-    # Remove the original tar list file.
-    if verbose:
-        print >> sys.stderr, "make_archive_tar(): removing uncompressed tar list file for %s" % rundir.get_dir()
-    if ssh_socket is None:
-        os.remove(list_tar_path_tmp)
-    else:
-        if not remote_remove(ssh_socket, list_tar_path_tmp):
-            print >> sys.stderr, "make_archive_tar(): FAILED to remove uncompressed tar list file for %s" % rundir.get_dir()
-
     # Rename the temporary compressed tar list file to the final tar list file name.
     if verbose:
         print >> sys.stderr, "make_archive_tar(): renaming compressed tar list file for %s" % rundir.get_dir()
@@ -887,20 +737,19 @@ def make_archive_tar(rundir, **opts):
     if verbose:
         print >> sys.stderr, "make_archive_tar(): creating MD5 checksum file listing for %s compressed tar" % rundir.get_dir()
 
-    if ssh_socket is None:
-        if platform.system() == "Linux":
-            md5_cmd_list = ["md5sum"]
-        elif platform.system() == "Darwin":
-            md5_cmd_list = ["md5", "-r"]
-        else:
-            md5_cmd_list = ["md5sum"]
-
-        md5_cmd_list.append(compressed_tar_path)
-
-        md5_file = open(md5_path_tmp, "w")
-        if debug: print >> sys.stderr, "DEBUG: %s" % " ".join(md5_cmd_list)
-        retcode = subprocess.call(md5_cmd_list, stdout=md5_file)
-        md5_file.close()
+    # The compressed tar was checksummed as it was made; one made by an
+    # earlier call has to be read again.
+    if compressed_tar_checksums is None and ssh_socket is None:
+        if debug: print >> sys.stderr, "DEBUG: checksumming %s" % compressed_tar_path
+        compressed_tar_checksums = checksum.checksum_file(compressed_tar_path)
+
+    if compressed_tar_checksums is not None:
+        # In md5sum's format.
+        md5_line = "%s  %s\n" % (compressed_tar_checksums.get_md5(), compressed_tar_path)
+        retcode = write_small_file(md5_path_tmp, md5_line, ssh_socket)
+        if not retcode:
+            retcode = write_small_file(checksum.get_checksums_path(compressed_tar_path),
+                                       checksum.format_checksums(compressed_tar_checksums), ssh_socket)
     else:
         #
         # ASSUMPTION: an ssh socket will be into a Linux machine.
@@ -994,6 +843,122 @@ def make_archive_tar(rundir, **opts):
     return ERROR_MKARCHTAR_NO_ERROR
 
 
+def write_archive_stream(cmd_list, list_path, out_path=None, ssh_cmd_list=None,
+                         compression="gzip", level=None, threads=None):
+    """
+    Function : Runs cmd_list, which writes a tar to its stdout, compresses the tar, and
+               writes it to out_path or to the stdin of ssh_cmd_list. On the way the
+               compressed tar is checksummed, and listed by tar -tv into list_path.
+    Args     : compression, level, threads - as for parallel_compress.open_compressor().
+    Returns  : (retcode, list_retcode, checksums, compression_stats) - retcode is nonzero
+               if either command failed or the tar couldn't be written, list_retcode if it
+               couldn't be listed.
+    """
+    proc = subprocess.Popen(cmd_list, stdout=subprocess.PIPE)
+    if ssh_cmd_list is None:
+        ssh_proc = None
+        out = open(out_path, "wb")
+    else:
+        ssh_proc = subprocess.Popen(ssh_cmd_list, stdin=subprocess.PIPE)
+        out = ssh_proc.stdin
+    list_file = open(list_path, "w")
+    list_proc = subprocess.Popen(["tar"] + parallel_compress.get_tar_list_options(compression) + ["-f", "-"],
+                                 stdin=subprocess.PIPE, stdout=list_file)
+    list_file.close()
+    archive_out = ArchiveOutput(out, checksum.MultiHasher(), list_proc.stdin)
+    compressor = parallel_compress.open_compressor(archive_out, compression, level, threads)
+    compression_stats = None
+    write_error = False
+    try:
+        while True:
+            data = proc.stdout.read(checksum.CHUNK_SIZE)
+            if not data:
+                break
+            compressor.write(data)
+        compression_stats = compressor.close()
+        out.close()
+    except IOError, e:
+        print >> sys.stderr, "write_archive_stream(): Error writing %s: %s" % (out_path or " ".join(ssh_cmd_list), e)
+        write_error = True
+        proc.kill()
+    finally:
+        if compression_stats is None:
+            compressor.abort()
+        checksums = archive_out.close()
+    retcode = proc.wait()
+    if ssh_proc is not None:
+        retcode = retcode or ssh_proc.wait()
+    if write_error:
+        retcode = retcode or 1
+    list_retcode = list_proc.wait()
+    if archive_out.list_error:
+        list_retcode = list_retcode or 1
+    return (retcode, list_retcode, checksums, compression_stats)
+
+class ArchiveOutput:
+    """
+    Writes a compressed tar to out, checksums it with hasher, and feeds it to list_in, the
+    stdin of a tar -tv.
+    """
+
+    def __init__(self, out, hasher, list_in):
+        self.out = out
+        self.hasher = hasher
+        self.list_in = list_in
+        self.list_error = False
+
+    def write(self, data):
+        self.out.write(data)
+        self.hasher.update(data)
+        if not self.list_error:
+            try:
+                self.list_in.write(data)
+            except IOError:
+                # tar -tv gave up on the tar; its exit status says why.
+                self.list_error = True
+
+    def close(self):
+        """
+        Returns : The Checksums of the compressed tar.
+        """
+        try:
+            self.list_in.close()
+        except IOError:
+            self.list_error = True
+        return self.hasher.finish()
+
+def compress_tar_list(list_path, out, name, paths):
+    """
+    Function : gzips the tar file list at list_path to the file object out, and looks for
+               paths in it, as fgrep -q would, in the same read.
+    Args     : name - the file name recorded in the gzip header.
+    Returns  : The set of paths found in the list.
+    """
+    found = set()
+    gzip_file = gzip.GzipFile(filename=name, mode="wb", fileobj=out)
+    with open(list_path) as list_file:
+        for line in list_file:
+            gzip_file.write(line)
+            for path in paths:
+                if path not in found and path in line:
+                    found.add(path)
+    gzip_file.close()
+    return found
+
+def write_small_file(path, text, ssh_socket=None):
+    """
+    Function : Writes text to path, locally or through ssh_socket.
+    Returns  : 0, or the nonzero exit status of the ssh if it failed.
+    """
+    if ssh_socket is None:
+        with open(path, "w") as f:
+            f.write(text)
+        return 0
+    ssh_proc = subprocess.Popen(["ssh", "-S", ssh_socket, "", "unset noclobber ; cat > %s" % (path)],
+                                stdin=subprocess.PIPE)
+    ssh_proc.communicate(text)
+    return ssh_proc.returncode
+
 def remote_stat(ssh_socket, remote_file, verbose=False):
     stat_ssh_cmd_list = ["ssh", "-S", ssh_socket, "", "stat --format=%%s %s" % (remote_file)]
 
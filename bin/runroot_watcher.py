@@ -0,0 +1,301 @@
+#!/usr/bin/env python
+
+###############################################################################
+#
+# runroot_watcher.py - Wake the autocopy main loop as soon as something
+#   interesting happens in a run root, instead of always sleeping for
+#   MAIN_LOOP_DELAY_SECONDS.
+#
+# Two mechanisms are used:
+#   inotify - Linux kernel notifications (via ctypes, no extra packages).
+#             Used for run roots on local filesystems.
+#   poll    - Compare directory mtimes every poll_seconds. Used for run roots
+#             on network filesystems (NFS, CIFS, ...) where inotify does not
+#             see changes made by other hosts, or when inotify is unavailable.
+#
+# Either way, the loop wakes when a new run directory (matching rundir_reg)
+# appears, or when a status sentinel file is written into a run directory.
+#
+###############################################################################
+
+import os
+import sys
+import time
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+
+class RunRootWatcher:
+
+    # Modes accepted for RUNROOT_WATCH_MODE.
+    MODE_INOTIFY = 'inotify'  # inotify where possible, poll network filesystems
+    MODE_POLL = 'poll'        # poll every run root
+    MODE_OFF = 'off'          # just sleep, as autocopy always did
+    MODES = [MODE_INOTIFY, MODE_POLL, MODE_OFF]
+
+    # Filesystem types (from /proc/mounts) where inotify can't be trusted.
+    NETWORK_FS_TYPES = ['nfs', 'nfs4', 'cifs', 'smbfs', 'smb3', 'afs', 'lustre', 'gpfs', 'fuse.sshfs']
+
+    # inotify constants from <sys/inotify.h>
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM  = 0x00000040
+    IN_MOVED_TO    = 0x00000080
+    IN_CREATE      = 0x00000100
+    IN_DELETE      = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_MOVE_SELF   = 0x00000800
+    IN_Q_OVERFLOW  = 0x00004000
+    IN_IGNORED     = 0x00008000
+    IN_ISDIR       = 0x40000000
+    IN_NONBLOCK    = 0x00000800
+    IN_CLOEXEC     = 0x00080000
+
+    RUNROOT_MASK = IN_CREATE | IN_MOVED_TO | IN_MOVED_FROM | IN_DELETE
+    RUNDIR_MASK = IN_MOVED_TO | IN_CLOSE_WRITE | IN_DELETE_SELF | IN_MOVE_SELF
+
+    EVENT_HEADER = struct.Struct('iIII')  # wd, mask, cookie, len
+    READ_SIZE = 64 * 1024
+
+    def __init__(self, run_roots, rundir_reg, status_files, mode=MODE_INOTIFY, poll_seconds=60, log=None):
+        """
+        Args : run_roots - list of run root directories to watch.
+               rundir_reg - compiled regex matching run directory names.
+               status_files - sentinel file names that should wake the loop.
+               mode - one of RunRootWatcher.MODES.
+               poll_seconds - how often to compare mtimes for polled run roots.
+               log - optional function taking a string, used for log messages.
+        """
+        if mode not in self.MODES:
+            raise ValueError("Invalid run root watch mode %s. Valid modes are %s" % (mode, self.MODES))
+        self.run_roots = list(run_roots)
+        self.rundir_reg = rundir_reg
+        self.status_files = set(f for f in status_files if f)
+        self.mode = mode
+        self.poll_seconds = poll_seconds
+        self.log = log or (lambda msg: sys.stderr.write(msg + '\n'))
+
+        self.inotify_fd = None
+        self.libc = None
+        self.watches = {}        # wd -> (run_root, dirname or None)
+        self.rundir_watches = {} # (run_root, dirname) -> wd
+        self.poll_roots = []
+        self.poll_mtimes = {}    # path -> mtime, for polled run roots and their run dirs
+
+        if self.mode == self.MODE_OFF:
+            return
+
+        if self.mode == self.MODE_INOTIFY:
+            self.initialize_inotify()
+
+        for run_root in self.run_roots:
+            if self.inotify_fd is not None and not self.is_network_fs(run_root):
+                self.add_runroot_watch(run_root)
+            elif self.mode != self.MODE_OFF:
+                self.poll_roots.append(run_root)
+        if self.poll_roots:
+            self.log("Polling run roots every %s seconds: %s" % (self.poll_seconds, ', '.join(self.poll_roots)))
+            self.poll_mtimes = self.get_poll_mtimes()
+
+    def close(self):
+        if self.inotify_fd is not None:
+            os.close(self.inotify_fd)
+            self.inotify_fd = None
+
+    def wait(self, timeout):
+        """
+        Function : Blocks for up to timeout seconds, returning early if a new run directory
+                   or a status sentinel file shows up in any run root.
+        Returns  : True if woken by a change, False if the timeout expired.
+        """
+        deadline = time.time() + timeout
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            if self.mode == self.MODE_OFF:
+                time.sleep(remaining)
+                return False
+            if self.poll_roots:
+                remaining = min(remaining, self.poll_seconds)
+
+            if self.inotify_fd is not None:
+                try:
+                    readable = select.select([self.inotify_fd], [], [], remaining)[0]
+                except select.error as e:
+                    if e.args[0] == errno.EINTR:
+                        continue
+                    raise
+                if readable and self.read_inotify_events():
+                    return True
+            else:
+                time.sleep(remaining)
+
+            if self.poll_roots and self.check_poll_mtimes():
+                return True
+
+    #
+    # inotify
+    #
+    def initialize_inotify(self):
+        if not sys.platform.startswith('linux'):
+            self.log("inotify is not available on %s; falling back to polling run roots" % sys.platform)
+            return
+        try:
+            self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            fd = self.libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        except (OSError, AttributeError) as e:
+            self.log("inotify is not available (%s); falling back to polling run roots" % e)
+            return
+        if fd < 0:
+            self.log("inotify_init1 failed (%s); falling back to polling run roots" % os.strerror(ctypes.get_errno()))
+            return
+        self.inotify_fd = fd
+
+    def add_watch(self, path, mask):
+        wd = self.libc.inotify_add_watch(self.inotify_fd, path, mask)
+        if wd < 0:
+            self.log("Could not watch %s: %s" % (path, os.strerror(ctypes.get_errno())))
+            return None
+        return wd
+
+    def add_runroot_watch(self, run_root):
+        wd = self.add_watch(run_root, self.RUNROOT_MASK)
+        if wd is None:
+            self.poll_roots.append(run_root)
+            return
+        self.watches[wd] = (run_root, None)
+        for dirname in os.listdir(run_root):
+            if self.rundir_reg.match(dirname) and os.path.isdir(os.path.join(run_root, dirname)):
+                self.add_rundir_watch(run_root, dirname)
+
+    def add_rundir_watch(self, run_root, dirname):
+        if (run_root, dirname) in self.rundir_watches:
+            return
+        wd = self.add_watch(os.path.join(run_root, dirname), self.RUNDIR_MASK)
+        if wd is not None:
+            self.watches[wd] = (run_root, dirname)
+            self.rundir_watches[(run_root, dirname)] = wd
+
+    def remove_rundir_watch(self, run_root, dirname):
+        wd = self.rundir_watches.pop((run_root, dirname), None)
+        if wd is not None:
+            self.watches.pop(wd, None)
+            self.libc.inotify_rm_watch(self.inotify_fd, wd)
+
+    def read_inotify_events(self):
+        """
+        Returns : True if any event read should wake the main loop.
+        """
+        wake = False
+        while True:
+            try:
+                buf = os.read(self.inotify_fd, self.READ_SIZE)
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EINTR):
+                    break
+                raise
+            if not buf:
+                break
+            offset = 0
+            while offset < len(buf):
+                (wd, mask, cookie, length) = self.EVENT_HEADER.unpack_from(buf, offset)
+                offset += self.EVENT_HEADER.size
+                name = buf[offset:offset + length].rstrip('\0')
+                offset += length
+                if self.handle_inotify_event(wd, mask, name):
+                    wake = True
+        return wake
+
+    def handle_inotify_event(self, wd, mask, name):
+        if mask & self.IN_Q_OVERFLOW:
+            # Events were dropped; a full pass will sort it out.
+            return True
+        if wd not in self.watches:
+            return False
+        (run_root, dirname) = self.watches[wd]
+
+        if mask & self.IN_IGNORED:
+            self.watches.pop(wd, None)
+            if dirname is not None:
+                self.rundir_watches.pop((run_root, dirname), None)
+            return False
+
+        if dirname is None:
+            # Event in a run root.
+            if not (mask & self.IN_ISDIR and self.rundir_reg.match(name)):
+                return False
+            if mask & (self.IN_CREATE | self.IN_MOVED_TO):
+                self.log("New run directory %s in %s" % (name, run_root))
+                self.add_rundir_watch(run_root, name)
+                return True
+            self.remove_rundir_watch(run_root, name)
+            return False
+
+        # Event in a run directory.
+        if mask & (self.IN_DELETE_SELF | self.IN_MOVE_SELF):
+            self.remove_rundir_watch(run_root, dirname)
+            return False
+        if name in self.status_files:
+            self.log("Status file %s written in %s" % (name, dirname))
+            return True
+        return False
+
+    #
+    # Polling
+    #
+    def is_network_fs(self, path):
+        """
+        Function : Looks up the filesystem type of path in /proc/mounts.
+        Returns  : True if path lives on a network filesystem.
+        """
+        try:
+            with open('/proc/mounts') as mounts:
+                entries = [line.split() for line in mounts]
+        except IOError:
+            return False
+        path = os.path.realpath(path)
+        best_mount = ''
+        best_type = None
+        for entry in entries:
+            if len(entry) < 3:
+                continue
+            mount_point = entry[1].replace('\\040', ' ')
+            if path == mount_point or path.startswith(mount_point.rstrip('/') + '/'):
+                if len(mount_point) >= len(best_mount):
+                    (best_mount, best_type) = (mount_point, entry[2])
+        return best_type in self.NETWORK_FS_TYPES
+
+    def get_poll_mtimes(self):
+        # Creating a run dir changes the run root mtime, and writing a
+        # sentinel file changes the run dir mtime, so one stat per directory
+        # is enough to notice either.
+        mtimes = {}
+        for run_root in self.poll_roots:
+            try:
+                mtimes[run_root] = os.stat(run_root).st_mtime
+                dirnames = os.listdir(run_root)
+            except OSError:
+                continue
+            for dirname in dirnames:
+                if not self.rundir_reg.match(dirname):
+                    continue
+                path = os.path.join(run_root, dirname)
+                try:
+                    mtimes[path] = os.stat(path).st_mtime
+                except OSError:
+                    pass
+        return mtimes
+
+    def check_poll_mtimes(self):
+        """
+        Returns : True if any polled run root or run directory changed since the last check.
+        """
+        mtimes = self.get_poll_mtimes()
+        changed = [path for (path, mtime) in mtimes.items() if self.poll_mtimes.get(path) != mtime]
+        self.poll_mtimes = mtimes
+        if changed:
+            self.log("Change detected in %s" % ', '.join(sorted(changed)))
+            return True
+        return False
@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+
+###############################################################################
+#
+# ssh_connection.py - Persistent ssh connections to the copy destination.
+#
+# Every remote operation of autocopy (the rsyncs, listing and verifying
+# the destination, touching the copy complete sentinel) used to open its
+# own ssh connection, paying for a handshake and a login on the cluster
+# head node each time. An SSHConnection instead keeps one ssh
+# ControlMaster connection open per host and user, and runs every command
+# as a session multiplexed over it. Commands that take an ssh command line,
+# like rsync -e, are given one that uses the master too.
+#
+# The master is started by the first command and kept for persist_seconds
+# after the last session closes (ControlPersist). Masters are left running
+# when autocopy stops, since copy processes that outlive autocopy (see
+# state_journal.py) may still be using them.
+#
+# The control socket path doesn't depend on the host's port or address, so
+# it can also be given to the rundir_utils functions that take sshSocket;
+# those archive helpers run their remote stat, checksum and writes over
+# whatever socket their caller supplies.
+#
+###############################################################################
+
+import os
+import time
+import tempfile
+import threading
+import subprocess
+
+CONTROL_DIR = tempfile.gettempdir()
+PERSIST_SECONDS = 600
+CHECK_SECONDS = 60   # How often get() checks that a connection is still alive
+CONNECT_TIMEOUT_SECONDS = 30
+SERVER_ALIVE_SECONDS = 30
+
+class SSHConnection:
+    """
+    A persistent connection to host, logged in as user.
+    """
+
+    def __init__(self, host, user, control_dir=CONTROL_DIR, persist_seconds=PERSIST_SECONDS):
+        self.host = host
+        self.user = user
+        self.control_path = os.path.join(control_dir, 'autocopy-ssh-%s@%s' % (user, host))
+        self.persist_seconds = persist_seconds
+        self.last_checked = None
+
+    def get_ssh_args(self):
+        return ['ssh', '-l', self.user,
+                '-o', 'ControlMaster=auto',
+                '-o', 'ControlPath=%s' % self.control_path,
+                '-o', 'ControlPersist=%d' % self.persist_seconds,
+                '-o', 'ConnectTimeout=%d' % CONNECT_TIMEOUT_SECONDS,
+                '-o', 'ServerAliveInterval=%d' % SERVER_ALIVE_SECONDS,
+                '-o', 'BatchMode=yes']
+
+    def get_ssh_command(self):
+        """
+        Returns : The ssh command line as one string, for rsync -e.
+        """
+        return ' '.join(self.get_ssh_args())
+
+    def is_alive(self):
+        """
+        Returns : True if the master connection is up.
+        """
+        with open(os.devnull, 'w') as devnull:
+            retcode = subprocess.call(['ssh', '-o', 'ControlPath=%s' % self.control_path,
+                                       '-O', 'check', self.host], stdout=devnull, stderr=devnull)
+        return retcode == 0
+
+    def connect(self, stderr=None):
+        """
+        Function : Starts the master connection if it isn't up, replacing a control socket
+                   left by a master that died.
+        Returns  : True if the master connection is up.
+        """
+        if self.is_alive():
+            return True
+        if os.path.exists(self.control_path):
+            os.remove(self.control_path)
+        return self.call(['true'], stderr=stderr) == 0
+
+    def ensure_connected(self, stderr=None):
+        """
+        Function : Checks the master connection, at most every CHECK_SECONDS, and reconnects
+                   it if it's down.
+        Returns  : True if the master connection is believed to be up.
+        """
+        now = time.time()
+        if self.last_checked is not None and now - self.last_checked < CHECK_SECONDS:
+            return True
+        connected = self.connect(stderr=stderr)
+        self.last_checked = now if connected else None
+        return connected
+
+    def call(self, remote_cmd, stdout=None, stderr=None):
+        """
+        Function : Runs remote_cmd, a list of words joined into a shell command on the host.
+        Returns  : The exit code of the command, or 255 if ssh failed.
+        """
+        return subprocess.call(self.get_ssh_args() + [self.host] + remote_cmd, stdout=stdout, stderr=stderr)
+
+    def check_output(self, remote_cmd, stderr=None):
+        """
+        Returns : (exit code, standard output) of remote_cmd.
+        """
+        proc = self.popen(remote_cmd, stderr=stderr)
+        output = proc.communicate()[0]
+        return (proc.returncode, output)
+
+    def popen(self, remote_cmd, stdin=None, stdout=subprocess.PIPE, stderr=None):
+        """
+        Returns : A Popen of remote_cmd, by default with its output on a pipe, for output
+                  too large to keep in memory.
+        """
+        return subprocess.Popen(self.get_ssh_args() + [self.host] + remote_cmd,
+                                stdin=stdin, stdout=stdout, stderr=stderr)
+
+    def touch(self, remote_file, stderr=None):
+        return self.call(['touch', remote_file], stderr=stderr) == 0
+
+class SSHConnectionPool:
+    """
+    The SSHConnections of autocopy, one per host and user, shared by its threads.
+    """
+
+    def __init__(self, control_dir=CONTROL_DIR, persist_seconds=PERSIST_SECONDS, log_file=None):
+        self.control_dir = control_dir
+        self.persist_seconds = persist_seconds
+        self.log_file = log_file
+        self.connections = {}  # (host, user) -> SSHConnection
+        self.lock = threading.Lock()
+
+    def get(self, host, user):
+        """
+        Returns : The SSHConnection to host as user, checked to be up. If it can't be
+                  connected its commands will fail, and get() tries again next time.
+        """
+        with self.lock:
+            if (host, user) not in self.connections:
+                if not os.path.isdir(self.control_dir):
+                    os.makedirs(self.control_dir, 0700)
+                self.connections[(host, user)] = SSHConnection(host, user, self.control_dir, self.persist_seconds)
+            connection = self.connections[(host, user)]
+            connection.ensure_connected(stderr=self.log_file)
+        return connection
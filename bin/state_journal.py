@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+
+###############################################################################
+#
+# state_journal.py - Remember autocopy's in-flight copies across restarts.
+#
+# Autocopy keeps as little state as it can (see the guidelines in
+# autocopy.py), but the copy processes it has started only exist in memory.
+# The journal is an append-only file of JSON lines, one per change to a
+# monitored run:
+#
+#   {"time": ..., "run_root": ..., "dir": ..., "event": "monitored"}
+#   {"time": ..., "run_root": ..., "dir": ..., "event": "copy_started",
+#    "pid": ..., "proc_start": ..., "copy_start_time": ...}
+#   {"time": ..., "run_root": ..., "dir": ..., "event": "copy_reset"}
+#   {"time": ..., "run_root": ..., "dir": ..., "event": "copy_completed",
+#    "copy_end_time": ..., "bytes": ...}
+#   {"time": ..., "run_root": ..., "dir": ..., "event": "forgotten"}
+#
+# On startup the journal is replayed into the latest state of each run and
+# then rewritten as one "monitored" record holding that state per run, so
+# it stays small. A line cut short by a crash is ignored.
+#
+###############################################################################
+
+import os
+import json
+import time
+import errno
+import signal
+import threading
+
+def get_process_start_time(pid):
+    """
+    Returns : The start time of process pid in clock ticks since boot, from /proc, to tell
+              it apart from a later process given the same pid. None if it isn't running
+              or /proc isn't available.
+    """
+    try:
+        with open('/proc/%d/stat' % pid) as f:
+            stat = f.read()
+    except IOError:
+        return None
+    # Field 22 (starttime), counting the fields after the parenthesized
+    # command name, which may itself contain spaces.
+    fields = stat[stat.rindex(')') + 2:].split()
+    return int(fields[19])
+
+def is_process_running(pid, proc_start=None):
+    """
+    Returns : True if pid is running and, when proc_start is given, is the same process
+              that was started then.
+    """
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        if e.errno != errno.EPERM:
+            return False
+    if proc_start is not None:
+        start = get_process_start_time(pid)
+        if start is not None and start != proc_start:
+            return False
+    return True
+
+class ReattachedProcess:
+    """
+    A copy process started by an earlier autocopy, found still running after a restart.
+    Provides the poll(), wait() and kill() of subprocess.Popen. The process is not a child
+    of this autocopy, so its exit status can't be known: poll() returns
+    UNKNOWN_RETURNCODE once it has exited.
+    """
+
+    UNKNOWN_RETURNCODE = -1
+    reattached = True
+
+    def __init__(self, pid, proc_start=None):
+        self.pid = pid
+        self.proc_start = proc_start
+        self.returncode = None
+
+    def poll(self):
+        if self.returncode is None and not is_process_running(self.pid, self.proc_start):
+            self.returncode = self.UNKNOWN_RETURNCODE
+        return self.returncode
+
+    def wait(self):
+        while self.poll() is None:
+            time.sleep(1)
+        return self.returncode
+
+    def kill(self):
+        if self.poll() is not None:
+            return
+        try:
+            if os.getpgid(self.pid) == self.pid:
+                # Leads its own group (DNAnexus uploads); stop its children too.
+                os.killpg(self.pid, signal.SIGTERM)
+            else:
+                os.kill(self.pid, signal.SIGTERM)
+        except OSError:
+            pass
+
+class StateJournal:
+
+    # Rewrite the journal after this many appended records.
+    COMPACT_AFTER_RECORDS = 10000
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.runs = {}  # (run_root, dir) -> latest state dict
+        self.records_since_compact = 0
+        self.replay()
+        self.compact()
+
+    def replay(self):
+        try:
+            f = open(self.path)
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                return
+            raise
+        with f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # Partly written when autocopy stopped
+                    continue
+                self.apply(record)
+
+    def apply(self, record):
+        key = (record['run_root'], record['dir'])
+        event = record['event']
+        if event == 'forgotten':
+            self.runs.pop(key, None)
+            return
+        state = self.runs.setdefault(key, {'run_root': record['run_root'], 'dir': record['dir']})
+        if event == 'monitored':
+            # Compacted records carry the run's whole state.
+            state.update((field, value) for (field, value) in record.items() if field not in ('time', 'event'))
+        elif event == 'copy_started':
+            state.update(pid=record['pid'], proc_start=record.get('proc_start'),
+                         copy_start_time=record['copy_start_time'])
+        elif event in ('copy_reset', 'copy_completed'):
+            for field in ('pid', 'proc_start', 'copy_start_time'):
+                state.pop(field, None)
+            if event == 'copy_completed':
+                state.update(copy_end_time=record.get('copy_end_time'), bytes=record.get('bytes'))
+
+    def get_runs(self):
+        """
+        Returns : A list of the latest state dicts of the runs being monitored, with keys
+                  run_root and dir, and pid, proc_start and copy_start_time while copying.
+        """
+        with self.lock:
+            return [dict(state) for state in self.runs.values()]
+
+    def record(self, run_root, dirname, event, **fields):
+        record = dict(fields)
+        record.update(time=time.time(), run_root=run_root, dir=dirname, event=event)
+        with self.lock:
+            self.apply(record)
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(record) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+            self.records_since_compact += 1
+            if self.records_since_compact >= self.COMPACT_AFTER_RECORDS:
+                self.compact_locked()
+
+    def compact(self):
+        with self.lock:
+            self.compact_locked()
+
+    def compact_locked(self):
+        # Rewrite the journal as one record per run, atomically.
+        tmp_path = '%s.tmp' % self.path
+        with open(tmp_path, 'w') as f:
+            for state in self.runs.values():
+                f.write(json.dumps(dict(time=time.time(), event='monitored', **state)) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_path, self.path)
+        self.records_since_compact = 0
@@ -0,0 +1,337 @@
+#!/usr/bin/env python
+
+###############################################################################
+#
+# tar_writer.py - Write tar archives of run directory subtrees in-process,
+#   instead of forking GNU tar.
+#
+# The directory walk is spread over a thread pool, one directory listing per
+# task, since a lane directory holds hundreds of thousands of small BCL and
+# filter files and a single-threaded walk spends most of its time waiting on
+# file metadata. File bodies are copied with sendfile(2) when writing to a
+# local file, and with large sequential reads otherwise.
+#
+# Given a checksum.MultiHasher, the archive is checksummed as it's written,
+# so it needn't be read again to checksum it. sendfile is then not used, as
+# the file bodies have to pass through the hasher.
+#
+# Archives are written the way `tar -C root -cf out members...` writes them:
+# GNU format headers, members in argument order, directories before their
+# contents, hard links stored as links, and the archive padded to 10240 byte
+# records. They extract to the same tree as a GNU tar archive, so
+# initiate_analysis and the bcl2fastq applet see no difference. Only the
+# order of entries within a directory differs (sorted here, readdir order
+# in GNU tar).
+#
+###############################################################################
+
+import os
+import sys
+import grp
+import pwd
+import stat
+import time
+import errno
+import ctypes
+import ctypes.util
+import tarfile
+from multiprocessing.pool import ThreadPool
+
+BLOCKSIZE = tarfile.BLOCKSIZE     # 512
+RECORDSIZE = tarfile.RECORDSIZE   # 10240, GNU tar's default blocking factor of 20
+
+WALK_THREADS = 8
+BUFFER_SIZE = 8 * 1024 * 1024
+SENDFILE_MIN_SIZE = 1024 * 1024   # Smaller files are read into the write buffer
+SENDFILE_MAX_COUNT = 0x7ffff000   # Linux transfers at most this much per sendfile call
+
+class TarStats:
+    """
+    Counts for one archive, for logging.
+    """
+
+    def __init__(self):
+        self.files = 0
+        self.bytes = 0
+        self.seconds = 0.0
+        self.missing = []   # members that could not be read, as GNU tar's "Cannot stat"
+        self.changed = []   # files that shrank while being archived
+
+    def __str__(self):
+        seconds = max(self.seconds, 0.001)
+        return '%d files, %d bytes in %.1f s (%.1f MB/s, %.0f files/s)' % (
+            self.files, self.bytes, self.seconds,
+            self.bytes / seconds / (1024 * 1024), self.files / seconds)
+
+def _load_sendfile():
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        sendfile = libc.sendfile
+    except (OSError, AttributeError):
+        return None
+    sendfile.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t]
+    sendfile.restype = ctypes.c_ssize_t
+    return sendfile
+
+_sendfile = _load_sendfile()
+
+def walk(root, members, threads=WALK_THREADS):
+    """
+    Function : Finds every path under the members of root, listing directories in parallel.
+    Args     : root - directory the member paths are relative to (tar -C).
+               members - list of paths relative to root.
+               threads - number of directory listings to run at once.
+    Returns  : (entries, missing), where entries is a list of (relative path, lstat result)
+               in archive order, and missing lists the paths that could not be read.
+    """
+    top = []
+    missing = []
+    for member in members:
+        try:
+            top.append((member, os.lstat(os.path.join(root, member))))
+        except OSError:
+            missing.append(member)
+
+    def list_dir(rel_dir):
+        children = []
+        try:
+            names = os.listdir(os.path.join(root, rel_dir))
+        except OSError:
+            return (rel_dir, None)
+        for name in sorted(names):
+            rel_path = os.path.join(rel_dir, name)
+            try:
+                children.append((rel_path, os.lstat(os.path.join(root, rel_path))))
+            except OSError:
+                # Removed since it was listed
+                pass
+        return (rel_dir, children)
+
+    # List one level of the tree per pass, every directory of the level in
+    # parallel, then put the entries back in depth-first order.
+    contents = {}
+    level = [rel_path for (rel_path, st) in top if stat.S_ISDIR(st.st_mode)]
+    pool = ThreadPool(processes=max(1, threads))
+    try:
+        while level:
+            next_level = []
+            for (rel_dir, children) in pool.map(list_dir, level):
+                if children is None:
+                    missing.append(rel_dir)
+                    children = []
+                contents[rel_dir] = children
+                next_level.extend(rel_path for (rel_path, st) in children if stat.S_ISDIR(st.st_mode))
+            level = next_level
+    finally:
+        pool.close()
+        pool.join()
+
+    entries = []
+    stack = list(reversed(top))
+    while stack:
+        (rel_path, st) = stack.pop()
+        entries.append((rel_path, st))
+        if stat.S_ISDIR(st.st_mode):
+            stack.extend(reversed(contents.get(rel_path, [])))
+    return (entries, missing)
+
+class TarWriter:
+    """
+    Writes tar headers and file bodies to an open file descriptor, or to any object
+    with a write() method (e.g. a dxpy.DXFile being uploaded), in buffer_size writes.
+    Everything written is also fed to hasher, if given.
+    """
+
+    def __init__(self, out, buffer_size=BUFFER_SIZE, hasher=None):
+        if isinstance(out, (int, long)):
+            self.fd = out
+            self.fileobj = None
+        else:
+            self.fd = None
+            self.fileobj = out
+        self.buffer_size = buffer_size
+        self.hasher = hasher
+        self.buffer = []
+        self.buffered = 0
+        self.offset = 0
+        self.hard_links = {}   # (st_dev, st_ino) -> first archived name
+        self.owner_names = {}  # (uid, gid) -> (uname, gname)
+
+    def add(self, root, rel_path, st, stats):
+        mode = st.st_mode
+        tarinfo = tarfile.TarInfo(rel_path)
+        tarinfo.mode = stat.S_IMODE(mode)
+        tarinfo.uid = st.st_uid
+        tarinfo.gid = st.st_gid
+        tarinfo.mtime = int(st.st_mtime)
+        (tarinfo.uname, tarinfo.gname) = self.get_owner_names(st.st_uid, st.st_gid)
+        size = 0
+        body = None
+        if stat.S_ISREG(mode):
+            key = (st.st_dev, st.st_ino)
+            if st.st_nlink > 1 and key in self.hard_links:
+                tarinfo.type = tarfile.LNKTYPE
+                tarinfo.linkname = self.hard_links[key]
+            else:
+                if st.st_nlink > 1:
+                    self.hard_links[key] = rel_path
+                tarinfo.type = tarfile.REGTYPE
+                size = st.st_size
+                if size:
+                    # Open before writing the header, so a file that has gone
+                    # away is skipped rather than leaving a header without a body.
+                    try:
+                        body = open(os.path.join(root, rel_path), 'rb')
+                    except IOError:
+                        stats.missing.append(rel_path)
+                        return
+        elif stat.S_ISDIR(mode):
+            tarinfo.type = tarfile.DIRTYPE
+        elif stat.S_ISLNK(mode):
+            tarinfo.type = tarfile.SYMTYPE
+            tarinfo.linkname = os.readlink(os.path.join(root, rel_path))
+        else:
+            # Sockets, fifos and devices don't occur in run directories;
+            # GNU tar would ignore sockets too.
+            return
+        tarinfo.size = size
+        self.write(tarinfo.tobuf(tarfile.GNU_FORMAT))
+        if body:
+            with body:
+                self.write_file_body(body, rel_path, size, stats)
+        stats.files += 1
+        stats.bytes += size
+
+    def get_owner_names(self, uid, gid):
+        if (uid, gid) not in self.owner_names:
+            try:
+                uname = pwd.getpwuid(uid).pw_name
+            except KeyError:
+                uname = ''
+            try:
+                gname = grp.getgrgid(gid).gr_name
+            except KeyError:
+                gname = ''
+            self.owner_names[(uid, gid)] = (uname, gname)
+        return self.owner_names[(uid, gid)]
+
+    def write_file_body(self, f, rel_path, size, stats):
+        copied = 0
+        if (self.fd is not None and _sendfile is not None and self.hasher is None and
+            size >= SENDFILE_MIN_SIZE):
+            self.flush()
+            copied = self.sendfile(f.fileno(), size)
+        while copied < size:
+            data = f.read(min(self.buffer_size, size - copied))
+            if not data:
+                break
+            self.write(data)
+            copied += len(data)
+        if copied < size:
+            # The header already promised size bytes; keep the archive
+            # readable, as GNU tar does for a file that shrank.
+            stats.changed.append(rel_path)
+            self.write_zeros(size - copied)
+        self.write_zeros(-size % BLOCKSIZE)
+
+    def sendfile(self, in_fd, count):
+        """
+        Returns : The number of bytes copied, less than count if the file shrank or
+                  sendfile is not supported for this pair of files.
+        """
+        copied = 0
+        while copied < count:
+            sent = _sendfile(self.fd, in_fd, None, min(count - copied, SENDFILE_MAX_COUNT))
+            if sent < 0:
+                err = ctypes.get_errno()
+                if err in (errno.EINTR, errno.EAGAIN):
+                    continue
+                if copied == 0 and err in (errno.EINVAL, errno.ENOSYS):
+                    break
+                raise OSError(err, os.strerror(err))
+            if sent == 0:
+                break
+            copied += sent
+        self.offset += copied
+        return copied
+
+    def write_zeros(self, count):
+        while count > 0:
+            chunk = min(count, self.buffer_size)
+            self.write('\0' * chunk)
+            count -= chunk
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.buffered += len(data)
+        self.offset += len(data)
+        if self.buffered >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        if not self.buffer:
+            return
+        data = ''.join(self.buffer)
+        self.buffer = []
+        self.buffered = 0
+        if self.hasher is not None:
+            self.hasher.update(data)
+        if self.fd is not None:
+            view = memoryview(data)
+            while view:
+                written = os.write(self.fd, view)
+                view = view[written:]
+        else:
+            for start in xrange(0, len(data), self.buffer_size):
+                self.fileobj.write(data[start:start + self.buffer_size])
+
+    def close(self):
+        # End of archive marker, then pad to a whole record.
+        self.write_zeros(2 * BLOCKSIZE)
+        self.write_zeros(-self.offset % RECORDSIZE)
+        self.flush()
+
+def write_tar(root, members, out, walk_threads=WALK_THREADS, buffer_size=BUFFER_SIZE, list_file=None,
+              hasher=None):
+    """
+    Function : Archives members of root, like `tar -C root -cf out members...`.
+    Args     : root - directory the member paths are relative to.
+               members - list of paths relative to root.
+               out - a path, which is written atomically through a temporary file,
+                     or an object with a write() method.
+               walk_threads - number of directory listings to run at once.
+               buffer_size - size of writes to out.
+               list_file - if given, archived paths are written to it, like tar -v.
+               hasher - if given, a checksum.MultiHasher fed the archive as it's written.
+    Returns  : A TarStats.
+    """
+    stats = TarStats()
+    start_time = time.time()
+    (entries, stats.missing) = walk(root, members, threads=walk_threads)
+    if isinstance(out, basestring):
+        tmp_path = '%s.tmp%d' % (out, os.getpid())
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0666)
+        try:
+            writer = TarWriter(fd, buffer_size, hasher)
+            write_entries(writer, root, entries, stats, list_file)
+            os.fsync(fd)
+        except:
+            os.close(fd)
+            os.remove(tmp_path)
+            raise
+        os.close(fd)
+        os.rename(tmp_path, out)
+    else:
+        writer = TarWriter(out, buffer_size, hasher)
+        write_entries(writer, root, entries, stats, list_file)
+    stats.seconds = time.time() - start_time
+    return stats
+
+def write_entries(writer, root, entries, stats, list_file):
+    for (rel_path, st) in entries:
+        writer.add(root, rel_path, st, stats)
+        if list_file:
+            list_file.write(rel_path + ('/' if stat.S_ISDIR(st.st_mode) else '') + '\n')
+    writer.close()
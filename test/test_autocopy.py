@@ -2,13 +2,18 @@
 
 DEBUG=True
 
+import datetime
 import grp
+import hashlib
 import os
 import pwd
 import re
 import shutil
 import sys
+import tarfile
 import tempfile
+from StringIO import StringIO
+from multiprocessing.pool import ThreadPool
 
 if sys.version_info[0:2] == (2, 6):
     import unittest2 as unittest
@@ -16,7 +21,11 @@ else:
     import unittest
 
 sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),'..'))
+from bin import autocopy
 from bin.autocopy import Autocopy
+from bin.autocopy import DNAnexusUpload
+from bin.autocopy import DNAnexusUploadError
+from bin.checksum import Checksums
 from bin.autocopy import ValidationError
 from bin.rundir import RunDir
 
@@ -35,6 +44,28 @@ class CopyProcHelper:
     def poll(self):
         return self.retcode
 
+class FakeDXFile:
+    # Stands in for the dxpy.DXFile returned by dxpy.new_dxfile,
+    # keeping the uploaded bytes in memory.
+
+    def __init__(self, **kwargs):
+        self.kwargs = kwargs
+        self.chunks = []
+        self.closed = False
+        self.properties = dict(kwargs.get('properties', {}))
+
+    def write(self, data):
+        self.chunks.append(data)
+
+    def close(self, block=False):
+        self.closed = True
+
+    def get_id(self):
+        return 'file-fake'
+
+    def set_properties(self, properties):
+        self.properties.update(properties)
+
 class TestAutocopy(unittest.TestCase):
 
     def setUp(self):
@@ -143,7 +174,7 @@ class TestAutocopy(unittest.TestCase):
         a.log_lims_error(error)
         a.log_connecting_to_mail_server()
         a.log_lost_smtp_connection()
-        a.log_reached_copy_processes_max(rundir)    
+        a.log_copy_postponed(rundir, 1)
         a.log_creating_copy_complete_sentinel_file(rundir, 'filename')
 
     def testLIMSConnection(self):
@@ -242,6 +273,42 @@ class TestAutocopy(unittest.TestCase):
         self.assertTrue(os.path.exists(dest_path))
         a.cleanup()
 
+    def testRestartCopyIsScheduled(self):
+        # The run copied into the temp run root by setUp, finished.
+        with open(os.path.join(self.test_run_path, 'RTAComplete.txt'), 'w') as f:
+            f.write('RTA complete\n')
+        a = Autocopy(log_file=self.tmp_file.name, no_email=True, test_mode_lims=True, config=self.config, errors_to_terminal=DEBUG)
+        a.update_rundirs_monitored()
+        rundir = a.get_rundir(dirname=self.test_run_name)
+        self.assertTrue(rundir.is_finished())
+        lims_runinfo = a.get_runinfo_from_lims(rundir)
+        killed = []
+        class StuckCopyProc:
+            def poll(self):
+                return None
+            def kill(self):
+                killed.append(rundir)
+        rundir.set_copy_proc_and_start_time(StuckCopyProc())
+        a.SECONDS_BEFORE_COPY_RESTART = 60
+        rundir.copy_start_time -= datetime.timedelta(seconds=120)
+        started = []
+        a.start_copy = lambda rundir, dnanexus: started.append(rundir)
+        # A worker thread of process_rundirs only stops the copy...
+        pool = ThreadPool(1)
+        try:
+            pool.apply(a.process_copying_rundir, (rundir, lims_runinfo))
+        finally:
+            pool.close()
+            pool.join()
+        self.assertEqual(killed, [rundir])
+        self.assertEqual(started, [])
+        # ...and the copy starts again from the main thread, through the scheduler.
+        self.assertTrue(a.is_rundir_ready_for_copy(rundir))
+        a.process_ready_for_copy_rundir(rundir, lims_runinfo)
+        a.start_scheduled_copies()
+        self.assertEqual(started, [rundir])
+        a.cleanup()
+
     def testUpdateRundirsMonitored(self):
         run_root = os.path.realpath(os.path.join(os.path.dirname(__file__), 'testdata', 'RunRoot0'))
         self.config.update({'COPY_SOURCE_RUN_ROOTS': [run_root]})
@@ -251,6 +318,173 @@ class TestAutocopy(unittest.TestCase):
         self.assertEqual(len(a.rundirs_monitored), n_valid_runs)
         a.cleanup()
 
+    def testUpdateRundirsMonitoredReusesRundirs(self):
+        a = Autocopy(log_file=self.tmp_file.name, no_email=True, test_mode_lims=True, config=self.config, errors_to_terminal=DEBUG)
+        a.update_rundirs_monitored()
+        rundir = a.get_rundir(run_root=self.run_root, dirname=self.test_run_name)
+        a.update_rundirs_monitored()
+        self.assertIs(a.get_rundir(run_root=self.run_root, dirname=self.test_run_name), rundir)
+
+        # A new run directory shows up on the next pass
+        new_run_name = '141126_PINKERTON_0343_BC4J1PACXX'
+        source = os.path.realpath(os.path.join(os.path.dirname(__file__), 'testdata', 'RunRoot0', new_run_name))
+        shutil.copytree(source, os.path.join(self.run_root, new_run_name))
+        a.runroot_scans.clear()
+        a.update_rundirs_monitored()
+        self.assertIsNotNone(a.get_rundir(run_root=self.run_root, dirname=new_run_name))
+        self.assertIs(a.get_rundir(run_root=self.run_root, dirname=self.test_run_name), rundir)
+        a.cleanup()
+
+    def testProcessRundirsConcurrently(self):
+        run_root = os.path.realpath(os.path.join(os.path.dirname(__file__), 'testdata', 'RunRoot0'))
+        self.config.update({'COPY_SOURCE_RUN_ROOTS': [run_root], 'MAX_RUNDIR_WORKERS': 2})
+        a = Autocopy(log_file=self.tmp_file.name, no_email=True, test_mode_lims=True, config=self.config, errors_to_terminal=DEBUG)
+        a.update_rundirs_monitored()
+        processed = []
+        def process_rundir(rundir):
+            if rundir.get_dir() == '141117_MONK_0387_AC4JCDACXX':
+                raise Exception('bad run')
+            processed.append(rundir.get_dir())
+        a.process_rundir = process_rundir
+        # One failing run must not keep the other from being processed
+        a.process_rundirs(list(a.rundirs_monitored))
+        self.assertEqual(processed, ['141126_PINKERTON_0343_BC4J1PACXX'])
+        a.cleanup()
+
+    def get_dnanexus_upload(self, a, rundir, tar_dir, upload_mode):
+        return DNAnexusUpload(rundir=rundir, tar_dir=tar_dir, LOG_FILE=a.LOG_FILE, initiate_analysis_script=None,
+                              lims_url=None, lims_token=None, test=True, upload_mode=upload_mode, viewers=[],
+                              contributors=[], administrators=[], dx_env_config=None, dx_workflow_config_dir=None,
+                              release=False, develop=True, region=None, upload_agent=None, ua_token='')
+
+    def testFindUploadedFileCachesLookups(self):
+        a = Autocopy(log_file=self.tmp_file.name, no_email=True, test_mode_lims=True, config=self.config, errors_to_terminal=DEBUG)
+        a.update_rundirs_monitored()
+        rundir = a.get_rundir(dirname=self.test_run_name)
+        upload = self.get_dnanexus_upload(a, rundir, self.run_root, 'API')
+        queries = []
+        def find_data_objects(**kwargs):
+            queries.append(kwargs['project'])
+            if kwargs['project'] != 'project-L1':
+                return []
+            return [{'id': 'file-interop', 'project': 'project-L1',
+                     'describe': {'name': 'run.InterOp.tar', 'properties': {'upload_complete': 'true'}}},
+                    {'id': 'file-lane', 'project': 'project-L1',
+                     'describe': {'name': 'run_L1.tar', 'properties': {'upload_complete': 'true'}}}]
+        clones = []
+        class DXFile:
+            def __init__(self, dxid, project):
+                self.dxid = dxid
+            def clone(self, project, folder, parents):
+                clones.append((self.dxid, project))
+        original = (autocopy.dxpy.find_data_objects, autocopy.dxpy.DXFile)
+        (autocopy.dxpy.find_data_objects, autocopy.dxpy.DXFile) = (find_data_objects, DXFile)
+        try:
+            signature = (1, 1)
+            # One query answers both files of the project folder
+            self.assertEqual(upload.find_uploaded_file('run.InterOp.tar', 'file', 'project-L1', '/raw_data', signature), 'file-interop')
+            self.assertEqual(upload.find_uploaded_file('run_L1.tar', 'file', 'project-L1', '/raw_data', signature), 'file-lane')
+            self.assertEqual(queries, ['project-L1'])
+            # The shared tar is cloned into the next lane's project instead of uploaded again
+            self.assertEqual(upload.find_uploaded_file('run.InterOp.tar', 'file', 'project-L2', '/raw_data', signature), 'file-interop')
+            self.assertEqual(clones, [('file-interop', 'project-L2')])
+            # ...but only if it is the same file
+            self.assertEqual(upload.find_uploaded_file('run.InterOp.tar', 'file', 'project-L2', '/raw_data', (2, 2)), None)
+        finally:
+            (autocopy.dxpy.find_data_objects, autocopy.dxpy.DXFile) = original
+        a.cleanup()
+
+    def testCheckUploadAgentParts(self):
+        a = Autocopy(log_file=self.tmp_file.name, no_email=True, test_mode_lims=True, config=self.config, errors_to_terminal=DEBUG)
+        a.update_rundirs_monitored()
+        rundir = a.get_rundir(dirname=self.test_run_name)
+        upload = self.get_dnanexus_upload(a, rundir, self.run_root, 'UploadAgent')
+        part_size = upload.UPLOAD_PART_SIZE
+        checksums = Checksums(2 * part_size + 1000, {'md5': 'whole'}, part_size, ['a', 'b', 'c'])
+        # The parts of an Upload Agent upload, made with --chunk-size from UPLOAD_PART_SIZE
+        parts = {'1': {'size': part_size, 'md5': 'a'},
+                 '2': {'size': part_size, 'md5': 'b'},
+                 '3': {'size': 1000, 'md5': 'c'}}
+        dxfiles = []
+        class DXFile(FakeDXFile):
+            def describe(self, fields):
+                return {'parts': parts}
+        def new_dxfile(**kwargs):
+            dxfiles.append(DXFile(**kwargs))
+            return dxfiles[-1]
+        original_dxfile = autocopy.dxpy.DXFile
+        autocopy.dxpy.DXFile = new_dxfile
+        try:
+            upload.check_upload('run_L1.tar', checksums, 'file-fake', 'project-fake')
+            self.assertEqual(dxfiles[-1].properties, {})
+            parts['2']['md5'] = 'x'
+            self.assertRaises(DNAnexusUploadError, upload.check_upload, 'run_L1.tar', checksums,
+                              'file-fake', 'project-fake')
+            self.assertEqual(dxfiles[-1].properties, {'upload_complete': 'false'})
+        finally:
+            autocopy.dxpy.DXFile = original_dxfile
+        a.cleanup()
+
+    def testStreamTarUpload(self):
+        a = Autocopy(log_file=self.tmp_file.name, no_email=True, test_mode_lims=True, config=self.config, errors_to_terminal=DEBUG)
+        a.update_rundirs_monitored()
+        rundir = a.get_rundir(dirname=self.test_run_name)
+        tar_dir = tempfile.mkdtemp()
+        upload = self.get_dnanexus_upload(a, rundir, tar_dir, 'Stream')
+        upload.STREAM_PART_SIZE = 1024
+        upload.find_uploaded_file = lambda *args: None
+        dxfiles = []
+        def new_dxfile(**kwargs):
+            dxfiles.append(FakeDXFile(**kwargs))
+            return dxfiles[-1]
+        corrupt_parts = []
+        property_updates = []
+        class DXFile:
+            # The uploaded file, as described by DNAnexus: an MD5 per part uploaded.
+            def __init__(self, dxid, project):
+                self.dxfile = dxfiles[-1]
+            def describe(self, fields):
+                data = ''.join(self.dxfile.chunks)
+                parts = {}
+                for (index, start) in enumerate(range(0, len(data), upload.STREAM_PART_SIZE), 1):
+                    part = data[start:start + upload.STREAM_PART_SIZE]
+                    parts[str(index)] = {'size': len(part), 'md5': hashlib.md5(part).hexdigest()}
+                for index in corrupt_parts:
+                    parts[index]['md5'] = hashlib.md5('corrupt').hexdigest()
+                return {'parts': parts}
+            def set_properties(self, properties):
+                property_updates.append(properties)
+                self.dxfile.set_properties(properties)
+        original = (autocopy.dxpy.new_dxfile, autocopy.dxpy.DXFile)
+        (autocopy.dxpy.new_dxfile, autocopy.dxpy.DXFile) = (new_dxfile, DXFile)
+        try:
+            dxid = upload.stream_tar_upload(upload.get_interop_tar_spec(), 'project-fake', '/raw_data')
+            # Verified against the MD5s of its parts before being marked complete
+            self.assertEqual(property_updates, [])
+            self.assertTrue(len(dxfiles[0].chunks) > 1)
+
+            # An upload whose parts don't match is left incomplete
+            corrupt_parts.append('2')
+            self.assertRaises(DNAnexusUploadError, upload.stream_tar_upload, upload.get_interop_tar_spec(),
+                              'project-fake', '/raw_data')
+            self.assertEqual(property_updates, [{'upload_complete': 'false'}])
+            self.assertEqual(dxfiles[1].properties['upload_complete'], 'false')
+        finally:
+            (autocopy.dxpy.new_dxfile, autocopy.dxpy.DXFile) = original
+
+        self.assertEqual(dxid, 'file-fake')
+        dxfile = dxfiles[0]
+        self.assertEqual(dxfile.kwargs['name'], '%s.InterOp.tar' % self.test_run_name)
+        self.assertTrue(dxfile.closed)
+        self.assertEqual(dxfile.properties['upload_complete'], 'true')
+        self.assertTrue(max(len(chunk) for chunk in dxfile.chunks) <= 1024)
+        # Nothing was written to the tar dir, and the streamed bytes are a valid tar
+        self.assertEqual(os.listdir(tar_dir), [])
+        streamed = tarfile.open(fileobj=StringIO(''.join(dxfile.chunks)))
+        self.assertTrue('RunInfo.xml' in streamed.getnames())
+        shutil.rmtree(tar_dir)
+        a.cleanup()
+
     def testAreFilesMissing(self):
         run_root = os.path.realpath(os.path.join(os.path.dirname(__file__), 'testdata', 'RunRoot0'))
         self.config.update({'COPY_SOURCE_RUN_ROOTS': [run_root]})
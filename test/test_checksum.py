@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+
+import gzip
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+
+if sys.version_info[0:2] == (2, 6):
+    import unittest2 as unittest
+else:
+    import unittest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),'..'))
+from bin import checksum
+from bin import rundir_utils
+from bin import tar_writer
+from bin.checksum import Checksums, MultiHasher
+
+class TestChecksum(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.data = os.urandom(250000)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def testMultiHasher(self):
+        hasher = MultiHasher(['md5', 'sha1'], part_size=100000)
+        for start in range(0, len(self.data), 30000):
+            hasher.update(self.data[start:start + 30000])
+        checksums = hasher.finish()
+        self.assertEqual(checksums.size, len(self.data))
+        self.assertEqual(checksums.hexdigests, {'md5': hashlib.md5(self.data).hexdigest(),
+                                                'sha1': hashlib.sha1(self.data).hexdigest()})
+        self.assertEqual(checksums.part_md5s, [hashlib.md5(self.data[start:start + 100000]).hexdigest()
+                                               for start in (0, 100000, 200000)])
+        self.assertEqual(checksum.get_default_hashes()[0], 'md5')
+
+    def testSidecar(self):
+        path = os.path.join(self.dir, 'L001.tar')
+        with open(path, 'wb') as f:
+            f.write(self.data)
+        checksums = checksum.checksum_file(path, part_size=100000, chunk_size=4096)
+        self.assertEqual(checksums.get_md5(), hashlib.md5(self.data).hexdigest())
+        self.assertEqual(checksum.read_checksums(path), None)
+        checksum.write_checksums(path, checksums)
+        self.assertEqual(checksum.read_checksums(path), checksums)
+        # Cut short
+        text = checksum.format_checksums(checksums)
+        self.assertEqual(checksum.parse_checksums(text[:text.index('md5')]), None)
+        # A sidecar of an older file of the same name
+        with open(path, 'ab') as f:
+            f.write('more')
+        self.assertEqual(checksum.read_checksums(path), None)
+
+    def testMatchParts(self):
+        checksums = Checksums(250, {'md5': 'whole'}, 100, ['a', 'b', 'c'])
+        self.assertTrue(checksum.match_parts(checksums, {'1': {'size': 100, 'md5': 'a'},
+                                                         '2': {'size': 100, 'md5': 'b'},
+                                                         '3': {'size': 50, 'md5': 'c'}}))
+        self.assertFalse(checksum.match_parts(checksums, {'1': {'size': 100, 'md5': 'a'},
+                                                          '3': {'size': 50, 'md5': 'c'},
+                                                          '2': {'size': 100, 'md5': 'x'}}))
+        self.assertEqual(checksum.match_parts(checksums, {'1': {'size': 200, 'md5': 'ab'},
+                                                          '2': {'size': 50, 'md5': 'c'}}), None)
+        self.assertTrue(checksum.match_parts(checksums, {'1': {'size': 250, 'md5': 'whole'}}))
+        self.assertFalse(checksum.match_parts(checksums, {'1': {'size': 100, 'md5': 'a'}}))
+
+    def testTarWhileHashing(self):
+        root = os.path.join(self.dir, 'run')
+        os.makedirs(root)
+        with open(os.path.join(root, 'big.bcl'), 'wb') as f:
+            f.write(os.urandom(tar_writer.SENDFILE_MIN_SIZE + 1000))
+        tar_path = os.path.join(self.dir, 'run.tar')
+        hasher = MultiHasher(part_size=1024 * 1024)
+        tar_writer.write_tar(root, ['big.bcl'], tar_path, hasher=hasher)
+        self.assertEqual(hasher.finish(), checksum.checksum_file(tar_path, part_size=1024 * 1024))
+
+    def testWriteArchiveStream(self):
+        os.makedirs(os.path.join(self.dir, 'run', 'InterOp'))
+        with open(os.path.join(self.dir, 'run', 'RunInfo.xml'), 'w') as f:
+            f.write('<RunInfo/>')
+        tar_cmd_list = ['tar', '-C', self.dir, '-c', 'run']
+        tgz_path = os.path.join(self.dir, 'run.tgz')
+        list_path = os.path.join(self.dir, 'run.tgz.list')
+        (retcode, list_retcode, checksums, stats) = rundir_utils.write_archive_stream(tar_cmd_list, list_path,
+                                                                                      out_path=tgz_path, threads=2)
+        self.assertEqual((retcode, list_retcode), (0, 0))
+        self.assertEqual(stats.bytes_out, os.path.getsize(tgz_path))
+        self.assertEqual(checksums.get_md5(), hashlib.md5(open(tgz_path, 'rb').read()).hexdigest())
+        self.assertEqual(len(open(list_path).readlines()), 3)
+
+        list_gz_path = list_path + '.gz'
+        with open(list_gz_path, 'wb') as out:
+            found = rundir_utils.compress_tar_list(list_path, out, 'run.tgz.list',
+                                                   ['run/RunInfo.xml', 'run/InterOp/', 'run/Data'])
+        self.assertEqual(found, set(['run/RunInfo.xml', 'run/InterOp/']))
+        self.assertEqual(gzip.open(list_gz_path).read(), open(list_path).read())
+
+        not_a_tar_cmd_list = ['head', '-c', '2048', '/dev/urandom']
+        (retcode, list_retcode, checksums, stats) = rundir_utils.write_archive_stream(not_a_tar_cmd_list, list_path,
+                                                                                      out_path=tgz_path)
+        self.assertEqual(retcode, 0)
+        self.assertNotEqual(list_retcode, 0)
+        (retcode, list_retcode, checksums, stats) = rundir_utils.write_archive_stream(['false'], list_path,
+                                                                                      out_path=tgz_path)
+        self.assertNotEqual(retcode, 0)
+
+if __name__=='__main__':
+    unittest.main()
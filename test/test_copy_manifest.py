@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+if sys.version_info[0:2] == (2, 6):
+    import unittest2 as unittest
+else:
+    import unittest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),'..'))
+from bin import copy_manifest
+
+class TestCopyManifest(unittest.TestCase):
+
+    def setUp(self):
+        self.source = tempfile.mkdtemp()
+        self.dest = tempfile.mkdtemp()
+        self.bcl = os.path.join('Data', 'Intensities', 'BaseCalls', 'L001', 'C1.1', 's_1_1101.bcl')
+        self.write_file(self.source, self.bcl, 'bcl data')
+        self.write_file(self.source, 'RunInfo.xml', '<RunInfo/>')
+        self.write_file(self.source, os.path.join('Thumbnail_Images', 'L001', 'a.jpg'), 'jpg')
+
+    def tearDown(self):
+        shutil.rmtree(self.source)
+        shutil.rmtree(self.dest)
+
+    def write_file(self, root, rel_path, data, mtime=1400000000):
+        path = os.path.join(root, rel_path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as f:
+            f.write(data)
+        os.utime(path, (mtime, mtime))
+
+    def get_dest_manifest(self, dest=None):
+        output = subprocess.check_output(['sh', '-c', copy_manifest.get_find_command(dest or self.dest)])
+        return copy_manifest.parse_find_output(output)
+
+    def testDiffManifests(self):
+        source = copy_manifest.build_manifest(self.source, exclude=('Thumbnail_Images',))
+        self.assertEqual(sorted(source.keys()), sorted([self.bcl, 'RunInfo.xml']))
+        self.assertEqual(copy_manifest.diff_manifests(source, self.get_dest_manifest()),
+                         sorted([self.bcl, 'RunInfo.xml']))
+
+        # Copied with its mtime, as rsync -t does.
+        self.write_file(self.dest, self.bcl, 'bcl data')
+        self.write_file(self.dest, 'RunInfo.xml', '<RunInfo/>', mtime=1400000001)
+        self.assertEqual(copy_manifest.diff_manifests(source, self.get_dest_manifest()), ['RunInfo.xml'])
+
+    def testListMissingDestination(self):
+        self.assertEqual(self.get_dest_manifest(os.path.join(self.dest, 'not_copied_yet')), {})
+
+    def list_dest(self, samples=0, sample_bytes=4):
+        # REMOTE_MANIFEST_SCRIPT run here, as it is over ssh.
+        proc = subprocess.Popen(copy_manifest.get_remote_manifest_command(self.dest, sample_bytes, samples,
+                                                                          python=sys.executable),
+                                stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        output = proc.communicate(copy_manifest.REMOTE_MANIFEST_SCRIPT)[0]
+        self.assertEqual(proc.returncode, 0)
+        return output.splitlines(True)
+
+    def testSampleRanges(self):
+        self.assertEqual(copy_manifest.get_sample_ranges(10, 4, 3), [(0, 10)])
+        self.assertEqual(copy_manifest.get_sample_ranges(100, 4, 3), [(0, 4), (48, 4), (96, 4)])
+
+    def testVerifyCopy(self):
+        source = copy_manifest.build_manifest(self.source, exclude=('Thumbnail_Images',))
+        verification = copy_manifest.verify_copy(source, self.list_dest())
+        self.assertFalse(verification.is_ok())
+        self.assertEqual(verification.missing, sorted([self.bcl, 'RunInfo.xml']))
+
+        self.write_file(self.dest, self.bcl, 'bcl data')
+        self.write_file(self.dest, 'RunInfo.xml', '<RunInfo/>', mtime=1400000001)
+        self.write_file(self.dest, 'extra.txt', '')
+        verification = copy_manifest.verify_copy(source, self.list_dest())
+        self.assertEqual((verification.missing, verification.changed, verification.extra), ([], ['RunInfo.xml'], 1))
+
+        # Same size and mtime, different content, caught by the sampled hashes.
+        self.write_file(self.dest, 'RunInfo.xml', '<RunInfo/>')
+        self.write_file(self.dest, self.bcl, 'bcl dat!')
+        copy_manifest.add_sample_hashes(self.source, source, 4, 2)
+        verification = copy_manifest.verify_copy(source, self.list_dest(samples=2))
+        self.assertEqual((verification.changed, verification.corrupt), ([], [self.bcl]))
+        self.write_file(self.dest, self.bcl, 'bcl data')
+        self.assertTrue(copy_manifest.verify_copy(source, self.list_dest(samples=2)).is_ok())
+
+if __name__=='__main__':
+    unittest.main()
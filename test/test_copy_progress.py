@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+
+import os
+import sys
+
+if sys.version_info[0:2] == (2, 6):
+    import unittest2 as unittest
+else:
+    import unittest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),'..'))
+from bin import copy_progress
+from bin.copy_progress import CopyProgress, ProgressMonitor
+
+MB = 1024 * 1024
+
+class TestCopyProgress(unittest.TestCase):
+
+    def testTreeReadBytes(self):
+        table = {10: (1, 'python', 100),
+                 11: (10, 'rsync', 1000),
+                 12: (11, 'ssh', 1000),
+                 13: (10, 'rsync', 500),
+                 20: (1, 'rsync', 7)}
+        self.assertEqual(copy_progress.get_tree_read_bytes(table, 10), {10: 100, 11: 1000, 13: 500})
+        self.assertEqual(copy_progress.get_tree_read_bytes(table, 30), None)
+        if os.path.exists('/proc/self/io'):
+            self.assertTrue(os.getpid() in copy_progress.read_process_table())
+
+    def testProgressAcrossProcesses(self):
+        progress = CopyProgress(10)
+        progress.add_sample(0, {10: 100, 11: 1000}, 3600)
+        # Shard rsync 11 finished and 13 started.
+        progress.add_sample(600, {10: 100, 13: 600 * MB}, 3600)
+        self.assertEqual(progress.bytes, 600 * MB)
+        self.assertEqual(progress.get_rate(3600), None)
+        progress.add_sample(3600, {10: 100, 13: 600 * MB}, 3600)
+        self.assertEqual(progress.get_rate(3600), 600 * MB / 3600.0)
+        # Only one sample older than the window is kept.
+        progress.add_sample(4200, {10: 100, 13: 600 * MB}, 3600)
+        self.assertEqual(progress.get_rate(3600), 0)
+        self.assertEqual(len(progress.samples), 3)
+
+    def testStalled(self):
+        monitor = ProgressMonitor(window_seconds=600, min_rate=MB)
+        progress = monitor.progress['run'] = CopyProgress(10)
+        progress.add_sample(0, {10: 0}, 600)
+        progress.add_sample(600, {10: 601 * MB}, 600)
+        self.assertFalse(monitor.is_stalled('run'))
+        progress.add_sample(1200, {10: 700 * MB}, 600)
+        self.assertTrue(monitor.is_stalled('run'))
+
+    def testSample(self):
+        if not os.path.exists('/proc/self/io'):
+            return
+        monitor = ProgressMonitor()
+        self.assertEqual(monitor.sample({'run': os.getpid()}), {'run': 0})
+        self.assertTrue(monitor.is_measured('run'))
+        monitor.sample({})
+        self.assertFalse(monitor.is_measured('run'))
+
+if __name__=='__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import time
+
+if sys.version_info[0:2] == (2, 6):
+    import unittest2 as unittest
+else:
+    import unittest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),'..'))
+from bin.copy_scheduler import CopyScheduler, CopyCandidate
+
+GB = 1000 ** 3
+
+class TestCopyScheduler(unittest.TestCase):
+
+    def testRank(self):
+        scheduler = CopyScheduler(4, age_halving_seconds=3600)
+        hiseq = CopyCandidate('hiseq', 1000 * GB)
+        miseq = CopyCandidate('miseq', 10 * GB)
+        rapid = CopyCandidate('rapid', 2000 * GB, priority=10)
+        self.assertEqual([c.key for c in scheduler.rank([hiseq, miseq, rapid])], ['rapid', 'miseq', 'hiseq'])
+
+        # A large run that has waited long enough goes before a new small one.
+        scheduler.ready_since['hiseq'] = time.time() - 1000 * 3600
+        new_miseq = CopyCandidate('new_miseq', 10 * GB)
+        self.assertEqual([c.key for c in scheduler.rank([new_miseq, hiseq])], ['hiseq', 'new_miseq'])
+
+    def testSelect(self):
+        scheduler = CopyScheduler(2)
+        candidates = [CopyCandidate('run%d' % i, i * GB) for i in range(1, 4)]
+        (start, postponed) = scheduler.select(candidates, 1)
+        self.assertEqual([c.key for c in start], ['run1'])
+        self.assertEqual([c.key for c in postponed], ['run2', 'run3'])
+
+        # Runs that started copying are forgotten.
+        scheduler.select(candidates[1:], 2)
+        self.assertEqual(sorted(scheduler.ready_since.keys()), ['run2', 'run3'])
+
+        # No copies at all with MAX_COPY_PROCESSES=0 (--no_copy)
+        self.assertEqual(CopyScheduler(0).select(candidates, 0)[0], [])
+
+    def testBandwidthBudget(self):
+        scheduler = CopyScheduler(8, bandwidth_budget=400e6)
+        scheduler.throughput = 300e6
+        candidates = [CopyCandidate('run%d' % i, GB) for i in range(4)]
+        # 100 MB/s per copy; room for one more under the budget
+        (start, postponed) = scheduler.select(candidates, 3)
+        self.assertEqual(len(start), 1)
+
+    def testAdaptLimit(self):
+        scheduler = CopyScheduler(4)
+        scheduler.limit = 2
+        scheduler.adapt(1, 100e6)
+        scheduler.adapt(2, 190e6)
+        # A second copy nearly doubled throughput; try a third.
+        self.assertEqual(scheduler.limit, 3)
+        scheduler.adapt(3, 195e6)
+        # A third copy didn't help; back to two.
+        self.assertEqual(scheduler.limit, 2)
+
+if __name__=='__main__':
+    unittest.main()
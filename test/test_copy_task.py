@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+
+import multiprocessing
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+if sys.version_info[0:2] == (2, 6):
+    import unittest2 as unittest
+else:
+    import unittest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),'..'))
+from bin.copy_task import CopyTaskProcess
+from bin.state_journal import ReattachedProcess, is_process_running
+
+class ExitTask:
+    def __init__(self, code):
+        self.code = code
+    def run(self):
+        if self.code == 'raise':
+            raise ValueError('upload failed')
+        sys.exit(self.code)
+
+class SleepTask:
+    # Starts a grandchild, as a tar or rsync, records its pid, and waits on it.
+    def __init__(self, pid_file):
+        self.pid_file = pid_file
+    def run(self):
+        proc = subprocess.Popen(['sleep', '60'])
+        with open(self.pid_file + '.tmp', 'w') as f:
+            f.write('%d\n' % proc.pid)
+        os.rename(self.pid_file + '.tmp', self.pid_file)
+        return proc.wait()
+
+class TestCopyTask(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def testExitCodes(self):
+        for (code, returncode) in ((None, 0), (3, 3), ('failed', 1), ('raise', 1)):
+            proc = CopyTaskProcess(ExitTask(code), 'exit')
+            self.assertEqual(proc.wait(), returncode)
+            self.assertEqual(proc.poll(), returncode)
+
+    def testKillProcessGroup(self):
+        pid_file = os.path.join(self.tmp_dir, 'sleep.pid')
+        proc = CopyTaskProcess(SleepTask(pid_file), 'sleep')
+        # Not a multiprocessing child, so exiting autocopy doesn't wait for it.
+        self.assertEqual(multiprocessing.active_children(), [])
+        self.assertEqual(os.getpgid(proc.pid), proc.pid)
+        for i in range(100):
+            if os.path.exists(pid_file):
+                break
+            time.sleep(0.05)
+        sleep_pid = int(open(pid_file).read())
+        self.assertEqual(proc.poll(), None)
+
+        proc.kill()
+        self.assertTrue(proc.wait() < 0)
+        for i in range(100):
+            if not is_process_running(sleep_pid):
+                break
+            time.sleep(0.05)
+        self.assertFalse(is_process_running(sleep_pid))
+
+    def testReattach(self):
+        # After a restart, autocopy finds the copy by pid and can still stop its group.
+        pid_file = os.path.join(self.tmp_dir, 'sleep.pid')
+        proc = CopyTaskProcess(SleepTask(pid_file), 'sleep')
+        ReattachedProcess(proc.pid).kill()
+        self.assertTrue(proc.wait() < 0)
+
+if __name__=='__main__':
+    unittest.main()
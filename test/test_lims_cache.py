@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import threading
+import time
+
+if sys.version_info[0:2] == (2, 6):
+    import unittest2 as unittest
+else:
+    import unittest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),'..'))
+from bin.lims_cache import LimsCache
+
+class NotFound(Exception):
+    pass
+
+class TestLimsCache(unittest.TestCase):
+
+    def setUp(self):
+        self.lookups = []
+        self.lookups_lock = threading.Lock()
+
+    def fetch(self, run_name):
+        with self.lookups_lock:
+            self.lookups.append(run_name)
+        if run_name.startswith('missing'):
+            raise NotFound(run_name)
+        return 'runinfo %s' % run_name
+
+    def testPrefetch(self):
+        cache = LimsCache(self.fetch, ttl_seconds=60, threads=4)
+        run_names = ['run%d' % i for i in range(10)] + ['missing0']
+        cache.prefetch(run_names)
+        self.assertEqual(sorted(self.lookups), sorted(run_names))
+        # Later lookups in the pass, including failed ones, come from the cache
+        self.assertEqual(cache.get('run3'), 'runinfo run3')
+        self.assertRaises(NotFound, cache.get, 'missing0')
+        cache.prefetch(run_names)
+        self.assertEqual(len(self.lookups), len(run_names))
+
+    def expire(self, cache, run_name, seconds):
+        entry = cache.entries[run_name]
+        entry.fetched_at -= seconds
+        entry.expires_at -= seconds
+        entry.stale_until -= seconds
+
+    def testExpiry(self):
+        cache = LimsCache(self.fetch, ttl_seconds=60, max_stale_seconds=0)
+        cache.get('run0')
+        self.expire(cache, 'run0', 60)
+        cache.get('run0')
+        self.assertEqual(self.lookups, ['run0', 'run0'])
+
+    def testNotFoundTTL(self):
+        cache = LimsCache(self.fetch, ttl_seconds=60, not_found_ttl_seconds=600,
+                          is_not_found=lambda error: isinstance(error, NotFound))
+        self.assertRaises(NotFound, cache.get, 'missing0')
+        self.expire(cache, 'missing0', 60)
+        cache.prefetch(['missing0'])
+        self.assertRaises(NotFound, cache.get, 'missing0')
+        self.assertEqual(self.lookups, ['missing0'])
+
+    def testStaleWhileRevalidate(self):
+        cache = LimsCache(self.fetch, ttl_seconds=60, max_stale_seconds=600)
+        cache.get('run0')
+        self.expire(cache, 'run0', 60)
+        self.assertEqual(cache.get('run0'), 'runinfo run0')
+        for thread in threading.enumerate():
+            if thread.name == 'lims_refresh_run0':
+                thread.join()
+        self.assertEqual(self.lookups, ['run0', 'run0'])
+        self.assertTrue(cache.entries['run0'].expires_at > time.time())
+
+    def testServeStaleWhileLimsIsDown(self):
+        cache = LimsCache(self.fetch, ttl_seconds=60, max_stale_seconds=600, error_ttl_seconds=30)
+        cache.get('run0')
+        self.expire(cache, 'run0', 60)
+        def fetch(run_name):
+            self.lookups.append(run_name)
+            raise IOError('LIMS is down')
+        cache.fetch = fetch
+        cache.prefetch(['run0', 'run1'])
+        self.assertEqual(cache.get('run0'), 'runinfo run0')
+        self.assertRaises(IOError, cache.get, 'run1')
+        # Neither is retried until error_ttl_seconds have passed
+        cache.prefetch(['run0', 'run1'])
+        self.assertEqual(len(self.lookups), 3)
+
+    def testLRU(self):
+        cache = LimsCache(self.fetch, max_entries=2)
+        cache.get('run0')
+        cache.get('run1')
+        cache.get('run0')
+        cache.get('run2')
+        self.assertEqual(list(cache.entries.keys()), ['run0', 'run2'])
+
+if __name__=='__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+
+import gzip
+import os
+import subprocess
+import sys
+import tarfile
+from StringIO import StringIO
+
+if sys.version_info[0:2] == (2, 6):
+    import unittest2 as unittest
+else:
+    import unittest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),'..'))
+from bin import parallel_compress
+from bin.parallel_compress import ParallelGzipWriter
+
+class TestParallelCompress(unittest.TestCase):
+
+    def setUp(self):
+        # Compressible, and not a multiple of the block size
+        self.data = ''.join(os.urandom(100) * 50 for i in range(100)) + 'end'
+
+    def compress(self, chunks, **args):
+        out = StringIO()
+        writer = ParallelGzipWriter(out, block_size=64 * 1024, **args)
+        for chunk in chunks:
+            writer.write(chunk)
+        stats = writer.close()
+        return (out.getvalue(), stats)
+
+    def testGzipMembers(self):
+        chunks = [self.data[start:start + 30000] for start in range(0, len(self.data), 30000)]
+        (compressed, stats) = self.compress(chunks, level=1, threads=3)
+        self.assertEqual(gzip.GzipFile(fileobj=StringIO(compressed)).read(), self.data)
+        gunzip = subprocess.Popen(['gzip', '-d', '-c'], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self.assertEqual(gunzip.communicate(compressed)[0], self.data)
+        self.assertEqual((stats.bytes_in, stats.bytes_out), (len(self.data), len(compressed)))
+        self.assertTrue(stats.get_ratio() > 10)
+        self.assertTrue('gzip level 1, 3 threads' in str(stats))
+        # One member per block, each starting with the gzip magic
+        self.assertEqual(compressed.count('\x1f\x8b\x08\x00\x00\x00\x00\x00\x04\xff'), 8)
+
+    def testEmpty(self):
+        (compressed, stats) = self.compress([])
+        self.assertEqual(gzip.GzipFile(fileobj=StringIO(compressed)).read(), '')
+
+    def testTar(self):
+        out = StringIO()
+        compressor = parallel_compress.open_compressor(out, 'gzip', threads=2)
+        tar_file = tarfile.open(fileobj=compressor, mode='w|')
+        tarinfo = tarfile.TarInfo('run/RunInfo.xml')
+        tarinfo.size = len(self.data)
+        tar_file.addfile(tarinfo, StringIO(self.data))
+        tar_file.close()
+        compressor.close()
+        out.seek(0)
+        self.assertEqual(tarfile.open(fileobj=out, mode='r:gz').extractfile('run/RunInfo.xml').read(), self.data)
+
+    def testFormats(self):
+        self.assertTrue(parallel_compress.is_level_valid('gzip', 9))
+        self.assertFalse(parallel_compress.is_level_valid('gzip', 10))
+        self.assertTrue(parallel_compress.is_level_valid('zstd', None))
+        # A zstd level given for a gzip stream
+        self.assertRaises(ValueError, ParallelGzipWriter, StringIO(), level=19)
+        self.assertFalse(parallel_compress.is_format_available('bzip2'))
+        self.assertRaises(ValueError, parallel_compress.open_compressor, StringIO(), 'bzip2')
+        if not parallel_compress.is_format_available('zstd'):
+            return
+        out = StringIO()
+        compressor = parallel_compress.open_compressor(out, 'zstd', threads=2)
+        compressor.write(self.data)
+        compressor.close()
+        self.assertEqual(parallel_compress.zstandard.ZstdDecompressor().decompressobj().decompress(out.getvalue()),
+                         self.data)
+
+if __name__=='__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+
+import os
+import shutil
+import sys
+import tempfile
+
+if sys.version_info[0:2] == (2, 6):
+    import unittest2 as unittest
+else:
+    import unittest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),'..'))
+from bin import parallel_rsync
+from bin.ssh_connection import SSHConnection
+
+class TestParallelRsync(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.run_dir = os.path.join(self.root, '150101_TEST_0001_AC00000XX')
+        basecalls = os.path.join(self.run_dir, 'Data', 'Intensities', 'BaseCalls')
+        for lane in range(1, 9):
+            self.write_file(os.path.join(basecalls, 'L%03d' % lane, 's_%d_1101.bcl' % lane), 400 * 1024)
+        self.write_file(os.path.join(self.run_dir, 'InterOp', 'QMetricsOut.bin'), 100 * 1024)
+        self.write_file(os.path.join(self.run_dir, 'Thumbnail_Images', 'L001', 's_1_1101_a.jpg'), 1000 * 1024)
+        self.write_file(os.path.join(self.run_dir, 'RunInfo.xml'), 1024)
+        os.makedirs(os.path.join(self.run_dir, 'Logs'))
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def write_file(self, path, size):
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as f:
+            f.write(os.urandom(size))
+
+    def testPlanShards(self):
+        shards = parallel_rsync.plan_shards(self.run_dir, 4, exclude=('Thumbnail_Images',),
+                                            pieces_per_stream=2)
+        self.assertEqual(len(shards), 4)
+        paths = sorted(path for (shard_paths, size) in shards for path in shard_paths)
+        lanes = [os.path.join('Data', 'Intensities', 'BaseCalls', 'L%03d' % lane) for lane in range(1, 9)]
+        self.assertEqual(paths, sorted(lanes + ['InterOp', 'Logs', 'RunInfo.xml']))
+        # Two lanes per shard, with the small pieces spread over them.
+        sizes = [size for (shard_paths, size) in shards]
+        self.assertTrue(max(sizes) - min(sizes) <= 200 * 1024)
+
+    def testPlanShardsSingleStream(self):
+        shards = parallel_rsync.plan_shards(self.run_dir, 1, exclude=('Thumbnail_Images',))
+        self.assertEqual(len(shards), 1)
+        self.assertEqual(sorted(shards[0][0]), ['Data', 'InterOp', 'Logs', 'RunInfo.xml'])
+
+    def testRsyncCommands(self):
+        copy = parallel_rsync.ParallelRsync(self.run_dir + '/', SSHConnection('cluster', 'autocopy', self.root),
+                                            '~/runs/', ['-rlpt'], 4)
+        self.assertEqual(copy.get_dest(), 'cluster:~/runs/150101_TEST_0001_AC00000XX/')
+        shard_cmd = copy.get_rsync_command('/tmp/shard0')
+        self.assertEqual(shard_cmd[-4:], ['--files-from=/tmp/shard0', '--checksum', self.run_dir + '/', copy.get_dest()])
+        self.assertTrue('ControlMaster=auto' in shard_cmd[shard_cmd.index('-e') + 1])
+        self.assertFalse('--checksum' in copy.get_rsync_command())
+
+if __name__=='__main__':
+    unittest.main()
@@ -1,10 +1,12 @@
 #!/usr/bin/env python
 
 import os
+import shutil
 import sys
+import tempfile
 
 if sys.version_info[0:2] == (2, 6):
-    import unittest2 asunittest
+    import unittest2 as unittest
 else:
     import unittest
 
@@ -34,6 +36,75 @@ class TestRundir(unittest.TestCase):
     def testStr(self):
         self.rundir.str()
 
+    def testGetStatus(self):
+        self.assertEqual(self.rundir.get_status(), RunDir.STATUS_BASECALLING_COMPLETE_READ3)
+        self.assertEqual(self.rundir.get_status_string(), "Base Calling Complete (Read 3)")
+
+    def testGetStatusSeesNewStatusFile(self):
+        run_root = tempfile.mkdtemp()
+        try:
+            os.mkdir(os.path.join(run_root, self.runname))
+            rundir = RunDir(run_root, self.runname)
+            self.assertEqual(rundir.get_status(), RunDir.STATUS_INITIALIZED)
+            open(os.path.join(rundir.get_path(), "RTAComplete.txt"), "w").close()
+            rundir.status_listed_at -= RunDir.STATUS_CACHE_SECONDS
+            self.assertEqual(rundir.get_status(), RunDir.STATUS_RTA_COMPLETE)
+        finally:
+            shutil.rmtree(run_root)
+
+    def testGetDiskUsage(self):
+        run_root = tempfile.mkdtemp()
+        try:
+            basecalls = os.path.join(run_root, self.runname, 'Data', 'Intensities', 'BaseCalls')
+            os.makedirs(basecalls)
+            with open(os.path.join(basecalls, 's_1_1101.bcl'), 'w') as f:
+                f.write('x' * 100000)
+            rundir = RunDir(run_root, self.runname)
+            usage = rundir.get_disk_usage()
+            subtrees = rundir.get_disk_usage_by_subtree()
+            bcl_bytes = os.stat(os.path.join(basecalls, 's_1_1101.bcl')).st_blocks * 512
+            self.assertTrue(usage > subtrees['Data/Intensities'] > subtrees['Data/Intensities/BaseCalls'] > bcl_bytes)
+            self.assertEqual(subtrees['Thumbnail_Images'], None)
+            # Unchanged directories are answered from the cache
+            self.assertEqual(len(rundir.disk_usage_cache), 4)
+            self.assertEqual(rundir.get_disk_usage(), usage)
+            # A new file is seen once its directory changes
+            for listing in rundir.disk_usage_cache.values():
+                listing.listed_at += 10
+            with open(os.path.join(basecalls, 's_1_1102.bcl'), 'w') as f:
+                f.write('x' * 100000)
+            self.assertTrue(rundir.get_disk_usage() > usage)
+        finally:
+            shutil.rmtree(run_root)
+
+    def testGetRunParameters(self):
+        run_params = self.rundir.get_run_parameters()
+        self.assertEqual(run_params.application_name, 'HiSeq Control Software')
+        self.assertEqual(run_params.run_start_date, '141117')
+        self.assertEqual(run_params.setup_reads, [(1, 101, 'N'), (2, 8, 'Y'), (3, 101, 'N')])
+        # Parsed once, and reused while the file is unchanged
+        self.assertIs(self.rundir.get_run_parameters(), run_params)
+        run_params.mtime -= 1
+        self.assertIsNot(self.rundir.get_run_parameters(), run_params)
+
+    def testGetRunInfo(self):
+        run_info = self.rundir.get_run_info()
+        self.assertEqual(run_info.run_number, '390')
+        self.assertEqual(run_info.instrument, 'MONK')
+        self.assertEqual((run_info.lane_count, run_info.surface_count, run_info.swath_count, run_info.tile_count),
+                         (8, 2, 3, 16))
+        self.assertEqual(self.rundir.get_number(), '390')
+        self.assertEqual(self.rundir.get_flowcell(), 'C4JCD')
+        self.assertEqual(self.rundir.get_cycle_list(), [101, 8, 101])
+
+    def testGetTileList(self):
+        # From <FlowcellLayout>: 2 surfaces, 3 swaths, 16 tiles
+        tile_list = self.rundir.get_tile_list()
+        self.assertEqual(len(tile_list), 96)
+        self.assertEqual((tile_list[0], tile_list[15], tile_list[16], tile_list[-1]), (1101, 1116, 1201, 2316))
+        self.assertEqual(self.rundir.get_lane_list(), range(1, 9))
+        self.assertEqual(self.rundir.get_surface_list(), [1, 2])
+
 if __name__=='__main__':
     unittest.main()
     
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+
+import os
+import shutil
+import sys
+import tempfile
+
+if sys.version_info[0:2] == (2, 6):
+    import unittest2 as unittest
+else:
+    import unittest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),'..'))
+from bin import rundir_utils
+from bin import rundir_layout
+from bin.rundir import RunDir
+from bin.rundir_index import index_intensities
+from bin.rundir_layout import FileSpec
+
+class MiSeqRunDir:
+    # The parts of a RunDir validate() uses, for a MiSeq run of 3 cycles.
+    PLATFORM_ILLUMINA_GA = RunDir.PLATFORM_ILLUMINA_GA
+    PLATFORM_ILLUMINA_HISEQ = RunDir.PLATFORM_ILLUMINA_HISEQ
+    PLATFORM_ILLUMINA_MISEQ = RunDir.PLATFORM_ILLUMINA_MISEQ
+
+    def __init__(self, path):
+        self.path = path
+        self.validated = None
+
+    def get_path(self): return self.path
+    def get_dir(self): return os.path.basename(self.path)
+    def get_platform(self): return RunDir.PLATFORM_ILLUMINA_MISEQ
+    def get_lane_list(self): return [1]
+    def get_tile_list(self): return range(1101, 1113)
+    def get_cycle_list(self): return [2, 1]
+
+class TestRunDirIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.intensities = os.path.join(self.path, 'Data', 'Intensities')
+        basecalls = os.path.join(self.intensities, 'BaseCalls')
+        files = [os.path.join(basecalls, 'config.xml')]
+        for tile in range(1101, 1113):
+            files.append(os.path.join(self.intensities, 'L001', 's_1_%04d.locs' % tile))
+            files.append(os.path.join(basecalls, 'L001', 's_1_%04d.filter' % tile))
+            for cycle in range(1, 4):
+                for ext in ('bcl', 'stats'):
+                    files.append(os.path.join(basecalls, 'L001', 'C%d.1' % cycle, 's_1_%d.%s' % (tile, ext)))
+        for path in files:
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            open(path, 'w').close()
+        # Not for lane 1, so not counted
+        open(os.path.join(basecalls, 'L001', 'C1.1', 's_2_1101.bcl'), 'w').close()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def testFileSpec(self):
+        spec = FileSpec('bcl', 'BaseCalls/L{lane:03d}/C{cycle}.1', 's_{lane}_{tile}.bcl')
+        self.assertEqual(spec.parse_dir('BaseCalls/L002/C17.1'), {'lane': 2, 'cycle': 17})
+        self.assertEqual(spec.parse_dir('BaseCalls/L002'), None)
+        self.assertEqual(spec.parse_name('s_2_1101.bcl', {'lane': 2, 'cycle': 17}), (2, 17, 1101, 'bcl'))
+        self.assertEqual(spec.parse_name('s_1_1101.bcl', {'lane': 2, 'cycle': 17}), None)
+        self.assertEqual(spec.get_dir((2, 17, 1101, 'bcl')), 'BaseCalls/L002/C17.1')
+        self.assertEqual(spec.get_name((2, 17, 1101, 'bcl')), 's_2_1101.bcl')
+        cbcl = FileSpec('cbcl', 'BaseCalls/L{lane:03d}/C{cycle}.1', 'L{lane:03d}_{surface}.cbcl')
+        self.assertEqual(len(cbcl.get_keys([1, 2], range(1, 11), [1, 2])), 40)
+        locs = FileSpec('locs', '', 's.locs')
+        self.assertEqual(locs.get_keys([1, 2], [1], [1101]), set([(None, None, None, 'locs')]))
+
+    def testIndex(self):
+        file_specs = rundir_layout.get_layout(MiSeqRunDir(self.path), self.intensities).file_specs
+        index = index_intensities(self.intensities, file_specs, threads=2)
+        self.assertTrue(index.has_dir('BaseCalls/L001/C3.1'))
+        self.assertTrue(index.has_file('BaseCalls', 'config.xml'))
+        self.assertTrue((1, 2, 1101, 'bcl') in index.keys)
+        self.assertTrue((1, None, 1105, 'locs') in index.keys)
+        self.assertTrue((None, None, None, 'config') in index.keys)
+        self.assertFalse((2, 1, 1101, 'bcl') in index.keys)
+        self.assertEqual(len(index.keys), 12 * 3 * 2 + 12 + 1)
+
+        os.remove(os.path.join(self.intensities, 'BaseCalls', 'L001', 'C2.1', 's_1_1107.stats'))
+        index = index_intensities(self.intensities, file_specs)
+        stats = [spec for spec in file_specs if spec.kind == 'stats'][0]
+        self.assertEqual(index.get_missing(stats, [1], range(1, 4), range(1101, 1113)),
+                         set([(1, 2, 1107, 'stats')]))
+
+    def testValidate(self):
+        rundir = MiSeqRunDir(self.path)
+        self.assertTrue(rundir_utils.validate(rundir))
+        self.assertTrue(rundir.validated)
+
+        os.remove(os.path.join(self.intensities, 'BaseCalls', 'L001', 'C3.1', 's_1_1101.bcl'))
+        self.assertFalse(rundir_utils.validate(rundir))
+
+        shutil.rmtree(os.path.join(self.intensities, 'BaseCalls'))
+        self.assertFalse(rundir_utils.validate(rundir))
+
+    def testValidateNovaSeq(self):
+        # An RTA 3 run: no runParameters.xml that RunDir reads, CBCL files.
+        shutil.rmtree(self.intensities)
+        runroot = tempfile.mkdtemp(dir=self.path)
+        run_path = os.path.join(runroot, '180101_A00123_0001_AH00000DSX')
+        basecalls = os.path.join(run_path, 'Data', 'Intensities', 'BaseCalls')
+        for lane in (1, 2):
+            for cycle in range(1, 4):
+                os.makedirs(os.path.join(basecalls, 'L%03d' % lane, 'C%d.1' % cycle))
+                for surface in (1, 2):
+                    open(os.path.join(basecalls, 'L%03d' % lane, 'C%d.1' % cycle, 'L%03d_%d.cbcl' % (lane, surface)), 'w').close()
+            for tile in (1101, 1102, 2101, 2102):
+                open(os.path.join(basecalls, 'L%03d' % lane, 's_%d_%04d.filter' % (lane, tile)), 'w').close()
+        open(os.path.join(os.path.dirname(basecalls), 's.locs'), 'w').close()
+        with open(os.path.join(run_path, 'RunInfo.xml'), 'w') as f:
+            f.write('<?xml version="1.0"?><RunInfo><Run Id="180101_A00123_0001_AH00000DSX" Number="1">'
+                    '<Reads><Read Number="1" NumCycles="2" IsIndexedRead="N" />'
+                    '<Read Number="2" NumCycles="1" IsIndexedRead="Y" /></Reads>'
+                    '<FlowcellLayout LaneCount="2" SurfaceCount="2" SwathCount="1" TileCount="2">'
+                    '<TileSet TileNamingConvention="FourDigit"><Tiles>'
+                    '<Tile>1_1101</Tile><Tile>1_1102</Tile><Tile>1_2101</Tile><Tile>1_2102</Tile>'
+                    '</Tiles></TileSet></FlowcellLayout></Run></RunInfo>')
+
+        rundir = RunDir(runroot, os.path.basename(run_path))
+        self.assertEqual(rundir_layout.get_layout(rundir, os.path.dirname(basecalls)).name, 'CBCL')
+        self.assertTrue(rundir_utils.validate(rundir))
+
+        os.remove(os.path.join(basecalls, 'L002', 'C3.1', 'L002_2.cbcl'))
+        self.assertFalse(rundir_utils.validate(rundir))
+
+if __name__=='__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+
+import os
+import re
+import shutil
+import sys
+import tempfile
+import time
+
+if sys.version_info[0:2] == (2, 6):
+    import unittest2 as unittest
+else:
+    import unittest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),'..'))
+from bin.runroot_watcher import RunRootWatcher
+
+RUNDIR_REG = re.compile(r'^\d{6}_')
+STATUS_FILES = [None, 'First_Base_Report.txt', 'RTAComplete.txt']
+
+class TestRunRootWatcher(unittest.TestCase):
+
+    def setUp(self):
+        self.run_root = tempfile.mkdtemp()
+        self.rundir = os.path.join(self.run_root, '141117_MONK_0387_AC4JCDACXX')
+        os.mkdir(self.rundir)
+        self.messages = []
+        self.watcher = None
+
+    def tearDown(self):
+        if self.watcher:
+            self.watcher.close()
+        shutil.rmtree(self.run_root)
+
+    def get_watcher(self, mode, poll_seconds=60):
+        self.watcher = RunRootWatcher([self.run_root], RUNDIR_REG, STATUS_FILES, mode=mode,
+                                      poll_seconds=poll_seconds, log=self.messages.append)
+        return self.watcher
+
+    def get_inotify_watcher(self):
+        watcher = self.get_watcher(RunRootWatcher.MODE_INOTIFY)
+        if watcher.inotify_fd is None or watcher.poll_roots:
+            self.skipTest('inotify is not available for %s' % self.run_root)
+        return watcher
+
+    def write_file(self, path):
+        with open(path, 'w') as f:
+            f.write('done\n')
+
+    def testNewRunDirWakes(self):
+        watcher = self.get_inotify_watcher()
+        self.assertFalse(watcher.wait(0.1))
+        os.mkdir(os.path.join(self.run_root, '141126_PINKERTON_0343_BC4J1PACXX'))
+        start = time.time()
+        self.assertTrue(watcher.wait(10))
+        self.assertTrue(time.time() - start < 5)
+        # The new run dir is watched too.
+        self.write_file(os.path.join(self.run_root, '141126_PINKERTON_0343_BC4J1PACXX', 'First_Base_Report.txt'))
+        self.assertTrue(watcher.wait(10))
+
+    def testStatusFileWakes(self):
+        watcher = self.get_inotify_watcher()
+        self.write_file(os.path.join(self.rundir, 'RTAComplete.txt'))
+        self.assertTrue(watcher.wait(10))
+        self.assertTrue('Status file RTAComplete.txt written in 141117_MONK_0387_AC4JCDACXX' in self.messages)
+
+    def testOwnFilesDontWake(self):
+        watcher = self.get_inotify_watcher()
+        # What autocopy writes: the completed and aborted subdirs, and tars in the run dir.
+        os.mkdir(os.path.join(self.run_root, 'DNAnexus_Runs_Completed'))
+        os.mkdir(os.path.join(self.run_root, 'DNAnexus_Runs_Aborted'))
+        self.write_file(os.path.join(self.rundir, 'Thumbnail_subset.tgz.tmp'))
+        os.rename(os.path.join(self.rundir, 'Thumbnail_subset.tgz.tmp'), os.path.join(self.rundir, 'Thumbnail_subset.tgz'))
+        self.write_file(os.path.join(self.rundir, 'Thumbnail_subset.tgz.checksums'))
+        self.assertFalse(watcher.wait(0.5))
+        # A finished run moved out of the run root doesn't wake it either.
+        os.rename(self.rundir, os.path.join(self.run_root, 'DNAnexus_Runs_Completed', os.path.basename(self.rundir)))
+        self.assertFalse(watcher.wait(0.5))
+
+    def testPollDetectsMtimeChange(self):
+        watcher = self.get_watcher(RunRootWatcher.MODE_POLL, poll_seconds=0.1)
+        self.assertEqual(watcher.poll_roots, [self.run_root])
+        self.assertEqual(watcher.inotify_fd, None)
+        self.assertFalse(watcher.wait(0.3))
+        # Set the mtime, as it may not change within the filesystem's granularity.
+        self.write_file(os.path.join(self.rundir, 'RTAComplete.txt'))
+        mtime = os.stat(self.rundir).st_mtime + 10
+        os.utime(self.rundir, (mtime, mtime))
+        self.assertTrue(watcher.wait(10))
+        self.assertTrue('Change detected in %s' % self.rundir in self.messages)
+        self.assertFalse(watcher.wait(0.3))
+
+    def testOff(self):
+        watcher = self.get_watcher(RunRootWatcher.MODE_OFF)
+        os.mkdir(os.path.join(self.run_root, '141126_PINKERTON_0343_BC4J1PACXX'))
+        self.assertFalse(watcher.wait(0.1))
+        self.assertRaises(ValueError, RunRootWatcher, [self.run_root], RUNDIR_REG, STATUS_FILES, mode='fast')
+
+if __name__=='__main__':
+    unittest.main()
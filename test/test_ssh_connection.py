@@ -0,0 +1,37 @@
+#!/usr/bin/env python
+
+import os
+import shutil
+import sys
+import tempfile
+
+if sys.version_info[0:2] == (2, 6):
+    import unittest2 as unittest
+else:
+    import unittest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),'..'))
+from bin.ssh_connection import SSHConnection
+
+class TestSSHConnection(unittest.TestCase):
+
+    def setUp(self):
+        self.control_dir = tempfile.mkdtemp()
+        self.connection = SSHConnection('cluster', 'autocopy', self.control_dir, persist_seconds=120)
+
+    def tearDown(self):
+        shutil.rmtree(self.control_dir)
+
+    def testSSHCommand(self):
+        args = self.connection.get_ssh_args()
+        self.assertEqual(args[0:3], ['ssh', '-l', 'autocopy'])
+        self.assertTrue('ControlPath=%s' % os.path.join(self.control_dir, 'autocopy-ssh-autocopy@cluster') in args)
+        self.assertTrue('ControlPersist=120' in args)
+        self.assertEqual(self.connection.get_ssh_command(), ' '.join(args))
+
+    def testNotConnected(self):
+        # No master is listening on the control socket.
+        self.assertFalse(self.connection.is_alive())
+
+if __name__=='__main__':
+    unittest.main()
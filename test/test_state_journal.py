@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+if sys.version_info[0:2] == (2, 6):
+    import unittest2 as unittest
+else:
+    import unittest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),'..'))
+from bin.state_journal import StateJournal, ReattachedProcess, get_process_start_time, is_process_running
+
+class TestStateJournal(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'autocopy_state.jsonl')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def testReplay(self):
+        journal = StateJournal(self.path)
+        journal.record('/runs', 'run_a', 'monitored')
+        journal.record('/runs', 'run_a', 'copy_started', pid=123, proc_start=456, copy_start_time=1000.0)
+        journal.record('/runs', 'run_b', 'monitored')
+        journal.record('/runs', 'run_b', 'copy_started', pid=124, proc_start=457, copy_start_time=1001.0)
+        journal.record('/runs', 'run_b', 'copy_completed', bytes=2048, copy_end_time=2000.0)
+        journal.record('/runs', 'run_c', 'monitored')
+        journal.record('/runs', 'run_c', 'forgotten')
+        # A record cut short when autocopy stopped
+        with open(self.path, 'a') as f:
+            f.write('{"run_root": "/runs", "dir": "run_a", "ev')
+
+        runs = dict((state['dir'], state) for state in StateJournal(self.path).get_runs())
+        self.assertEqual(sorted(runs.keys()), ['run_a', 'run_b'])
+        self.assertEqual(runs['run_a']['pid'], 123)
+        self.assertEqual(runs['run_a']['proc_start'], 456)
+        self.assertEqual(runs['run_a']['copy_start_time'], 1000.0)
+        self.assertFalse('pid' in runs['run_b'])
+        self.assertEqual(runs['run_b']['bytes'], 2048)
+
+        # Opening the journal compacts it to one record per run.
+        with open(self.path) as f:
+            self.assertEqual(len(f.readlines()), 2)
+
+    def testReattachedProcess(self):
+        proc = subprocess.Popen(['sleep', '60'])
+        proc_start = get_process_start_time(proc.pid)
+        self.assertTrue(is_process_running(proc.pid, proc_start))
+        self.assertFalse(is_process_running(proc.pid, proc_start + 1))
+
+        reattached = ReattachedProcess(proc.pid, proc_start)
+        self.assertEqual(reattached.poll(), None)
+        reattached.kill()
+        proc.wait()
+        self.assertEqual(reattached.poll(), ReattachedProcess.UNKNOWN_RETURNCODE)
+
+if __name__=='__main__':
+    unittest.main()
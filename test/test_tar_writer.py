@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+
+import os
+import shutil
+import sys
+import tarfile
+import tempfile
+from StringIO import StringIO
+
+if sys.version_info[0:2] == (2, 6):
+    import unittest2 as unittest
+else:
+    import unittest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),'..'))
+from bin import tar_writer
+
+class TestTarWriter(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.lane_dir = os.path.join('Data', 'Intensities', 'BaseCalls', 'L001')
+        os.makedirs(os.path.join(self.root, self.lane_dir, 'C1.1'))
+        self.bcl = os.path.join(self.lane_dir, 'C1.1', 's_1_1101.bcl')
+        with open(os.path.join(self.root, self.bcl), 'wb') as f:
+            f.write(os.urandom(tar_writer.SENDFILE_MIN_SIZE + 1000))
+        self.filter = os.path.join(self.lane_dir, 's_1_1101.filter')
+        with open(os.path.join(self.root, self.filter), 'wb') as f:
+            f.write('filter')
+        os.symlink('s_1_1101.filter', os.path.join(self.root, self.lane_dir, 'link'))
+        self.tar_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+        shutil.rmtree(self.tar_dir)
+
+    def testWriteTar(self):
+        tar_path = os.path.join(self.tar_dir, 'L001.tar')
+        stats = tar_writer.write_tar(self.root, [self.lane_dir, 'RunInfo.xml'], tar_path, walk_threads=2)
+        self.assertEqual(stats.files, 5)
+        self.assertEqual(stats.bytes, tar_writer.SENDFILE_MIN_SIZE + 1000 + len('filter'))
+        self.assertEqual(stats.missing, ['RunInfo.xml'])
+        self.assertEqual(os.path.getsize(tar_path) % tar_writer.RECORDSIZE, 0)
+        self.assertEqual(os.listdir(self.tar_dir), ['L001.tar'])
+
+        tar = tarfile.open(tar_path)
+        names = tar.getnames()
+        # Directories come before their contents, as with GNU tar
+        self.assertEqual(names[0], self.lane_dir)
+        self.assertTrue(names.index(os.path.dirname(self.bcl)) < names.index(self.bcl))
+        self.assertEqual(tar.getmember(os.path.join(self.lane_dir, 'link')).linkname, 's_1_1101.filter')
+        with open(os.path.join(self.root, self.bcl), 'rb') as f:
+            self.assertEqual(tar.extractfile(self.bcl).read(), f.read())
+        self.assertEqual(tar.extractfile(self.filter).read(), 'filter')
+
+    def testWriteTarToFileObject(self):
+        out = StringIO()
+        tar_path = os.path.join(self.tar_dir, 'L001.tar')
+        tar_writer.write_tar(self.root, [self.lane_dir], out)
+        tar_writer.write_tar(self.root, [self.lane_dir], tar_path)
+        with open(tar_path, 'rb') as f:
+            self.assertEqual(out.getvalue(), f.read())
+
+if __name__=='__main__':
+    unittest.main()